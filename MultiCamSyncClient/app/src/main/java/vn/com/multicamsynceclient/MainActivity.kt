@@ -2,6 +2,7 @@ package vn.com.multicamsynceclient
 
 import android.Manifest
 import android.os.Bundle
+import android.os.SystemClock
 import android.util.Log
 import android.view.Surface.ROTATION_90
 import android.widget.Button
@@ -17,11 +18,13 @@ import androidx.core.content.ContextCompat
 import kotlinx.coroutines.CoroutineScope
 import kotlinx.coroutines.Dispatchers
 import kotlinx.coroutines.SupervisorJob
+import kotlinx.coroutines.delay
 import kotlinx.coroutines.launch
 import kotlinx.coroutines.withContext
 import org.json.JSONArray
 import org.json.JSONObject
 import java.io.ByteArrayOutputStream
+import java.io.IOException
 import java.net.DatagramPacket
 import java.net.DatagramSocket
 import java.net.InetAddress
@@ -52,7 +55,36 @@ private const val CMD_START = "START"
 
 private const val CMD_STOP = "STOP"
 
+private const val CMD_HEARTBEAT = "HEARTBEAT"
+
+// Lệnh có xác nhận: server gửi {"type":"COMMAND","id","cmd"}, máy trả {"type":"ACK","id"}
+private const val COMMAND_ACK = "commandAck"
+private const val COMMAND = "COMMAND"
+private const val ACK = "ACK"
+private const val HEARTBEAT_INTERVAL = 5000L
+
+// Đo lệch đồng hồ với server (NTP qua UDP)
+private const val CLOCK_PING = "CLOCK_PING"
+private const val CLOCK_PONG = "CLOCK_PONG"
+
 private const val FRAME_DELAY = 200L  // 200ms ~ 5 FPS
+private const val JPEG_QUALITY = 50
+
+// Server gợi ý giảm tốc khi ghi không kịp: {"type":"RATE","level","fps","quality"}
+private const val RATE_CONTROL = "rateControl"
+private const val RATE = "RATE"
+
+// Header frame TCP v2: magic + version + flags + header_len + sequence + capture_ns + length
+private const val FRAME_PROTOCOL = "frameProtocol"
+private const val FRAME_PROTOCOL_VERSION = 2
+private val FRAME_MAGIC = byteArrayOf(0x4D, 0x43, 0x46, 0x32) // "MCF2"
+private const val FRAME_HEADER_V2_SIZE = 28
+
+// Cổng ingest dùng chung: trước frame đầu gửi "MCH1" + u16 length + JSON {deviceId, token},
+// server trả 1 byte trạng thái (0 = OK)
+private const val INGEST_HANDSHAKE = "ingestHandshake"
+private val HANDSHAKE_MAGIC = byteArrayOf(0x4D, 0x43, 0x48, 0x31) // "MCH1"
+private const val HANDSHAKE_OK = 0
 
 class MainActivity : ComponentActivity() {
 
@@ -75,6 +107,11 @@ class MainActivity : ComponentActivity() {
     private val cameraExecutor = Executors.newSingleThreadExecutor()
 
     private var lastSentTime = 0L
+    // FPS / chất lượng JPEG hiện tại (server có thể giảm qua RATE, không vượt giá trị gốc)
+    @Volatile private var frameDelay = FRAME_DELAY
+    @Volatile private var jpegQuality = JPEG_QUALITY
+    private var frameSequence = 0L
+    private var lastCommandId = 0L
 
 
     // deviceId của máy này (random đơn giản, bạn có thể thay bằng Android ID, v.v.)
@@ -85,7 +122,9 @@ class MainActivity : ComponentActivity() {
         val deviceId: String,
         val name: String,
         val port: Int,
-        val subdir: String
+        val subdir: String,
+        val frameProtocol: Int = 1,  // phiên bản header frame TCP server đã đồng ý
+        val mux: Boolean = false     // port là cổng ingest chung -> cần handshake
     )
 
     private var myDeviceInfo: DeviceInfo? = null
@@ -184,6 +223,13 @@ class MainActivity : ComponentActivity() {
 
                 // 4. REGISTER – CỰC KỲ QUAN TRỌNG
                 sendUdpCommand(CMD_REGISTER, ::log)
+                // Heartbeat để server phát hiện máy mất kết nối
+                launch {
+                    while (udpSocket != null && !udpSocket!!.isClosed) {
+                        delay(HEARTBEAT_INTERVAL)
+                        sendUdpCommand(CMD_HEARTBEAT) { }
+                    }
+                }
                 // 5. Kết nối TCP tới port được gán
                 connectTcp(my.port, ::log)
 
@@ -231,8 +277,10 @@ class MainActivity : ComponentActivity() {
             imageAnalyzer.setAnalyzer(cameraExecutor) { image ->
                 if (isRecording) {
                     val now = System.currentTimeMillis()
-                    if (now - lastSentTime >= FRAME_DELAY) {
+                    if (now - lastSentTime >= frameDelay) {
                         lastSentTime = now
+                        // Thời điểm chụp theo đồng hồ monotonic của thiết bị (gửi trong header v2)
+                        val captureNs = SystemClock.elapsedRealtimeNanos()
                         // YUV_420_888 to JPEG using YuvImage (NV21)
                         val yBuffer = image.planes[0].buffer
                         val uBuffer = image.planes[1].buffer
@@ -257,11 +305,11 @@ class MainActivity : ComponentActivity() {
                         val baos = ByteArrayOutputStream()
                         yuvImage.compressToJpeg(
                             android.graphics.Rect(0, 0, image.width, image.height),
-                            50,
+                            jpegQuality,
                             baos
                         )
                         val jpeg = baos.toByteArray()
-                        sendTcpFrame(jpeg)
+                        sendTcpFrame(jpeg, captureNs)
                     }
                 }
                 image.close()
@@ -278,10 +326,22 @@ class MainActivity : ComponentActivity() {
     }
 
 
-    private fun sendTcpFrame(jpeg: ByteArray) {
+    private fun sendTcpFrame(jpeg: ByteArray, captureNs: Long) {
         try {
             val os = tcpSocket?.getOutputStream() ?: return
-            val header = ByteBuffer.allocate(4).putInt(jpeg.size).array()
+            val header = if ((myDeviceInfo?.frameProtocol ?: 1) >= 2) {
+                ByteBuffer.allocate(FRAME_HEADER_V2_SIZE)
+                    .put(FRAME_MAGIC)
+                    .put(FRAME_PROTOCOL_VERSION.toByte())
+                    .put(0.toByte())                          // flags
+                    .putShort(FRAME_HEADER_V2_SIZE.toShort())
+                    .putLong(frameSequence++)
+                    .putLong(captureNs)
+                    .putInt(jpeg.size)
+                    .array()
+            } else {
+                ByteBuffer.allocate(4).putInt(jpeg.size).array()
+            }
             os.write(header)
             os.write(jpeg)
             os.flush()
@@ -330,6 +390,12 @@ class MainActivity : ComponentActivity() {
                     put(DEVICE_ID, deviceId)
                     put(TOKEN, token)
                     put(NAME, camName) // tên cam / device
+                    put(FRAME_PROTOCOL, FRAME_PROTOCOL_VERSION) // header frame cao nhất hỗ trợ
+                    put(COMMAND_ACK, 1) // nhận lệnh dạng COMMAND và trả ACK
+                    put(RATE_CONTROL, 1) // nhận gợi ý RATE khi server quá tải
+                    put("maxFps", 1000.0 / FRAME_DELAY)
+                    put("jpegQuality", JPEG_QUALITY)
+                    put(INGEST_HANDSHAKE, 1) // dùng được cổng ingest chung nếu server bật
                 }
 
                 val data = jsonObject.toString().toByteArray()
@@ -367,8 +433,10 @@ class MainActivity : ComponentActivity() {
                     val name = o.optString(NAME)
                     val port = o.optInt("port")
                     val subdir = o.optString("subdir")
+                    val frameProtocol = o.optInt(FRAME_PROTOCOL, 1)
+                    val mux = o.optBoolean("mux")
                     if (dId.isNotEmpty() && port != 0) {
-                        list.add(DeviceInfo(dId, name, port, subdir))
+                        list.add(DeviceInfo(dId, name, port, subdir, frameProtocol, mux))
                     }
                 }
                 list
@@ -385,7 +453,11 @@ class MainActivity : ComponentActivity() {
     private fun connectTcp(port: Int, log: (String) -> Unit) {
         try {
             tcpSocket?.close()
-            tcpSocket = Socket(serverIp, port)
+            val socket = Socket(serverIp, port)
+            if (myDeviceInfo?.mux == true) {
+                sendIngestHandshake(socket)
+            }
+            tcpSocket = socket
             log("TCP Connected to $serverIp:$port")
             Log.i("MainActivity", "TCP Connected to $serverIp:$port")
             runOnUiThread {
@@ -408,6 +480,26 @@ class MainActivity : ComponentActivity() {
         }
     }
 
+    private fun sendIngestHandshake(socket: Socket) {
+        val body = JSONObject().apply {
+            put(DEVICE_ID, deviceId)
+            put(TOKEN, token)
+        }.toString().toByteArray()
+        val buffer = ByteBuffer.allocate(HANDSHAKE_MAGIC.size + 2 + body.size)
+        buffer.put(HANDSHAKE_MAGIC)
+        buffer.putShort(body.size.toShort())
+        buffer.put(body)
+        socket.soTimeout = 5000
+        socket.getOutputStream().write(buffer.array())
+        socket.getOutputStream().flush()
+        val status = socket.getInputStream().read()
+        socket.soTimeout = 0
+        if (status != HANDSHAKE_OK) {
+            socket.close()
+            throw IOException("ingest handshake bị từ chối (status=$status)")
+        }
+    }
+
     // ------------------ UDP ------------------
 
     private suspend fun startUdpListener(log: (String) -> Unit) {
@@ -428,30 +520,15 @@ class MainActivity : ComponentActivity() {
                 withContext(Dispatchers.IO) {
                     socket.receive(packet)
                 }
+                // t1 của CLOCK_PING: lấy ngay khi nhận gói
+                val recvNs = SystemClock.elapsedRealtimeNanos()
 
                 val msg = String(packet.data, 0, packet.length).trim()
-                log("UDP Receiver: $msg")
-
-                runOnUiThread {
-                    when (msg) {
-                        SYNC_START -> Toast.makeText(
-                            this,
-                            "Received START command",
-                            Toast.LENGTH_SHORT
-                        ).show()
-
-                        SYNC_STOP -> Toast.makeText(
-                            this,
-                            "Received STOP command",
-                            Toast.LENGTH_SHORT
-                        ).show()
-                    }
-                }
-                Log.i("MainActivity", "UDP Receiver: $msg")
-                when (msg) {
-                    SYNC_START -> startRecording(log)
-                    SYNC_STOP -> stopRecording(log)
+                if (msg.startsWith("{")) {
+                    handleControlJson(socket, packet, msg, recvNs, log)
+                    continue
                 }
+                handleCommand(msg, log)
             }
         } catch (e: Exception) {
             log("UDP Listen Error: ${e.message}")
@@ -459,6 +536,108 @@ class MainActivity : ComponentActivity() {
         }
     }
 
+    private fun handleCommand(msg: String, log: (String) -> Unit) {
+        log("UDP Receiver: $msg")
+
+        // "SYNC_START <ns>": bắt đầu đúng thời điểm elapsedRealtimeNanos do server hẹn
+        if (msg.startsWith("$SYNC_START ")) {
+            val startNs = msg.substringAfter(' ').toLongOrNull()
+            if (startNs != null) {
+                scheduleStart(startNs, log)
+                return
+            }
+        }
+
+        runOnUiThread {
+            when (msg) {
+                SYNC_START -> Toast.makeText(
+                    this,
+                    "Received START command",
+                    Toast.LENGTH_SHORT
+                ).show()
+
+                SYNC_STOP -> Toast.makeText(
+                    this,
+                    "Received STOP command",
+                    Toast.LENGTH_SHORT
+                ).show()
+            }
+        }
+        Log.i("MainActivity", "UDP Receiver: $msg")
+        when (msg) {
+            SYNC_START -> startRecording(log)
+            SYNC_STOP -> stopRecording(log)
+        }
+    }
+
+    private suspend fun handleControlJson(
+        socket: DatagramSocket,
+        packet: DatagramPacket,
+        msg: String,
+        recvNs: Long,
+        log: (String) -> Unit
+    ) {
+        val json = try {
+            JSONObject(msg)
+        } catch (e: Exception) {
+            return
+        }
+        if (json.optString(ACTION_TYPE) == COMMAND) {
+            val id = json.optLong("id")
+            val ack = JSONObject().apply {
+                put(ACTION_TYPE, ACK)
+                put(DEVICE_ID, deviceId)
+                put(TOKEN, token)
+                put("id", id)
+            }.toString().toByteArray()
+            withContext(Dispatchers.IO) {
+                socket.send(DatagramPacket(ack, ack.size, packet.address, packet.port))
+            }
+            // Server gửi lại khi mất ACK: chỉ thực hiện mỗi id 1 lần
+            if (id > lastCommandId) {
+                lastCommandId = id
+                handleCommand(json.optString("cmd"), log)
+            }
+            return
+        }
+        if (json.optString(ACTION_TYPE) == RATE) {
+            val fps = json.optDouble("fps", 0.0)
+            if (fps > 0) {
+                frameDelay = maxOf(FRAME_DELAY, (1000.0 / fps).toLong())
+                jpegQuality = json.optInt("quality", JPEG_QUALITY).coerceIn(10, JPEG_QUALITY)
+                log("RATE level ${json.optInt("level")}: ${"%.1f".format(fps)} fps, JPEG $jpegQuality")
+            }
+            return
+        }
+        if (json.optString(ACTION_TYPE) != CLOCK_PING) return
+        val reply = JSONObject().apply {
+            put(ACTION_TYPE, CLOCK_PONG)
+            put(DEVICE_ID, deviceId)
+            put(TOKEN, token)
+            put("id", json.optLong("id"))
+            put("t0", json.optLong("t0"))
+            put("t1", recvNs)
+            put("t2", SystemClock.elapsedRealtimeNanos())
+        }.toString().toByteArray()
+        withContext(Dispatchers.IO) {
+            socket.send(DatagramPacket(reply, reply.size, packet.address, packet.port))
+        }
+    }
+
+    private fun scheduleStart(startNs: Long, log: (String) -> Unit) {
+        coroutineScope.launch {
+            val waitMs = (startNs - SystemClock.elapsedRealtimeNanos()) / 1_000_000
+            log("SYNC_START hẹn sau $waitMs ms")
+            if (waitMs > 0) delay(waitMs)
+            // phần lẻ dưới 1 ms: chờ bận cho sát thời điểm hẹn
+            while (SystemClock.elapsedRealtimeNanos() < startNs) { }
+            runOnUiThread {
+                Toast.makeText(this@MainActivity, "Received START command", Toast.LENGTH_SHORT).show()
+            }
+            startRecording(log)
+        }
+    }
+
     private fun sendUdpCommand(cmd: String, log: (String) -> Unit) {
         //Stop capture if needed
         coroutineScope.launch {
@@ -471,6 +650,7 @@ class MainActivity : ComponentActivity() {
                     put(ACTION_TYPE, cmd)
                     put(DEVICE_ID, deviceId)
                     put(TOKEN, token)
+                    if (cmd == CMD_REGISTER) put(COMMAND_ACK, 1)
                 }
                 val data = jsonObject.toString().toByteArray()
                 val packet = DatagramPacket(
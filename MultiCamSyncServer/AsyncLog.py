@@ -0,0 +1,210 @@
+"""
+Log bất đồng bộ cho CamServer.
+
+Thread gọi log() (thread mạng, event loop...) chỉ kiểm tra mức log, giới hạn tần suất
+rồi đẩy 1 tuple nhỏ vào hàng đợi có giới hạn; 1 thread nền định dạng thời gian, ghi
+console và file. Hàng đợi đầy thì bản ghi mới bị bỏ (có đếm) thay vì chặn, nên console
+bị treo (vd chọn text trên cửa sổ cmd Windows) hay file log chậm không bao giờ làm
+chậm việc nhận frame.
+
+    logger = AsyncLogger(level=LOG_INFO, tag_levels={'TCP': LOG_WARNING}, file_path='logs/server.log')
+    logger.log('TCP', 'Kết nối MỚI ...')
+    logger.log('TCP', f'{cam} count={n}', LOG_DEBUG)
+
+Console giữ định dạng cũ "[HH:MM:SS][TAG] message" (thêm [WARNING]/[ERROR] với mức cao);
+file log có thể là text hoặc JSON lines ({"ts", "level", "tag", "msg"}), xoay vòng theo kích thước.
+"""
+import atexit
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = 10, 20, 30, 40
+LEVELS = {'DEBUG': LOG_DEBUG, 'INFO': LOG_INFO, 'WARNING': LOG_WARNING, 'ERROR': LOG_ERROR}
+LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+
+
+def parse_level(text, default=LOG_INFO):
+    return LEVELS.get(str(text).strip().upper(), default)
+
+
+def parse_tag_levels(text):
+    """'TCP=WARNING,UDP=DEBUG' -> {'TCP': 30, 'UDP': 10}"""
+    result = {}
+    for item in (text or '').split(','):
+        tag, sep, level = item.partition('=')
+        if sep and tag.strip():
+            result[tag.strip().upper()] = parse_level(level)
+    return result
+
+
+class RotatingFile:
+    """File log xoay vòng: path -> path.1 -> ... -> path.<backups>."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self.size = self._file.tell()
+
+    def write(self, text):
+        if self.max_bytes > 0 and self.size > 0 and self.size + len(text) > self.max_bytes:
+            self.rotate()
+        self._file.write(text)
+        self.size += len(text)
+
+    def rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class AsyncLogger:
+    """
+    level / tag_levels: mức tối thiểu chung và theo tag.
+    rate_limit: số dòng tối đa cùng (tag, nội dung) trong mỗi rate_window giây (0 = không giới hạn);
+    số dòng bị nén được báo lại ở dòng kế tiếp của cùng nội dung.
+    queue_size: số bản ghi tối đa chờ ghi; vượt thì bỏ bản ghi mới.
+    """
+
+    def __init__(self, level=LOG_INFO, tag_levels=None, console=True, file_path=None,
+                 file_max_bytes=10 * 1024 * 1024, file_backups=5, json_lines=False,
+                 rate_limit=20, rate_window=10.0, queue_size=10000, stream=None):
+        self.level = level
+        self.tag_levels = dict(tag_levels or {})
+        self._min_level = min([level] + list(self.tag_levels.values()))
+        self.console = console
+        self.stream = stream
+        self.json_lines = json_lines
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.queue_size = queue_size
+        self.file = RotatingFile(file_path, file_max_bytes, file_backups) if file_path else None
+
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._rate = {}           # (tag, message) -> [window_start, count, suppressed]
+        self._rate_lock = threading.Lock()
+        self.dropped = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="async-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---------- Phía thread gọi ----------
+
+    def enabled(self, tag, level):
+        """Kiểm tra rẻ trước khi dựng chuỗi log tốn kém (f-string trên đường nóng)."""
+        if level < self._min_level:
+            return False
+        return level >= self.tag_levels.get(tag, self.level)
+
+    def log(self, tag, message, level=LOG_INFO):
+        if level < self._min_level or level < self.tag_levels.get(tag, self.level):
+            return
+        suppressed = 0
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            key = (tag, message)
+            with self._rate_lock:
+                state = self._rate.get(key)
+                if state is None or now - state[0] >= self.rate_window:
+                    suppressed = state[2] if state is not None else 0
+                    if len(self._rate) > 4096:
+                        self._rate.clear()
+                    self._rate[key] = [now, 1, 0]
+                elif state[1] >= self.rate_limit:
+                    state[2] += 1
+                    return
+                else:
+                    state[1] += 1
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self._queue.append((time.time(), level, tag, message, suppressed))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    # ---------- Thread nền ----------
+
+    def _format_text(self, record):
+        ts, level, tag, message, suppressed = record
+        stamp = datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+        prefix = f"[{stamp}][{tag}]" if level < LOG_WARNING else f"[{stamp}][{tag}][{LEVEL_NAMES.get(level, level)}]"
+        line = f"{prefix} {message}"
+        if suppressed:
+            line += f" (đã bỏ {suppressed} dòng giống hệt)"
+        return line + "\n"
+
+    def _format_json(self, record):
+        ts, level, tag, message, suppressed = record
+        obj = {"ts": round(ts, 6), "level": LEVEL_NAMES.get(level, level), "tag": tag, "msg": message}
+        if suppressed:
+            obj["suppressed"] = suppressed
+        return json.dumps(obj, ensure_ascii=False) + "\n"
+
+    def _drain(self):
+        records = []
+        while self._queue and len(records) < 1000:
+            records.append(self._queue.popleft())
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append((time.time(), LOG_WARNING, "LOG", f"Hàng đợi log đầy, đã bỏ {dropped} dòng.", 0))
+        if not records:
+            return False
+        text = ''.join(self._format_text(r) for r in records)
+        if self.console:
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(text)
+                stream.flush()
+            except Exception:
+                pass
+        if self.file is not None:
+            try:
+                self.file.write(text if not self.json_lines else ''.join(self._format_json(r) for r in records))
+                self.file.flush()
+            except Exception:
+                pass
+        return True
+
+    def _run(self):
+        while self._running or self._queue:
+            if not self._drain():
+                self._wakeup.wait(0.5)
+                self._wakeup.clear()
+
+    def close(self, timeout=2.0):
+        """Ghi nốt hàng đợi rồi dừng thread nền (gọi được nhiều lần)."""
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(timeout)
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception:
+                pass
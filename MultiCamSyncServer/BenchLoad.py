@@ -0,0 +1,614 @@
+"""
+Benchmark tải cho CamServer: giả lập N camera (CONNECT/REGISTER qua UDP rồi gửi frame
+kích thước thật theo FPS cấu hình qua cổng TCP được cấp) và đo:
+    - thông lượng thực tế (frame/s, MB/s) phía gửi và phía server đã ghi
+    - độ trễ từng frame: từ lúc gửi (capture time header v2) tới khi frame xuất hiện
+      trong index frames.idx trên đĩa (p50/p90/p99/max); với --protocol 1 là từ lúc
+      server nhận đủ frame
+    - frame thiếu (đã gửi nhưng không được ghi), frame gửi dở (kết nối đứt giữa frame)
+    - CPU và RSS của process server, cộng cả process con (process ingest, pool ảnh thu nhỏ;
+      psutil nếu có, không thì /proc trên Linux)
+Kết quả ghi ra JSON để so sánh storage / ingest mode giữa các phiên bản.
+
+Mặc định tự khởi động 1 CamServer cục bộ (HEADLESS=1, thư mục dữ liệu tạm):
+    python BenchLoad.py --cameras 8 --fps 30 --frame-size 200000 --duration 20 --out bench.json
+    python BenchLoad.py --env STORAGE_FORMAT=segment --env INGEST_MODE=asyncio --label seg-async
+    python BenchLoad.py --ingest-port 16000 --label shared-port   # mọi camera qua 1 cổng + handshake
+
+Chạy với server có sẵn (cần --data-dir để đo độ trễ / frame đã ghi):
+    python BenchLoad.py --no-spawn --server 127.0.0.1 --control-port 5000 --data-dir data
+
+Độ trễ chỉ chính xác khi server chạy cùng máy (đồng hồ chung). Camera giả lập trả lời
+CLOCK_PING bằng time.time_ns() nên timestamp frame trùng đồng hồ server.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from FrameIndex import INDEX_FILE, INDEX_HEADER, INDEX_RECORD
+from Session import MANIFEST_FILE, list_sessions
+from FrameReceiver import (
+    FRAME_HEADER, FRAME_HEADER_V2, FRAME_HEADER_V2_SIZE, FRAME_MAGIC, FRAME_PROTOCOL_VERSION, HANDSHAKE_OK,
+    pack_handshake,
+)
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CamServer.py')
+
+
+# ---------- Camera giả lập ----------
+
+def make_payload(size):
+    """Payload giống JPEG (SOI ... EOI) kích thước cố định."""
+    size = max(16, size)
+    return b'\xff\xd8' + os.urandom(size - 4) + b'\xff\xd9'
+
+
+class SimCamera:
+    def __init__(self, index, args, fps=None):
+        self.index = index
+        self.args = args
+        self.device_id = f"bench_{index:03d}"
+        self.name = f"Bench_{index:03d}"
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.port = None
+        self.subdir = None
+        self.mux = False
+        # FPS gốc khai báo khi CONNECT (maxFps) và FPS hiện tại (giảm theo RATE)
+        self.max_fps = self.fps = fps if fps is not None else args.fps
+        self.rate_levels = []   # (thời điểm, nấc, fps) nhận từ RATE
+        self.freeze_alerts = 0  # số cảnh báo FREEZE (đứng hình) server gửi về camera này
+        self.sent = 0
+        self.sent_bytes = 0
+        self.short = 0
+        self.late = 0
+        self.errors = 0
+        self.running = True
+
+    def _send_json(self, msg):
+        msg.update({"deviceId": self.device_id, "token": self.args.token})
+        self.udp.sendto(json.dumps(msg).encode('utf-8'), (self.args.server, self.args.control_port))
+
+    def connect(self, timeout=5.0):
+        self.udp.settimeout(1.0)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self._send_json({"type": "CONNECT", "name": self.name, "frameProtocol": self.args.protocol,
+                             "commandAck": 1, "ingestHandshake": 1 if self.args.ingest_port else 0,
+                             "rateControl": 1 if self.args.rate_control else 0, "maxFps": self.max_fps,
+                             "jpegQuality": 80})
+            try:
+                data, _ = self.udp.recvfrom(65536)
+            except socket.timeout:
+                continue
+            try:
+                devices = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            mine = next((d for d in devices if d.get('deviceId') == self.device_id), None)
+            if mine is not None:
+                self.port = mine['port']
+                self.subdir = mine['subdir']
+                self.mux = bool(mine.get('mux'))
+                self.protocol = min(self.args.protocol, int(mine.get('frameProtocol', 1)))
+                self._send_json({"type": "REGISTER", "commandAck": 1})
+                threading.Thread(target=self._control_loop, daemon=True).start()
+                return True
+        return False
+
+    def send_command(self, msg_type):
+        self._send_json({"type": msg_type})
+
+    def _control_loop(self):
+        """Trả lời CLOCK_PING / COMMAND và áp dụng RATE như app Android."""
+        self.udp.settimeout(0.5)
+        while self.running:
+            try:
+                data, addr = self.udp.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            t1 = time.time_ns()
+            if not data.startswith(b'{'):
+                continue
+            try:
+                msg = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            reply = None
+            if msg.get('type') == 'CLOCK_PING':
+                reply = {"type": "CLOCK_PONG", "id": msg.get('id'), "t0": msg.get('t0'), "t1": t1}
+            elif msg.get('type') == 'COMMAND':
+                reply = {"type": "ACK", "id": msg.get('id')}
+            elif msg.get('type') == 'RATE' and self.args.rate_control:
+                try:
+                    fps = float(msg['fps'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if fps > 0 and fps != self.fps:
+                    self.fps = min(fps, self.max_fps)
+                    self.rate_levels.append((time.time_ns(), msg.get("level"), self.fps))
+            elif msg.get('type') == 'FREEZE' and msg.get('frozen') and msg.get('deviceId') == self.device_id:
+                self.freeze_alerts += 1
+            if reply is not None:
+                reply.update({"deviceId": self.device_id, "token": self.args.token})
+                if 't1' in reply:
+                    reply['t2'] = time.time_ns()
+                try:
+                    self.udp.sendto(json.dumps(reply).encode('utf-8'), addr)
+                except OSError:
+                    pass
+
+    def open_stream(self):
+        """Kết nối TCP tới cổng được cấp (cổng chung: gửi handshake trước). OSError nếu thất bại."""
+        sock = socket.create_connection((self.args.server, self.port), timeout=5.0)
+        if self.mux:
+            sock.sendall(pack_handshake(self.device_id, self.args.token))
+            status = sock.recv(1)
+            if status != bytes((HANDSHAKE_OK,)):
+                sock.close()
+                raise OSError(f"handshake bị từ chối: {status!r}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def frame_header(self, sequence, length):
+        """Header frame theo protocol đã thoả thuận (v2: sequence + capture time = lúc gửi)."""
+        if self.protocol >= FRAME_PROTOCOL_VERSION:
+            return FRAME_MAGIC + FRAME_HEADER_V2.pack(
+                FRAME_PROTOCOL_VERSION, 0, FRAME_HEADER_V2_SIZE, sequence, time.time_ns(), length)
+        return FRAME_HEADER.pack(length)
+
+    def stream(self, start_at, stop_at):
+        args = self.args
+        # mỗi frame khác nhau (sequence ghi sau SOI) để server không coi là camera đứng hình / dedup
+        payload = bytearray(make_payload(args.frame_size))
+        try:
+            sock = self.open_stream()
+        except OSError:
+            self.errors += 1
+            return
+        next_at = start_at
+        seq = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= stop_at:
+                    break
+                interval = 1.0 / self.fps
+                if next_at > now:
+                    time.sleep(next_at - now)
+                elif now - next_at > interval:
+                    # không theo kịp FPS: bỏ lịch cũ thay vì dồn frame
+                    self.late += 1
+                    next_at = now
+                next_at += interval
+                struct.pack_into('>Q', payload, 2, seq)
+                header = self.frame_header(seq, len(payload))
+                try:
+                    sock.sendall(header + payload)
+                except OSError:
+                    self.short += 1
+                    break
+                seq += 1
+                self.sent += 1
+                self.sent_bytes += len(payload)
+        finally:
+            sock.close()
+
+    def close(self):
+        self.running = False
+        self.udp.close()
+
+
+# ---------- Theo dõi index trên đĩa ----------
+
+def new_session_dir(data_dir, known):
+    """Thư mục phiên mới nhất chưa có trong known (phiên do lần chạy này mở), None nếu chưa có."""
+    fresh = [path for path in list_sessions(data_dir) if path not in known]
+    return fresh[-1] if fresh else None
+
+
+class IndexTail:
+    """
+    Đọc nối tiếp frames.idx của 1 camera, ghi lại độ trễ timestamp -> lúc thấy bản ghi.
+    Frame nằm trong DATA_DIR/<session>/<subdir>: thư mục phiên được tìm khi poll
+    (phiên chỉ được tạo sau START).
+    """
+
+    def __init__(self, data_dir, subdir, known_sessions=()):
+        self.data_dir = data_dir
+        self.subdir = subdir
+        self.known_sessions = set(known_sessions)
+        self.session_dir = None
+        self.path = None
+        self.offset = INDEX_HEADER.size
+        self.count = 0
+        self.latencies_ns = []
+        self._pending = b''
+
+    def poll(self, window=None):
+        if self.path is None:
+            self.session_dir = new_session_dir(self.data_dir, self.known_sessions)
+            if self.session_dir is None:
+                return
+            self.path = os.path.join(self.session_dir, self.subdir, INDEX_FILE)
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if not data:
+            return
+        now = time.time_ns()
+        self.offset += len(data)
+        data = self._pending + data
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        self._pending = data[usable:]
+        for (ts, _seq, _fid, _off, _len) in INDEX_RECORD.iter_unpack(data[:usable]):
+            self.count += 1
+            if window is None or window[0] <= ts <= window[1]:
+                self.latencies_ns.append(now - ts)
+
+
+def wait_manifest(session_dir, timeout):
+    """Chờ server đóng phiên (manifest status "closed"), trả về manifest (None nếu hết thời gian)."""
+    path = os.path.join(session_dir, MANIFEST_FILE)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("status") == "closed":
+                return manifest
+        except (OSError, ValueError):
+            pass
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.1)
+
+
+# ---------- Đo CPU / RSS process server ----------
+
+class ProcessSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_samples = []
+        self.rss_max = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _pids(self):
+        """Process server và mọi process con của nó."""
+        if psutil is not None:
+            return [self.pid] + [c.pid for c in psutil.Process(self.pid).children(recursive=True)]
+        pids, i = [self.pid], 0
+        while i < len(pids):
+            try:
+                for task in os.listdir(f'/proc/{pids[i]}/task'):
+                    with open(f'/proc/{pids[i]}/task/{task}/children') as f:
+                        pids.extend(int(c) for c in f.read().split())
+            except OSError:
+                pass
+            i += 1
+        return pids
+
+    @staticmethod
+    def _cpu_rss(pid):
+        if psutil is not None:
+            p = psutil.Process(pid)
+            t = p.cpu_times()
+            return t.user + t.system, p.memory_info().rss
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        return cpu, rss
+
+    def _sample(self):
+        """{pid: (giây CPU, RSS)} của server và process con còn sống."""
+        out = {}
+        for pid in self._pids():
+            try:
+                out[pid] = self._cpu_rss(pid)
+            except Exception:
+                if pid == self.pid:
+                    raise
+        return out
+
+    def available(self):
+        try:
+            self._sample()
+            return True
+        except Exception:
+            return False
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        last = self._sample()
+        last_t = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                sample = self._sample()
+            except Exception:
+                return
+            now = time.monotonic()
+            # process con mới xuất hiện: tính toàn bộ CPU của nó vào khoảng này
+            cpu = sum(c - last.get(pid, (0.0, 0))[0] for pid, (c, _) in sample.items())
+            self.cpu_samples.append(100.0 * cpu / (now - last_t))
+            self.rss_max = max(self.rss_max, sum(rss for _, rss in sample.values()))
+            last, last_t = sample, now
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if not self.cpu_samples:
+            return {"cpu_percent_avg": None, "cpu_percent_max": None, "rss_mb_max": None}
+        return {
+            "cpu_percent_avg": sum(self.cpu_samples) / len(self.cpu_samples),
+            "cpu_percent_max": max(self.cpu_samples),
+            "rss_mb_max": self.rss_max / (1024 * 1024),
+        }
+
+
+def percentiles_ms(values_ns):
+    if not values_ns:
+        return None
+    values = sorted(values_ns)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] / 1e6
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) / 1e6,
+        "p50": pct(50),
+        "p90": pct(90),
+        "p99": pct(99),
+        "max": values[-1] / 1e6,
+    }
+
+
+# ---------- Server cục bộ ----------
+
+def spawn_server(args, data_dir, log_path):
+    env = dict(os.environ)
+    env.update({
+        "HEADLESS": "1",
+        "DATA_DIR": data_dir,
+        "CONTROL_PORT": str(args.control_port),
+        "BASE_CAM_PORT": str(args.base_cam_port),
+        "INGEST_PORT": str(args.ingest_port),
+        "AUTH_TOKEN": args.token,
+        "MAX_FRAMES": "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    log_file = open(log_path, 'wb')
+    proc = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env, cwd=os.path.dirname(SERVER_SCRIPT),
+                            stdout=log_file, stderr=subprocess.STDOUT)
+    return proc, log_file
+
+
+def stop_server(proc, timeout=10.0):
+    if proc.poll() is not None:
+        return
+    # SIGINT để server ghi nốt hàng đợi (KeyboardInterrupt), hết thời gian thì kill
+    if os.name == 'posix':
+        proc.send_signal(signal.SIGINT)
+    else:
+        proc.terminate()
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run(args):
+    spawned = None
+    log_file = None
+    temp_dir = None
+    data_dir = args.data_dir
+    if not args.no_spawn:
+        temp_dir = tempfile.mkdtemp(prefix='camserver_bench_')
+        data_dir = data_dir or os.path.join(temp_dir, 'data')
+        spawned, log_file = spawn_server(args, data_dir, os.path.join(temp_dir, 'server.log'))
+        print(f"Đã khởi động CamServer (pid {spawned.pid}), dữ liệu: {data_dir}")
+
+    cameras = [SimCamera(i, args) for i in range(args.cameras)]
+    try:
+        for cam in cameras:
+            if not cam.connect(timeout=args.connect_timeout):
+                raise RuntimeError(f"{cam.device_id}: không nhận được phản hồi CONNECT từ server")
+        print(f"{len(cameras)} camera đã CONNECT, chờ {args.warmup}s (mở cổng TCP, đo đồng hồ)...")
+        time.sleep(args.warmup)
+
+        tails = {}
+        known = []
+        if data_dir:
+            known = list_sessions(data_dir)
+            tails = {cam.device_id: IndexTail(data_dir, cam.subdir, known) for cam in cameras}
+        # START như app: server mở phiên ghi mới (DATA_DIR/<session>/) và phát SYNC_START
+        cameras[0].send_command("START")
+
+        sampler = None
+        pid = args.server_pid or (spawned.pid if spawned is not None else None)
+        if pid is not None:
+            sampler = ProcessSampler(pid)
+            if sampler.available():
+                sampler.start()
+            else:
+                sampler = None
+
+        start_wall = time.time_ns()
+        start_at = time.monotonic() + 0.2
+        stop_at = start_at + args.duration
+        threads = [threading.Thread(target=cam.stream, args=(start_at, stop_at), daemon=True) for cam in cameras]
+        for t in threads:
+            t.start()
+
+        # Theo dõi index trong lúc gửi + thời gian xả hàng đợi
+        drain_deadline = None
+        window = (start_wall, time.time_ns() + int((args.duration + 60) * 1e9))
+        while True:
+            for tail in tails.values():
+                tail.poll(window)
+            if drain_deadline is None and not any(t.is_alive() for t in threads):
+                drain_deadline = time.monotonic() + args.drain
+            if drain_deadline is not None:
+                sent = sum(c.sent for c in cameras)
+                stored = sum(t.count for t in tails.values())
+                if stored >= sent or time.monotonic() >= drain_deadline:
+                    break
+            time.sleep(args.poll_interval)
+        elapsed = (time.time_ns() - start_wall) / 1e9
+        server_stats = sampler.stop() if sampler is not None else None
+        cameras[0].send_command("STOP")
+        session_dir = next((t.session_dir for t in tails.values() if t.session_dir), None)
+        manifest = wait_manifest(session_dir, args.drain) if session_dir else None
+        # chỉ START mở phiên: camera gửi tiếp sau MAX_FRAMES / SYNC_STOP không được mở thêm phiên
+        opened = len([path for path in list_sessions(data_dir) if path not in known]) if data_dir else None
+    finally:
+        for cam in cameras:
+            cam.close()
+        if spawned is not None:
+            stop_server(spawned)
+            log_file.close()
+
+    sent = sum(c.sent for c in cameras)
+    sent_bytes = sum(c.sent_bytes for c in cameras)
+    stored = sum(t.count for t in tails.values()) if tails else None
+    latencies = [lat for t in tails.values() for lat in t.latencies_ns]
+    result = {
+        "label": args.label,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "host": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count()},
+        "config": {
+            "cameras": args.cameras, "fps": args.fps, "frame_size": args.frame_size,
+            "duration_s": args.duration, "protocol": args.protocol,
+            "ingest_port": args.ingest_port, "rate_control": args.rate_control,
+            "server_env": dict(item.partition('=')[::2] for item in args.env),
+            "spawned": spawned is not None,
+        },
+        "elapsed_s": elapsed,
+        "sent_frames": sent,
+        "sent_bytes": sent_bytes,
+        "send_fps": sent / args.duration,
+        "send_mbps": sent_bytes / args.duration / (1024 * 1024),
+        "late_frames": sum(c.late for c in cameras),
+        "short_frames": sum(c.short for c in cameras),
+        "connect_errors": sum(c.errors for c in cameras),
+        "stored_frames": stored,
+        "missing_frames": (sent - stored) if stored is not None else None,
+        "stored_fps": stored / args.duration if stored is not None else None,
+        "latency_ms": percentiles_ms(latencies),
+        "server": server_stats,
+        "session": os.path.basename(session_dir) if session_dir else None,
+        "sessions_opened": opened,
+        "manifest_totals": manifest.get("totals") if manifest else None,
+        "per_camera": {
+            c.device_id: {
+                "sent": c.sent,
+                "stored": tails[c.device_id].count if tails else None,
+                "late": c.late,
+                "short": c.short,
+                "latency_ms": percentiles_ms(tails[c.device_id].latencies_ns) if tails else None,
+                "final_fps": c.fps,
+                "rate_changes": [{"t": round((t - start_wall) / 1e9, 3), "level": lv, "fps": fps}
+                                 for t, lv, fps in c.rate_levels],
+                "freeze_alerts": c.freeze_alerts,
+            } for c in cameras
+        },
+    }
+    if temp_dir is not None and not args.keep_data:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    elif temp_dir is not None:
+        result["data_dir"] = data_dir
+    return result
+
+
+def print_summary(result):
+    print(f"Đã gửi: {result['sent_frames']} frame ({result['send_fps']:.1f} fps, {result['send_mbps']:.1f} MB/s)"
+          f" | trễ lịch: {result['late_frames']} | gửi dở: {result['short_frames']}")
+    if result['stored_frames'] is not None:
+        print(f"Server đã ghi: {result['stored_frames']} frame ({result['stored_fps']:.1f} fps)"
+              f" | thiếu: {result['missing_frames']}")
+    if result.get('session'):
+        totals = result['manifest_totals'] or {}
+        print(f"Phiên: {result['session']} | manifest: {totals.get('frames', '?')} frame, "
+              f"bỏ {totals.get('dropped', '?')}")
+    if result.get('sessions_opened') is not None and result['sessions_opened'] > 1:
+        print(f"CẢNH BÁO: server đã mở {result['sessions_opened']} phiên cho 1 lần START.")
+    lat = result['latency_ms']
+    if lat:
+        print(f"Độ trễ gửi -> index (ms): p50 {lat['p50']:.2f} | p90 {lat['p90']:.2f} | p99 {lat['p99']:.2f}"
+              f" | max {lat['max']:.2f}")
+    srv = result['server']
+    if srv and srv['cpu_percent_avg'] is not None:
+        print(f"Server: CPU tb {srv['cpu_percent_avg']:.0f}% (max {srv['cpu_percent_max']:.0f}%)"
+              f" | RSS max {srv['rss_mb_max']:.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cameras', type=int, default=4, help="số camera giả lập")
+    parser.add_argument('--fps', type=float, default=15.0)
+    parser.add_argument('--frame-size', type=int, default=150_000, help="kích thước 1 frame (bytes)")
+    parser.add_argument('--duration', type=float, default=10.0, help="thời gian gửi (giây)")
+    parser.add_argument('--protocol', type=int, default=FRAME_PROTOCOL_VERSION, choices=(1, 2),
+                        help="header frame TCP (2 = có capture time, cần để đo độ trễ đầu-cuối)")
+    parser.add_argument('--server', default='127.0.0.1')
+    parser.add_argument('--control-port', type=int, default=15000)
+    parser.add_argument('--base-cam-port', type=int, default=16001, help="BASE_CAM_PORT của server tự khởi động")
+    parser.add_argument('--ingest-port', type=int, default=0,
+                        help="INGEST_PORT của server tự khởi động: camera dùng cổng chung + handshake (0 = cổng riêng)")
+    parser.add_argument('--rate-control', action='store_true',
+                        help="camera khai báo rateControl và giảm FPS theo gợi ý RATE của server")
+    parser.add_argument('--token', default='123456')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="biến môi trường thêm cho server tự khởi động (lặp lại được)")
+    parser.add_argument('--no-spawn', action='store_true', help="dùng server đang chạy thay vì tự khởi động")
+    parser.add_argument('--server-pid', type=int, help="pid server có sẵn để đo CPU/RSS")
+    parser.add_argument('--data-dir', help="DATA_DIR của server (bắt buộc để đo độ trễ khi --no-spawn)")
+    parser.add_argument('--keep-data', action='store_true', help="giữ lại thư mục dữ liệu tạm")
+    parser.add_argument('--warmup', type=float, default=2.0, help="thời gian chờ sau CONNECT (giây)")
+    parser.add_argument('--drain', type=float, default=10.0, help="thời gian tối đa chờ server ghi nốt (giây)")
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--poll-interval', type=float, default=0.002, help="chu kỳ đọc index (giây)")
+    parser.add_argument('--label', default='', help="nhãn lưu trong kết quả")
+    parser.add_argument('--out', help="file JSON kết quả (mặc định: bench_<thời gian>.json)")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    print_summary(result)
+    out = args.out or f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi kết quả: {out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Microbenchmark đường nhận frame TCP: so sánh MB/s giữa cách cũ (data += packet)
+và FrameReceiver (recv_into vào buffer cấp phát sẵn).
+
+Chạy:
+    python BenchRecv.py [--frames 300] [--size 2000000] [--chunk 65536]
+"""
+import argparse
+import socket
+import struct
+import threading
+import time
+
+from FrameReceiver import FrameReceiver
+
+
+def recv_frame_legacy(conn):
+    """Đường nhận cũ của handle_tcp_client (giữ lại để so sánh)."""
+    length_data = conn.recv(4)
+    if not length_data:
+        return None
+    frame_length = struct.unpack('>I', length_data)[0]
+    data = b""
+    while len(data) < frame_length:
+        packet = conn.recv(frame_length - len(data))
+        if not packet:
+            break
+        data += packet
+    return data
+
+
+def sender(sock, frames, size, chunk):
+    payload = bytes(size)
+    header = struct.pack('>I', size)
+    view = memoryview(payload)
+    try:
+        for _ in range(frames):
+            sock.sendall(header)
+            # Gửi theo từng mảnh nhỏ giống ảnh thật đi qua Wi-Fi
+            for i in range(0, size, chunk):
+                sock.sendall(view[i:i + chunk])
+    finally:
+        sock.shutdown(socket.SHUT_WR)
+
+
+def run(name, recv_fn, frames, size, chunk):
+    a, b = socket.socketpair()
+    t = threading.Thread(target=sender, args=(a, frames, size, chunk), daemon=True)
+    start = time.perf_counter()
+    t.start()
+    received = 0
+    count = 0
+    while True:
+        frame = recv_fn(b)
+        if frame is None:
+            break
+        received += len(frame)
+        count += 1
+    elapsed = time.perf_counter() - start
+    t.join()
+    a.close()
+    b.close()
+    mb_s = received / elapsed / (1024 * 1024)
+    print(f"{name:<16} {count} frames, {received / (1024 * 1024):.1f} MB trong {elapsed:.3f}s -> {mb_s:.1f} MB/s")
+    return mb_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--size', type=int, default=2_000_000, help="kích thước 1 frame (bytes)")
+    parser.add_argument('--chunk', type=int, default=64 * 1024, help="kích thước mỗi lần sendall phía gửi")
+    args = parser.parse_args()
+
+    legacy = run("legacy (+=)", recv_frame_legacy, args.frames, args.size, args.chunk)
+
+    receivers = {}
+
+    def recv_zero_copy(conn):
+        receiver = receivers.get(conn)
+        if receiver is None:
+            receiver = receivers[conn] = FrameReceiver(conn, max_frame_size=0)
+        return receiver.recv_frame()
+
+    zero_copy = run("recv_into", recv_zero_copy, args.frames, args.size, args.chunk)
+    print(f"Tăng tốc: x{zero_copy / legacy:.2f}")
+
+
+if __name__ == "__main__":
+    main()
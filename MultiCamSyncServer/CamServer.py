@@ -1,12 +1,39 @@
+import asyncio
 import socket
 import threading
 import os
-import datetime
-import base64
 import struct
 import json
+import queue
+import shutil
+import signal
 import time
 
+from FrameReceiver import (
+    BufferPool, CaptureTimeline, FrameHeader, FrameReceiver, FrameTooLargeError, IncompleteFrameError,
+    HANDSHAKE_BAD_TOKEN, HANDSHAKE_HEADER, HANDSHAKE_MALFORMED, HANDSHAKE_OK, HANDSHAKE_STOPPED,
+    HANDSHAKE_UNKNOWN_DEVICE, parse_handshake_body, parse_handshake_header, read_handshake,
+    FRAME_HEADER_V2, FRAME_MAGIC, FRAME_PROTOCOL_VERSION, parse_header_v2,
+)
+from FrameWriter import Frame, FrameWriter, JpegFileStorage, OVERFLOW_BLOCK
+from FrameCheck import FrameValidator, Quarantine, check_jpeg, is_base64
+from FreezeDetect import FreezeDetector, MATCH_IDENTICAL, PERCEPTUAL_AVAILABLE
+from SegmentStore import SegmentStorage
+from FrameIndex import FrameIndexer
+from FrameAlign import StreamingAligner
+from IngestWorkers import Channel, WorkerPool, WriterStatsView, run_worker
+from ClockSync import ClockSyncService
+from DeviceStore import DeviceJournal
+from CommandDispatch import CommandDispatcher, DELIVERY_FAILED, DELIVERY_LOST
+from Metrics import MetricsRegistry, MetricsServer, SamplingProfiler
+from Preview import LatestFrameCache, PreviewServer
+from Retention import RetentionService, PACK_FORMATS, format_bytes, format_report
+from RateControl import RateController, parse_levels
+from Session import SessionManager, SessionMirror
+from Thumbnails import ThumbnailStage, AVAILABLE as THUMBNAILS_AVAILABLE
+from VideoMux import MuxingStorage
+from AsyncLog import AsyncLogger, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR, parse_level, parse_tag_levels
+
 # Load .env file (optional) into environment if python-dotenv is available
 try:
     from dotenv import load_dotenv
@@ -21,17 +48,208 @@ AUTH_TOKEN = os.getenv('AUTH_TOKEN', '123456')
 
 DATA_DIR = os.getenv('DATA_DIR', 'data')
 
-# Số frame tối đa (0 = không giới hạn)
+# Chạy không mở UI Tkinter (server không màn hình / BenchLoad.py)
+HEADLESS = os.getenv('HEADLESS', '0').strip() == '1'
+
+# --- Log (ghi nền, không chặn thread mạng) ---
+# Mức log: DEBUG | INFO | WARNING | ERROR (log từng frame chỉ in ở DEBUG)
+LOG_LEVEL = parse_level(os.getenv('LOG_LEVEL', 'INFO'))
+# Mức riêng theo tag, vd 'TCP=WARNING,UDP=DEBUG'
+LOG_TAG_LEVELS = parse_tag_levels(os.getenv('LOG_TAG_LEVELS', ''))
+# File log xoay vòng (rỗng = chỉ console)
+LOG_FILE = os.getenv('LOG_FILE', '').strip()
+LOG_FILE_MAX_MB = int(os.getenv('LOG_FILE_MAX_MB', '10'))
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS', '5'))
+# File log dạng JSON lines
+LOG_JSON = os.getenv('LOG_JSON', '0').strip() == '1'
+# Tối đa N dòng giống hệt nhau mỗi LOG_RATE_WINDOW giây (0 = không giới hạn)
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '20'))
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', '10'))
+
+# --- Metrics (Prometheus) ---
+# Cổng HTTP /metrics (0 = tắt), mặc định chỉ nghe trên localhost
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Bật /debug/profile (profiler lấy mẫu stack các thread)
+PROFILER = os.getenv('PROFILER', '0').strip() == '1'
+
+# --- Xem trước live (HTTP MJPEG từ frame mới nhất trong RAM) ---
+# Cổng HTTP preview (0 = tắt), mặc định chỉ nghe trên localhost
+PREVIEW_PORT = int(os.getenv('PREVIEW_PORT', '8090'))
+PREVIEW_HOST = os.getenv('PREVIEW_HOST', '127.0.0.1')
+# FPS tối đa gửi cho mỗi người xem (0 = theo tốc độ camera)
+PREVIEW_MAX_FPS = float(os.getenv('PREVIEW_MAX_FPS', '15'))
+
+# Chế độ nhận frame TCP:
+#   'thread'  = 1 thread lắng nghe / port + 1 thread / kết nối (mặc định)
+#   'asyncio' = 1 event loop duy nhất phục vụ mọi port camera
+INGEST_MODE = os.getenv('INGEST_MODE', 'thread').strip().lower()
+# Số process ingest (nhận TCP + ghi storage, camera chia đều giữa các process); 0 = nhận ngay trong process chính
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '0'))
+# Chu kỳ (giây) process ingest gửi metrics / trạng thái camera về process chính
+INGEST_REPORT_INTERVAL = 1.0
+
+# Số frame tối đa mỗi camera trong 1 phiên ghi (0 = không giới hạn)
 MAX_FRAMES = int(os.getenv('MAX_FRAMES', '50'))
 
+# --- Phiên ghi (take): mỗi SYNC_START ghi vào DATA_DIR/<session>/<camera>/ + manifest.json ---
+# Số giây phiên còn nhận frame sau SYNC_STOP (frame đang trên đường truyền) trước khi đóng
+SESSION_CLOSE_GRACE = float(os.getenv('SESSION_CLOSE_GRACE', '2'))
+# Thời gian tối đa chờ writer ghi xong frame của phiên khi đóng (giây)
+SESSION_DRAIN_TIMEOUT = float(os.getenv('SESSION_DRAIN_TIMEOUT', '10'))
+
+# Kích thước tối đa 1 frame (bytes, 0 = không giới hạn) - chặn header hỏng bắt server cấp phát hàng GB
+MAX_FRAME_SIZE = int(os.getenv('MAX_FRAME_SIZE', str(16 * 1024 * 1024)))
+
+# Kiểm tra JPEG (SOI/EOI, không giải mã ảnh) trong writer thread trước khi ghi; frame hỏng
+# không ghi vào phiên mà chuyển vào <camera>/quarantine/ (1 = bật, 0 = tắt)
+FRAME_VALIDATE = os.getenv('FRAME_VALIDATE', '1').strip() == '1'
+# Payload Base64 (cờ header v2 hoặc tự nhận dạng) được giải mã trước khi ghi (0 = coi là hỏng)
+FRAME_DECODE_BASE64 = os.getenv('FRAME_DECODE_BASE64', '1').strip() == '1'
+# Số frame hỏng tối đa lưu vào quarantine cho mỗi camera / phiên (0 = chỉ đếm, không lưu)
+QUARANTINE_MAX_FILES = int(os.getenv('QUARANTINE_MAX_FILES', '100'))
+
+# --- Phát hiện camera đứng hình (băm nội dung frame trong writer thread) ---
+# Số frame liên tiếp giống nhau để báo camera đứng hình qua UDP điều khiển + UI (0 = tắt)
+FREEZE_FRAMES = int(os.getenv('FREEZE_FRAMES', '30'))
+# So thêm chữ ký perceptual trên ảnh giải mã 1/8 để bắt cả frame gần giống (cần Pillow, tốn CPU hơn; 1 = bật)
+FREEZE_PERCEPTUAL = os.getenv('FREEZE_PERCEPTUAL', '0').strip() == '1'
+# Số bit lệch tối đa (trên 64) giữa 2 chữ ký perceptual để coi là gần giống
+FREEZE_MAX_DISTANCE = int(os.getenv('FREEZE_MAX_DISTANCE', '4'))
+
+# --- Writer ghi đĩa chạy nền ---
+# Số writer thread (0 = ghi đồng bộ ngay trong thread mạng như trước)
+WRITER_THREADS = int(os.getenv('WRITER_THREADS', '2'))
+# Tổng số frame tối đa chờ ghi trong hàng đợi
+WRITER_QUEUE_SIZE = int(os.getenv('WRITER_QUEUE_SIZE', '256'))
+# Số frame tối đa mỗi lô ghi
+WRITER_BATCH_SIZE = int(os.getenv('WRITER_BATCH_SIZE', '16'))
+# Chính sách fsync: none | batch | frame
+WRITER_FSYNC = os.getenv('WRITER_FSYNC', 'none').strip().lower()
+# Khi hàng đợi đầy: block | drop-oldest | drop-newest
+WRITER_OVERFLOW = os.getenv('WRITER_OVERFLOW', 'block').strip().lower()
+
+# Định dạng lưu: jpeg (1 file / frame) | segment (file append-only theo camera + index)
+STORAGE_FORMAT = os.getenv('STORAGE_FORMAT', 'jpeg').strip().lower()
+# Ngưỡng xoay segment (0 = không xoay theo tiêu chí đó)
+SEGMENT_MAX_MB = int(os.getenv('SEGMENT_MAX_MB', '256'))
+SEGMENT_MAX_SECONDS = int(os.getenv('SEGMENT_MAX_SECONDS', '300'))
+# Ghi index nhị phân frames.idx theo camera trong lúc ingest (1 = bật, 0 = tắt)
+FRAME_INDEX = os.getenv('FRAME_INDEX', '1').strip() == '1'
+# Frame giống hệt frame trước của camera được lưu bằng tham chiếu (jpeg: hard link,
+# segment: bản ghi index trỏ lại dữ liệu cũ) thay vì ghi lại (1 = bật)
+STORAGE_DEDUP = os.getenv('STORAGE_DEDUP', '0').strip() == '1'
+
+# Ghép frame JPEG thành video DATA_DIR/<session>/<camera>.mkv ngay khi ghi (MJPEG, không nén lại; 1 = bật)
+VIDEO_MUX = os.getenv('VIDEO_MUX', '0').strip() == '1'
+# Độ dài tối đa 1 cluster Matroska (ms)
+VIDEO_MUX_CLUSTER_MS = int(os.getenv('VIDEO_MUX_CLUSTER_MS', '5000'))
+
+# --- Ảnh thu nhỏ / contact sheet (cần Pillow, giải mã trong process pool riêng; 1 = bật) ---
+THUMBNAILS = os.getenv('THUMBNAILS', '0').strip() == '1'
+# Lấy mẫu 1 frame / N frame đã ghi của mỗi camera
+THUMB_EVERY_N = int(os.getenv('THUMB_EVERY_N', '30'))
+# Cạnh dài tối đa (px) và chất lượng JPEG của ảnh thu nhỏ
+THUMB_SIZE = int(os.getenv('THUMB_SIZE', '320'))
+THUMB_QUALITY = int(os.getenv('THUMB_QUALITY', '70'))
+# Số process giải mã và số việc tối đa chờ pool (vượt thì bỏ frame mẫu)
+THUMB_PROCESSES = int(os.getenv('THUMB_PROCESSES', '1'))
+THUMB_MAX_PENDING = int(os.getenv('THUMB_MAX_PENDING', '8'))
+# Bỏ frame mẫu khi hàng đợi writer đầy hơn tỉ lệ này (0..1, ingest đang bận)
+THUMB_SHED_QUEUE = float(os.getenv('THUMB_SHED_QUEUE', '0.5'))
+# Chu kỳ ghép contact sheet mọi camera của phiên (giây, 0 = tắt)
+CONTACT_SHEET_INTERVAL = float(os.getenv('CONTACT_SHEET_INTERVAL', '10'))
+
+# Ghép frame đa camera live (1 = bật) và dung sai lệch thời gian giữa các camera (ms)
+ALIGN_LIVE = os.getenv('ALIGN_LIVE', '0').strip() == '1'
+ALIGN_TOLERANCE_MS = float(os.getenv('ALIGN_TOLERANCE_MS', '100'))
+
+# --- Bảo trì DATA_DIR chạy nền (xoá / đóng gói / chuyển phiên cũ; mọi chính sách mặc định tắt) ---
+# Chu kỳ lập kế hoạch bảo trì (giây)
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', '300'))
+# Xoá phiên cũ hơn N ngày (cả ổ chính và ổ phụ, 0 = tắt)
+RETENTION_MAX_AGE_DAYS = float(os.getenv('RETENTION_MAX_AGE_DAYS', '0'))
+# Tổng dung lượng tối đa các phiên trên ổ chính / của 1 camera (GB, 0 = tắt)
+RETENTION_MAX_GB = float(os.getenv('RETENTION_MAX_GB', '0'))
+RETENTION_CAMERA_MAX_GB = float(os.getenv('RETENTION_CAMERA_MAX_GB', '0'))
+# Ổ chính còn trống dưới DISK_MIN_FREE_PCT % thì giải phóng tới DISK_TARGET_FREE_PCT % (0 = tắt)
+DISK_MIN_FREE_PCT = float(os.getenv('DISK_MIN_FREE_PCT', '0'))
+DISK_TARGET_FREE_PCT = float(os.getenv('DISK_TARGET_FREE_PCT', '0'))
+# Đóng gói phiên cũ hơn N giờ: segment (JPEG -> segment theo camera) | zip (cả phiên; 0 = tắt)
+PACK_AFTER_HOURS = float(os.getenv('PACK_AFTER_HOURS', '0'))
+PACK_FORMAT = os.getenv('PACK_FORMAT', 'segment').strip().lower()
+# Ổ phụ (chậm hơn) nhận phiên cũ hơn RELOCATE_AFTER_HOURS giờ / phiên bị đẩy ra khi ổ chính đầy
+SECONDARY_DATA_DIR = os.getenv('SECONDARY_DATA_DIR', '').strip()
+RELOCATE_AFTER_HOURS = float(os.getenv('RELOCATE_AFTER_HOURS', '0'))
+# Giới hạn tốc độ đọc / ghi của bảo trì (MB/s, 0 = không giới hạn); tạm dừng khi hàng đợi
+# writer đầy hơn MAINTENANCE_PAUSE_QUEUE (0..1)
+MAINTENANCE_MAX_MBPS = float(os.getenv('MAINTENANCE_MAX_MBPS', '20'))
+MAINTENANCE_PAUSE_QUEUE = float(os.getenv('MAINTENANCE_PAUSE_QUEUE', '0.25'))
+# Chỉ ghi log kế hoạch (dung lượng sẽ giải phóng), không thay đổi gì (1 = bật)
+MAINTENANCE_DRY_RUN = os.getenv('MAINTENANCE_DRY_RUN', '0').strip() == '1'
+
+# --- Đồng bộ đồng hồ thiết bị (NTP qua UDP điều khiển) ---
+CLOCK_SYNC = os.getenv('CLOCK_SYNC', '1').strip() == '1'
+# Chu kỳ đo lại đồng hồ mọi thiết bị (giây, 0 = chỉ đo khi REGISTER)
+CLOCK_SYNC_INTERVAL = float(os.getenv('CLOCK_SYNC_INTERVAL', '30'))
+# Số gói ping mỗi vòng đo
+CLOCK_SYNC_SAMPLES = int(os.getenv('CLOCK_SYNC_SAMPLES', '8'))
+# SYNC_START hẹn giờ: bắt đầu sau N ms theo đồng hồ từng thiết bị (0 = phát SYNC_START ngay như cũ)
+SYNC_START_DELAY_MS = int(os.getenv('SYNC_START_DELAY_MS', '0'))
+
+# --- Phát lệnh điều khiển có ACK ---
+# Thời gian chờ ACK trước lần gửi lại đầu tiên (ms, nhân đôi mỗi lần)
+COMMAND_RETRY_MS = int(os.getenv('COMMAND_RETRY_MS', '50'))
+# Số lần gửi lại tối đa khi không có ACK
+COMMAND_RETRIES = int(os.getenv('COMMAND_RETRIES', '3'))
+# Thiết bị có gửi HEARTBEAT mà im lặng quá N giây thì coi là chết (0 = tắt)
+CLIENT_TIMEOUT = float(os.getenv('CLIENT_TIMEOUT', '30'))
+
+# --- Backpressure: gợi ý FPS / chất lượng JPEG cho thiết bị khai báo "rateControl" ---
+RATE_CONTROL = os.getenv('RATE_CONTROL', '1').strip() == '1'
+# Chu kỳ đánh giá tải (giây)
+RATE_CONTROL_INTERVAL = float(os.getenv('RATE_CONTROL_INTERVAL', '1'))
+# Thang nấc "hệ số FPS:giảm chất lượng", nấc đầu là tốc độ gốc của thiết bị
+RATE_LEVELS = parse_levels(os.getenv('RATE_LEVELS', '1:0,0.75:0,0.5:10,0.33:20,0.25:25'))
+RATE_MIN_FPS = float(os.getenv('RATE_MIN_FPS', '1'))
+RATE_MIN_QUALITY = int(os.getenv('RATE_MIN_QUALITY', '20'))
+# Ngưỡng độ đầy hàng đợi writer (0..1): vượt HIGH thì giảm, dưới LOW đủ lâu thì tăng lại
+RATE_QUEUE_HIGH = float(os.getenv('RATE_QUEUE_HIGH', '0.7'))
+RATE_QUEUE_LOW = float(os.getenv('RATE_QUEUE_LOW', '0.3'))
+# Ngưỡng độ trễ ingest từng thiết bị (capture -> nhận, chờ ghi)
+RATE_LAG_HIGH_MS = float(os.getenv('RATE_LAG_HIGH_MS', '500'))
+RATE_LAG_LOW_MS = float(os.getenv('RATE_LAG_LOW_MS', '150'))
+# Số giây ổn định dưới ngưỡng thấp trước khi tăng lại 1 nấc
+RATE_UP_AFTER = float(os.getenv('RATE_UP_AFTER', '5'))
+
 # --- Dynamic devices (nhiều mobile/cam) ---
 BASE_CAM_PORT = int(os.getenv('BASE_CAM_PORT', '6001'))   # cổng TCP bắt đầu cho device mới
+# Cổng TCP ingest dùng chung cho mọi camera hỗ trợ handshake (0 = tắt, mỗi device 1 cổng như cũ)
+INGEST_PORT = int(os.getenv('INGEST_PORT', '0'))
+# Thời gian tối đa chờ handshake trên cổng dùng chung (giây)
+INGEST_HANDSHAKE_TIMEOUT = float(os.getenv('INGEST_HANDSHAKE_TIMEOUT', '5'))
 DEVICES_FILE = os.path.join(DATA_DIR, 'devices.json')
+# Số thay đổi ghi vào journal trước khi ghi lại snapshot devices.json
+DEVICES_COMPACT_EVERY = int(os.getenv('DEVICES_COMPACT_EVERY', '1000'))
+# fsync journal sau mỗi thay đổi device
+DEVICES_FSYNC = os.getenv('DEVICES_FSYNC', '1').strip() == '1'
 
 # { deviceId: { "deviceId": ..., "name": ..., "port": ..., "subdir": ... } }
 devices = {}
 devices_lock = threading.Lock()
 next_dynamic_port = BASE_CAM_PORT
+device_journal = DeviceJournal(DEVICES_FILE, fsync=DEVICES_FSYNC, compact_every=DEVICES_COMPACT_EVERY)
+
+# Listener TCP riêng đang mở trong process này: { cam_name: port } (mở lười khi device kết nối lại)
+camera_listeners = {}
+
+# Hàm nhận thông báo device vừa thêm / đổi: fn(deviceId), gọi ngoài devices_lock (vd UI)
+device_listeners = []
+
+# Số kết nối TCP đang mở và thời điểm nhận frame cuối theo camera (UI đọc không cần lock)
+camera_connections = {}
+camera_connections_lock = threading.Lock()
+camera_last_frame_ns = {}
 
 # Lưu danh sách client UDP: { 'deviceId': ('ip', port) }
 control_clients = {}
@@ -39,87 +257,210 @@ control_clients = {}
 # Socket UDP điều khiển toàn cục
 control_udp_socket = None
 
-# Bộ đếm frame theo camera
-frame_counters = {
-}
-frame_counters_lock = threading.Lock()
+# Dịch vụ đo lệch đồng hồ (khởi tạo khi socket điều khiển đã mở)
+clock_sync = None
+
+# Bộ phát lệnh có ACK / gửi lại (khởi tạo khi socket điều khiển đã mở)
+command_dispatcher = None
+
+# camera (subdir viết thường) -> deviceId
+camera_devices = {}
+
+# Điều khiển tốc độ gửi theo tải (None nếu RATE_CONTROL tắt)
+rate_controller = RateController(
+    levels=RATE_LEVELS,
+    min_fps=RATE_MIN_FPS,
+    min_quality=RATE_MIN_QUALITY,
+    queue_high=RATE_QUEUE_HIGH,
+    queue_low=RATE_QUEUE_LOW,
+    lag_high=RATE_LAG_HIGH_MS / 1000.0,
+    lag_low=RATE_LAG_LOW_MS / 1000.0,
+    up_after=RATE_UP_AFTER,
+) if RATE_CONTROL else None
 
-# Sự kiện để dừng từng server camera
+# Phiên ghi hiện tại + các phiên đang đóng (bộ đếm frame / MAX_FRAMES tính theo phiên)
+sessions = SessionManager(DATA_DIR, close_grace=SESSION_CLOSE_GRACE)
+
+# Số frame writer đã bỏ theo camera lúc mở phiên (để tính số bỏ trong phiên): { session id: {cam: n} }
+session_drop_baseline = {}
+
+# Sự kiện để dừng từng server camera (khi tắt server)
 stop_events = {
 }
 
+# Event loop dùng chung cho chế độ INGEST_MODE=asyncio (khởi tạo lười)
+ingest_loop = None
+ingest_loop_lock = threading.Lock()
+
+# Server asyncio đang mở theo camera: { cam_name: asyncio.AbstractServer }
+async_servers = {}
+
+# Pool buffer nhận frame (trả lại sau khi writer ghi xong) & writer nền (khởi tạo lười)
+buffer_pool = BufferPool(max_buffers=WRITER_QUEUE_SIZE + max(1, WRITER_THREADS) * WRITER_BATCH_SIZE)
+frame_writer = None
+frame_writer_lock = threading.Lock()
+
+# Frame mới nhất theo camera cho preview (None nếu PREVIEW_PORT=0 hoặc ingest nhiều process)
+preview_cache = LatestFrameCache(buffer_pool) if PREVIEW_PORT > 0 and INGEST_WORKERS <= 0 else None
+preview_server = None
+
+# Tạo ảnh thu nhỏ sau khi ghi (None nếu THUMBNAILS tắt / thiếu Pillow)
+thumbnailer = None
+
+# Bảo trì DATA_DIR chạy nền (None nếu không có chính sách nào được bật)
+maintenance = None
+maintenance_last_report = None
+
+# Thống kê header v2 (sequence/capture time) của kết nối gần nhất theo camera: { cam_name: CaptureTimeline }
+capture_timelines = {}
+
+# Ghép multi-view live theo phiên: { session.path: (StreamingAligner, hàm đóng multiview.jsonl) }
+# (None nếu ALIGN_LIVE tắt hoặc ingest nhiều process)
+live_aligners = {} if ALIGN_LIVE and INGEST_WORKERS <= 0 else None
+MULTIVIEW_FILE = 'multiview.jsonl'
+
+# --- Ingest nhiều process (INGEST_WORKERS > 0) ---
+# Process chính: các process ingest, writer tổng hợp và metrics ingest theo process { index: { metric: snapshot } }
+ingest_workers = None
+ingest_writer = WriterStatsView()
+worker_metric_snapshots = {}
+# Ước lượng đồng hồ đã gửi cho từng process: { index: { cam: updated_ns } }
+worker_clock_sent = {}
+# Listener riêng đã giao cho process ingest: { cam_name: (port, cam_dir) } (mở lại khi process khởi động lại)
+worker_listeners = {}
+# Phiên đang thu bộ đếm cuối từ các process (bỏ báo cáo định kỳ tới muộn)
+finalizing_sessions = set()
+# Process ingest: kênh về process chính, ước lượng đồng hồ nhận từ process chính,
+# tổng (giây, số frame) độ trễ ingest / chờ hàng đợi theo camera từ lần báo cáo trước
+ingest_channel = None
+camera_clock_estimates = {}
+worker_rate_samples = {'lag': {}, 'wait': {}}
+
+# --- Metrics ---
+metrics = MetricsRegistry()
+frames_received_total = metrics.counter(
+    'camserver_frames_received_total', 'Frame đã nhận đủ qua TCP', ('camera',))
+bytes_received_total = metrics.counter(
+    'camserver_bytes_received_total', 'Byte payload frame đã nhận', ('camera',))
+frame_receive_seconds = metrics.histogram(
+    'camserver_frame_receive_seconds', 'Thời gian nhận payload 1 frame (sau header)', ('camera',))
+frames_short_total = metrics.counter(
+    'camserver_frames_short_total', 'Frame bị cắt giữa chừng (kết nối đóng khi chưa đủ dữ liệu)', ('camera',))
+frames_oversize_total = metrics.counter(
+    'camserver_frames_oversize_total', 'Header frame vượt MAX_FRAME_SIZE (coi là hỏng)', ('camera',))
+frames_lost_total = metrics.counter(
+    'camserver_frames_lost_total', 'Frame thiếu theo sequence header v2', ('camera',))
+frames_corrupt_total = metrics.counter(
+    'camserver_frames_corrupt_total', 'Frame không phải JPEG hoàn chỉnh, chuyển vào quarantine',
+    ('camera', 'reason'))
+frames_base64_total = metrics.counter(
+    'camserver_frames_base64_total', 'Frame gửi dạng Base64, đã giải mã trước khi ghi', ('camera',))
+frames_repeated_total = metrics.counter(
+    'camserver_frames_repeated_total', 'Frame giống hệt frame trước của camera', ('camera',))
+camera_frozen = metrics.gauge(
+    'camserver_camera_frozen', 'Camera đang đứng hình (FREEZE_FRAMES frame liên tiếp giống nhau)', ('camera',))
+frames_unsessioned_total = metrics.counter(
+    'camserver_frames_unsessioned_total', 'Frame tới sau khi phiên đã dừng (SYNC_STOP / MAX_FRAMES), bị bỏ',
+    ('camera',))
+frames_written_total = metrics.counter(
+    'camserver_frames_written_total', 'Frame đã ghi xuống storage', ('camera',))
+write_batch_seconds = metrics.histogram(
+    'camserver_write_batch_seconds', 'Thời gian ghi 1 lô frame xuống storage (kể cả fsync)')
+queue_wait_seconds = metrics.histogram(
+    'camserver_queue_wait_seconds', 'Thời gian frame chờ trong hàng đợi writer', ('camera',))
+command_ack_seconds = metrics.histogram(
+    'camserver_command_ack_seconds', 'Độ trễ từ lúc gửi lệnh điều khiển tới khi nhận ACK', ('device',))
+command_burst_seconds = metrics.histogram(
+    'camserver_command_burst_seconds', 'Chênh lệch thời điểm gửi giữa thiết bị đầu và cuối của 1 lệnh')
+command_lost_total = metrics.counter(
+    'camserver_command_lost_total', 'Lệnh điều khiển không được ACK sau khi hết lượt gửi lại', ('device',))
+maintenance_bytes_total = metrics.counter(
+    'camserver_maintenance_bytes_total', 'Dung lượng phiên đã xoá / đóng gói / chuyển sang ổ phụ', ('action',))
+
+# Metrics do process ingest đếm, gộp về process chính (INGEST_WORKERS > 0)
+INGEST_METRICS = (frames_received_total, bytes_received_total, frame_receive_seconds, frames_short_total,
+                  frames_oversize_total, frames_lost_total, frames_corrupt_total, frames_base64_total,
+                  frames_repeated_total, frames_unsessioned_total, frames_written_total, write_batch_seconds,
+                  queue_wait_seconds)
+
+
+def create_logger(file_path):
+    return AsyncLogger(
+        level=LOG_LEVEL,
+        tag_levels=LOG_TAG_LEVELS,
+        file_path=file_path,
+        file_max_bytes=LOG_FILE_MAX_MB * 1024 * 1024,
+        file_backups=LOG_FILE_BACKUPS,
+        json_lines=LOG_JSON,
+        rate_limit=LOG_RATE_LIMIT,
+        rate_window=LOG_RATE_WINDOW,
+    )
+
 
-def log(tag, message):
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}][{tag}] {message}")
+logger = create_logger(LOG_FILE or None)
+# Tiền tố dòng log (process ingest: "[ingest N] ")
+log_prefix = ''
+
+
+def log(tag, message, level=LOG_INFO):
+    logger.log(tag, log_prefix + message if log_prefix else message, level)
 
 
 def handle_tcp_client(conn, addr, cam_dir):
     """
     Xử lý kết nối dữ liệu hình ảnh qua TCP.
-    Giao thức: 4 bytes (length) + N bytes (Base64 image).
+    Giao thức: header v1 (4 bytes length) hoặc v2 (magic MCF2 + sequence + capture time)
+    + N bytes ảnh, xem FrameReceiver.
     """
     cam_name = os.path.basename(cam_dir).lower()
-    if cam_name not in frame_counters:
-        # Nếu là dynamic subdir thì thêm vào
-        with frame_counters_lock:
-            frame_counters.setdefault(cam_name, 0)
 
-    log("TCP", f"Kết nối MỚI từ {addr} -> Lưu vào: {cam_dir} (camera: {cam_name})")
+    log("TCP", f"Kết nối MỚI từ {addr} -> camera: {cam_name}")
+    track_connection(cam_name, 1)
+    receiver = FrameReceiver(conn, MAX_FRAME_SIZE)
+    timeline = capture_timelines[cam_name] = CaptureTimeline(lambda: capture_clock_offset(cam_name))
+    m_frames = frames_received_total.labels(cam_name)
+    m_bytes = bytes_received_total.labels(cam_name)
+    m_receive = frame_receive_seconds.labels(cam_name)
 
     try:
         while True:
-            # Nếu server cho camera này đã được dừng theo giới hạn frame
+            # Server đang tắt
             event = stop_events.get(cam_name)
             if event is not None and event.is_set():
-                log("TCP", f"Giới hạn frame đã đạt cho {cam_name}. Đóng kết nối {addr}.")
-                break
-
-            length_data = conn.recv(4)
-            if not length_data:
-                log("TCP", f"Client {addr} đã đóng kết nối (Không nhận được header).")
+                log("TCP", f"Server camera {cam_name} đã dừng. Đóng kết nối {addr}.")
                 break
 
-            frame_length = struct.unpack('>I', length_data)[0]
-            log("TCP", f"Chuẩn bị nhận frame kích thước: {frame_length} bytes")
-
-            data = b""
-            while len(data) < frame_length:
-                packet = conn.recv(frame_length - len(data))
-                if not packet:
+            try:
+                header = receiver.read_header()
+                if header is None:
+                    log("TCP", f"Client {addr} đã đóng kết nối (Không nhận được header).")
                     break
-                data += packet
-
-            if len(data) != frame_length:
-                log("TCP", f"LỖI: Dữ liệu không đủ. Cần {frame_length}, nhận được {len(data)}. Bỏ qua frame này.")
-                continue
+                if logger.enabled("TCP", LOG_DEBUG):
+                    log("TCP", f"Chuẩn bị nhận frame kích thước: {header.length} bytes", LOG_DEBUG)
+                started = time.perf_counter()
+                if WRITER_THREADS > 0:
+                    # Frame chuyển sang writer thread: đọc vào buffer mượn từ pool
+                    data, buf = receiver.read_payload_pooled(header.length, buffer_pool)
+                else:
+                    # memoryview trỏ vào buffer của receiver, hợp lệ tới frame kế tiếp
+                    data, buf = receiver.read_payload(header.length), None
+                recv_time_ns = time.time_ns()
+                m_receive.observe(time.perf_counter() - started)
+                m_frames.inc()
+                m_bytes.inc(header.length)
+            except IncompleteFrameError as e:
+                frames_short_total.labels(cam_name).inc()
+                log("TCP", f"LỖI: Dữ liệu không đủ. Cần {e.expected}, nhận được {e.received}. Bỏ qua frame này.")
+                break
+            except FrameTooLargeError as e:
+                frames_oversize_total.labels(cam_name).inc()
+                log("TCP", f"LỖI: Frame {e.frame_length} bytes vượt MAX_FRAME_SIZE={e.max_frame_size}. Đóng kết nối {addr}.")
+                break
 
             try:
-                image_data = data
-
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                filepath = os.path.join(cam_dir, f"frame_{timestamp}.jpg")
-                with open(filepath, 'wb') as f:
-                    f.write(image_data)
-
-                with frame_counters_lock:
-                    frame_counters.setdefault(cam_name, 0)
-                    frame_counters[cam_name] += 1
-                    current_count = frame_counters[cam_name]
-
-                log("TCP", f"{cam_name} count={current_count}")
-
-                if MAX_FRAMES > 0 and current_count >= MAX_FRAMES:
-                    log("TCP", f"ĐẠT GIỚI HẠN: {current_count} >= {MAX_FRAMES} cho {cam_name}. Gửi SYNC_STOP và dừng camera.")
-                    if cam_name not in stop_events:
-                        stop_events[cam_name] = threading.Event()
-                    stop_events[cam_name].set()
-                    try:
-                        broadcast_command(control_udp_socket, b"SYNC_STOP")
-                        log("UDP", "Đã phát SYNC_STOP do đạt giới hạn frame.")
-                    except Exception as e:
-                        log("UDP", f"Lỗi khi gửi SYNC_STOP: {e}")
-                    break
+                capture_time_ns = observe_capture(cam_name, timeline, header, recv_time_ns)
+                store_frame(cam_name, cam_dir, data, buf, recv_time_ns, capture_time_ns, header.sequence,
+                            header.flags)
             except Exception as e:
                 log("TCP", f"Lỗi khi giải mã/lưu ảnh: {e}")
 
@@ -129,92 +470,874 @@ def handle_tcp_client(conn, addr, cam_dir):
         log("TCP", f"Lỗi không xác định với {addr}: {e}")
     finally:
         conn.close()
+        track_connection(cam_name, -1)
         log("TCP", f"Đã đóng socket với {addr}")
 
 
-def broadcast_command(sock, message_bytes):
-    """Gửi lệnh tới TẤT CẢ client đã đăng ký"""
-    internal_sock = None
-    if sock is None:
-        internal_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock_to_use = internal_sock
+def track_connection(cam_name, delta):
+    """Đếm kết nối TCP đang mở của camera (+1 khi mở, -1 khi đóng)."""
+    with camera_connections_lock:
+        count = camera_connections[cam_name] = camera_connections.get(cam_name, 0) + delta
+    if count <= 0 and live_aligners:
+        # camera đã ngắt: không chờ frame của nó nữa (tuple sau không bị tính thiếu camera này)
+        for aligner, _ in list(live_aligners.values()):
+            aligner.remove_camera(cam_name)
+
+
+def create_storage():
+    """
+    Tạo storage theo STORAGE_FORMAT (kèm index frames.idx nếu FRAME_INDEX bật),
+    bọc thêm tầng ghép video .mkv nếu VIDEO_MUX bật.
+    """
+    indexer = FrameIndexer() if FRAME_INDEX else None
+    if STORAGE_FORMAT == 'segment':
+        storage = SegmentStorage(max_bytes=SEGMENT_MAX_MB * 1024 * 1024, max_seconds=SEGMENT_MAX_SECONDS,
+                                 indexer=indexer, dedup=STORAGE_DEDUP)
     else:
-        sock_to_use = sock
+        if STORAGE_FORMAT != 'jpeg':
+            log("INIT", f"STORAGE_FORMAT không hợp lệ '{STORAGE_FORMAT}', dùng 'jpeg'.")
+        storage = JpegFileStorage(indexer=indexer, dedup=STORAGE_DEDUP)
+    if VIDEO_MUX:
+        storage = MuxingStorage(
+            storage, cluster_ms=VIDEO_MUX_CLUSTER_MS,
+            on_error=lambda frame, e: log("VIDEO", f"Lỗi ghép video {frame.cam_name if frame else ''}: {e}",
+                                          LOG_ERROR),
+        )
+    return storage
+
+
+def observe_write_batch(batch, written, write_seconds, dequeue_time):
+    """Callback FrameWriter sau mỗi lô: thời gian ghi, thời gian chờ hàng đợi, số frame đã ghi."""
+    write_batch_seconds.observe(write_seconds)
+    for frame in batch:
+        if frame.enqueue_time is not None:
+            queue_wait_seconds.labels(frame.cam_name).observe(dequeue_time - frame.enqueue_time)
+            if rate_controller is not None:
+                rate_controller.observe_queue_wait(camera_devices.get(frame.cam_name),
+                                                   dequeue_time - frame.enqueue_time)
+            elif ingest_channel is not None:
+                add_rate_sample('wait', frame.cam_name, dequeue_time - frame.enqueue_time)
+    session_dirs = {}
+    for frame in written:
+        frames_written_total.labels(frame.cam_name).inc()
+        session_dir = os.path.dirname(frame.cam_dir)
+        session = session_dirs.get(session_dir)
+        if session is None:
+            session = session_dirs[session_dir] = sessions.find(session_dir)
+        if session is not None:
+            session.count_written(frame.cam_name, len(frame.data))
+    if thumbnailer is not None:
+        thumbnailer.offer(written)
+
+
+frame_validator = FrameValidator(
+    decode_base64=FRAME_DECODE_BASE64,
+    on_decode=lambda frame: frames_base64_total.labels(frame.cam_name).inc(),
+)
+quarantine = Quarantine(max_files=QUARANTINE_MAX_FILES)
+
+
+def quarantine_frame(frame, reason):
+    """on_reject của FrameWriter: frame hỏng -> đếm theo camera / lý do, lưu payload vào <camera>/quarantine/."""
+    frames_corrupt_total.labels(frame.cam_name, reason).inc()
+    session = sessions.find(os.path.dirname(frame.cam_dir))
+    if session is not None:
+        session.count_corrupt(frame.cam_name)
+    saved = quarantine.put(frame, reason) is not None
+    log("DISK", f"{frame.cam_name}: frame hỏng ({reason}), "
+                + ("chuyển vào quarantine." if saved else "bỏ qua (quarantine đã đủ file)."), LOG_WARNING)
+
+
+def on_camera_freeze(cam_name, frozen, match, count):
+    """on_change của FreezeDetector (writer thread): process ingest chuyển về process chính."""
+    if ingest_channel is not None:
+        ingest_channel.send('freeze', cam_name, frozen, match, count)
+    else:
+        report_camera_freeze(cam_name, frozen, match, count)
+
 
-    for d_id in list(control_clients.keys()):
-        d_addr = control_clients[d_id]
-        log("UDP", f"Gửi lệnh tới {d_id} tại {d_addr}")
+def report_camera_freeze(cam_name, frozen, match, count):
+    """Camera bắt đầu / hết đứng hình: log, cập nhật UI / metrics, báo mọi client điều khiển (FREEZE)."""
+    if frozen:
+        frozen_cameras[cam_name] = (match, count)
+        log("FREEZE", f"{cam_name}: {count} frame liên tiếp {'giống hệt' if match == MATCH_IDENTICAL else 'gần giống'}"
+                      f" - camera có thể đã đứng hình!", LOG_WARNING)
+    else:
+        frozen_cameras.pop(cam_name, None)
+        log("FREEZE", f"{cam_name}: hết đứng hình sau {count} frame giống nhau.")
+    camera_frozen.labels(cam_name).set(1 if frozen else 0)
+    sock = control_udp_socket
+    if sock is None:
+        return
+    payload = json.dumps({"type": "FREEZE", "deviceId": camera_devices.get(cam_name), "camera": cam_name,
+                          "frozen": frozen, "match": match, "frames": count}).encode('utf-8')
+    for d_id, addr in list(control_clients.items()):
         try:
-            sock_to_use.sendto(message_bytes, d_addr)
+            sock.sendto(payload, addr)
         except OSError as e:
-            if getattr(e, 'winerror', 0) == 10054:
-                log("UDP", f"Phát hiện client CHẾT: {d_id}. Đang xóa khỏi danh sách.")
-                del control_clients[d_id]
-            else:
-                log("UDP", f"Lỗi gửi tới {d_id}: {e}")
+            log("FREEZE", f"Lỗi gửi FREEZE tới {d_id}: {e}", LOG_WARNING)
+
+
+# Băm frame để phát hiện đứng hình / dedup storage (None nếu FREEZE_FRAMES=0 và STORAGE_DEDUP tắt)
+freeze_detector = FreezeDetector(
+    threshold=FREEZE_FRAMES,
+    perceptual=FREEZE_PERCEPTUAL and PERCEPTUAL_AVAILABLE,
+    max_distance=FREEZE_MAX_DISTANCE,
+    on_change=on_camera_freeze,
+) if FREEZE_FRAMES > 0 or STORAGE_DEDUP else None
+# Camera đang đứng hình (process chính): { cam_name: (match, số frame lúc báo) }
+frozen_cameras = {}
+
+
+def check_frame(frame):
+    """validator của FrameWriter (writer thread): kiểm tra JPEG rồi băm nội dung để phát hiện đứng hình."""
+    reason = frame_validator(frame) if FRAME_VALIDATE else None
+    if reason is None and freeze_detector is not None and freeze_detector.observe(frame):
+        frames_repeated_total.labels(frame.cam_name).inc()
+        session = sessions.find(os.path.dirname(frame.cam_dir))
+        if session is not None:
+            session.count_repeated(frame.cam_name)
+    return reason
+
+
+def collect_runtime_metrics():
+    """Collector lúc scrape: các giá trị đã có sẵn ở writer / clock sync / dispatcher."""
+    families = []
+    writer = current_writer()
+    if writer is not None:
+        ws = writer.stats()
+        families += [
+            ('camserver_writer_queue_depth', 'gauge', 'Số frame đang chờ ghi', [({}, ws['queue_depth'])]),
+            ('camserver_writer_queue_size', 'gauge', 'Sức chứa hàng đợi writer', [({}, ws['queue_size'])]),
+            ('camserver_writer_failed_total', 'counter', 'Frame ghi lỗi', [({}, ws['failed'])]),
+            ('camserver_writer_dropped_total', 'counter', 'Frame bị bỏ do hàng đợi đầy',
+             [({'camera': cam}, n) for cam, n in ws['dropped'].items()]),
+        ]
+    if preview_server is not None:
+        families += [
+            ('camserver_preview_viewers', 'gauge', 'Số người đang xem preview theo camera',
+             [({'camera': cam}, n) for cam, n in preview_cache.viewers().items()]),
+            ('camserver_preview_frames_sent_total', 'counter', 'Frame preview đã gửi cho người xem',
+             [({}, preview_server.frames_sent)]),
+        ]
+    if thumbnailer is not None:
+        ts = thumbnailer.stats()
+        families += [
+            ('camserver_thumbnails_total', 'counter', 'Ảnh thu nhỏ đã tạo', [({}, ts['thumbnails'])]),
+            ('camserver_contact_sheets_total', 'counter', 'Contact sheet đã tạo', [({}, ts['sheets'])]),
+            ('camserver_thumbnails_pending', 'gauge', 'Việc tạo ảnh đang chờ process pool', [({}, ts['pending'])]),
+            ('camserver_thumbnails_shed_total', 'counter', 'Frame mẫu bị bỏ do pool chưa xong / ingest bận',
+             [({}, ts['shed'])]),
+        ]
+    session = sessions.current()
+    families += [
+        ('camserver_session_active', 'gauge', 'Có phiên ghi đang mở (1) hay không (0)',
+         [({}, 1 if session is not None else 0)]),
+        ('camserver_session_frames', 'gauge', 'Số frame của từng camera trong phiên ghi hiện tại',
+         [({'camera': cam}, n) for cam, n in session.frame_counts().items()] if session is not None else []),
+        ('camserver_sessions_closed_total', 'counter', 'Số phiên ghi đã đóng từ lúc khởi động',
+         [({}, len(sessions.history))]),
+    ]
+    if ingest_workers is not None:
+        families += [
+            ('camserver_ingest_workers', 'gauge', 'Process ingest đang chạy', [({}, ingest_workers.alive())]),
+            ('camserver_ingest_worker_restarts_total', 'counter', 'Số lần process ingest bị khởi động lại',
+             [({}, ingest_workers.restarts)]),
+        ]
+    try:
+        usage = shutil.disk_usage(DATA_DIR)
+    except OSError:
+        usage = None
+    if usage is not None:
+        families += [
+            ('camserver_disk_free_bytes', 'gauge', 'Dung lượng trống của ổ chứa DATA_DIR', [({}, usage.free)]),
+            ('camserver_disk_total_bytes', 'gauge', 'Dung lượng ổ chứa DATA_DIR', [({}, usage.total)]),
+        ]
+    if maintenance is not None:
+        ms = maintenance.stats()
+        families += [
+            ('camserver_maintenance_runs_total', 'counter', 'Số lượt bảo trì DATA_DIR', [({}, ms['runs'])]),
+            ('camserver_maintenance_deferred_total', 'counter', 'Thao tác đóng gói / chuyển bị hoãn do đang ghi phiên',
+             [({}, ms['deferred'])]),
+            ('camserver_maintenance_failed_total', 'counter', 'Thao tác bảo trì lỗi', [({}, ms['failed'])]),
+        ]
+    families.append(('camserver_control_clients', 'gauge', 'Thiết bị đang có địa chỉ UDP điều khiển',
+                     [({}, len(control_clients))]))
+    if clock_sync is not None:
+        estimates = clock_sync.estimates()
+        families += [
+            ('camserver_clock_rtt_seconds', 'gauge', 'RTT của mẫu đo đồng hồ tốt nhất (sai số <= RTT/2)',
+             [({'device': d}, e.rtt_ns / 1e9) for d, e in estimates.items()]),
+            ('camserver_clock_residual_seconds', 'gauge', 'Residual của phép khớp offset đồng hồ qua các vòng',
+             [({'device': d}, e.residual_ns / 1e9) for d, e in estimates.items()]),
+            ('camserver_clock_drift_ppm', 'gauge', 'Drift đồng hồ thiết bị so với server (ppm)',
+             [({'device': d}, e.drift_ppm) for d, e in estimates.items()]),
+        ]
+    if rate_controller is not None:
+        targets = rate_controller.targets()
+        families += [
+            ('camserver_rate_level', 'gauge', 'Nấc giảm tốc hiện tại của thiết bị (0 = tốc độ gốc)',
+             [({'device': d}, t.level) for d, t in targets.items()]),
+            ('camserver_rate_target_fps', 'gauge', 'FPS mục tiêu đã gợi ý cho thiết bị',
+             [({'device': d}, t.fps) for d, t in targets.items()]),
+            ('camserver_rate_target_quality', 'gauge', 'Chất lượng JPEG mục tiêu đã gợi ý cho thiết bị',
+             [({'device': d}, t.quality) for d, t in targets.items()]),
+            ('camserver_ingest_lag_seconds', 'gauge', 'Độ trễ ingest (EWMA) dùng để điều khiển tốc độ',
+             [({'device': d}, t.lag_s) for d, t in targets.items()]),
+        ]
+    return families
+
+
+metrics.add_collector(collect_runtime_metrics)
+
+
+def start_metrics_server():
+    """Mở HTTP /metrics (và /debug/profile nếu PROFILER=1)."""
+    if METRICS_PORT <= 0:
+        return None
+    profiler = SamplingProfiler(hz=100) if PROFILER else None
+    try:
+        server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT, profiler=profiler).start()
+    except OSError as e:
+        log("INIT", f"Không mở được cổng metrics {METRICS_HOST}:{METRICS_PORT}: {e}", LOG_WARNING)
+        return None
+    log("INIT", f"Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics"
+                + (" | profiler: /debug/profile?seconds=10" if profiler is not None else ""))
+    return server
+
+
+def start_preview_server():
+    """Mở HTTP preview (MJPEG) phục vụ từ preview_cache."""
+    global preview_server
+    if preview_cache is None:
+        return None
+    try:
+        preview_server = PreviewServer(preview_cache, PREVIEW_HOST, PREVIEW_PORT, max_fps=PREVIEW_MAX_FPS,
+                                       cameras=lambda: list(camera_devices)).start()
+    except OSError as e:
+        log("INIT", f"Không mở được cổng preview {PREVIEW_HOST}:{PREVIEW_PORT}: {e}", LOG_WARNING)
+        return None
+    log("INIT", f"Preview: http://{PREVIEW_HOST}:{PREVIEW_PORT}/ (MJPEG: /stream/<camera>)")
+    return preview_server
+
+
+def writer_busy():
+    """Hàng đợi writer đầy hơn THUMB_SHED_QUEUE (nhường CPU cho ingest)."""
+    writer = frame_writer
+    return writer is not None and writer.queue_depth() >= THUMB_SHED_QUEUE * writer.queue_size
+
+
+def start_thumbnailer():
+    """Khởi tạo tầng ảnh thu nhỏ (process pool mở khi có frame mẫu đầu tiên)."""
+    global thumbnailer
+    if not THUMBNAILS:
+        return None
+    if not THUMBNAILS_AVAILABLE:
+        log("INIT", "THUMBNAILS=1 nhưng chưa cài Pillow (pip install pillow) - tắt ảnh thu nhỏ.", LOG_WARNING)
+        return None
+    thumbnailer = ThumbnailStage(
+        every_n=THUMB_EVERY_N,
+        max_size=THUMB_SIZE,
+        quality=THUMB_QUALITY,
+        processes=THUMB_PROCESSES,
+        max_pending=THUMB_MAX_PENDING,
+        sheet_interval=CONTACT_SHEET_INTERVAL,
+        busy=writer_busy,
+        on_error=lambda e: log("THUMB", f"Lỗi tạo ảnh thu nhỏ: {e}", LOG_WARNING),
+    )
+    log("INIT", f"Ảnh thu nhỏ: 1/{THUMB_EVERY_N} frame, {THUMB_SIZE}px, {THUMB_PROCESSES} process"
+                + (f", contact sheet mỗi {CONTACT_SHEET_INTERVAL:g}s" if CONTACT_SHEET_INTERVAL > 0 else ""))
+    return thumbnailer
+
+
+def maintenance_busy():
+    """Hàng đợi writer đầy hơn MAINTENANCE_PAUSE_QUEUE (bảo trì nhường I/O cho ingest)."""
+    writer = current_writer()
+    return writer is not None and writer.queue_depth() >= MAINTENANCE_PAUSE_QUEUE * writer.queue_size
+
+
+def on_maintenance_action(action):
+    maintenance_bytes_total.labels(action.kind).inc(action.bytes)
+    log("MAINT", f"{action.kind} {action.path} ({format_bytes(action.bytes)}, {action.reason})")
+
+
+def on_maintenance_error(action, e):
+    log("MAINT", f"Lỗi {action.kind} {action.path}: {e}" if action is not None else f"Lỗi lượt bảo trì: {e}",
+        LOG_ERROR)
+
+
+def on_maintenance_report(actions):
+    """Dry-run: log kế hoạch khi có thay đổi so với lượt trước."""
+    global maintenance_last_report
+    report = format_report(actions) if actions else None
+    if report != maintenance_last_report:
+        maintenance_last_report = report
+        if report is not None:
+            log("MAINT", "Dry-run:\n" + report)
+
+
+def maintenance_summary():
+    policies = []
+    if RETENTION_MAX_AGE_DAYS > 0:
+        policies.append(f"xoá sau {RETENTION_MAX_AGE_DAYS:g} ngày")
+    if RETENTION_MAX_GB > 0:
+        policies.append(f"tối đa {RETENTION_MAX_GB:g} GB")
+    if RETENTION_CAMERA_MAX_GB > 0:
+        policies.append(f"{RETENTION_CAMERA_MAX_GB:g} GB / camera")
+    if DISK_MIN_FREE_PCT > 0:
+        policies.append(f"trống >= {DISK_MIN_FREE_PCT:g}%")
+    if PACK_AFTER_HOURS > 0:
+        policies.append(f"gói {PACK_FORMAT} sau {PACK_AFTER_HOURS:g} giờ")
+    if SECONDARY_DATA_DIR:
+        policies.append(f"ổ phụ {SECONDARY_DATA_DIR}"
+                        + (f" sau {RELOCATE_AFTER_HOURS:g} giờ" if RELOCATE_AFTER_HOURS > 0 else ""))
+    if not policies:
+        return 'OFF'
+    return ", ".join(policies) + (" (dry-run)" if MAINTENANCE_DRY_RUN else "")
+
+
+def start_maintenance():
+    """Khởi động bảo trì DATA_DIR chạy nền (process chính) nếu có chính sách nào được bật."""
+    global maintenance
+    if PACK_FORMAT not in PACK_FORMATS:
+        log("INIT", f"PACK_FORMAT không hợp lệ '{PACK_FORMAT}' (hợp lệ: {', '.join(PACK_FORMATS)}) - tắt bảo trì.",
+            LOG_WARNING)
+        return None
+    service = RetentionService(
+        DATA_DIR,
+        secondary_dir=SECONDARY_DATA_DIR or None,
+        max_age=RETENTION_MAX_AGE_DAYS * 86400,
+        max_bytes=int(RETENTION_MAX_GB * 1024 ** 3),
+        camera_max_bytes=int(RETENTION_CAMERA_MAX_GB * 1024 ** 3),
+        min_free=DISK_MIN_FREE_PCT / 100,
+        target_free=DISK_TARGET_FREE_PCT / 100,
+        relocate_after=RELOCATE_AFTER_HOURS * 3600,
+        pack_after=PACK_AFTER_HOURS * 3600,
+        pack_format=PACK_FORMAT,
+        max_bytes_per_s=MAINTENANCE_MAX_MBPS * 1024 * 1024,
+        interval=MAINTENANCE_INTERVAL,
+        dry_run=MAINTENANCE_DRY_RUN,
+        active=sessions.active,
+        idle=lambda: sessions.current() is None,
+        busy=maintenance_busy,
+        on_action=on_maintenance_action,
+        on_error=on_maintenance_error,
+        on_report=on_maintenance_report,
+    )
+    if not service.enabled:
+        return None
+    maintenance = service.start()
+    log("INIT", f"Bảo trì DATA_DIR mỗi {MAINTENANCE_INTERVAL:g}s"
+                + (" (dry-run)" if MAINTENANCE_DRY_RUN else "")
+                + (f", tối đa {MAINTENANCE_MAX_MBPS:g} MB/s" if MAINTENANCE_MAX_MBPS > 0 else ""))
+    return maintenance
+
+
+def get_frame_writer():
+    """Trả về writer ghi đĩa dùng chung, khởi động writer thread nếu chưa có."""
+    global frame_writer
+    with frame_writer_lock:
+        if frame_writer is None:
+            writer = FrameWriter(
+                create_storage(),
+                threads=WRITER_THREADS,
+                queue_size=WRITER_QUEUE_SIZE,
+                batch_size=WRITER_BATCH_SIZE,
+                fsync_policy=WRITER_FSYNC,
+                overflow_policy=WRITER_OVERFLOW,
+                buffer_pool=buffer_pool,
+                on_error=lambda frame, e: log("DISK", f"Lỗi ghi frame {frame.cam_name if frame else ''}: {e}",
+                                              LOG_ERROR),
+                on_batch=observe_write_batch,
+                validator=check_frame if FRAME_VALIDATE or freeze_detector is not None else None,
+                on_reject=quarantine_frame,
+            )
+            if WRITER_THREADS > 0:
+                writer.start()
+                log("INIT", f"Writer nền: {WRITER_THREADS} thread, queue={WRITER_QUEUE_SIZE}, "
+                            f"batch={WRITER_BATCH_SIZE}, fsync={WRITER_FSYNC}, overflow={WRITER_OVERFLOW}")
+            frame_writer = writer
+        return frame_writer
+
+
+def capture_clock_offset(cam_name):
+    """Offset (ns) cộng vào capture time của camera để ra đồng hồ server, None nếu chưa đo đồng hồ."""
+    if ingest_channel is not None:
+        # process ingest: ước lượng do process chính gửi sang
+        estimate = camera_clock_estimates.get(cam_name)
+    elif clock_sync is None:
+        return None
+    else:
+        estimate = clock_sync.estimate(camera_devices.get(cam_name))
+    if estimate is None:
+        return None
+    return -int(estimate.offset_at(time.time_ns()))
+
+
+def observe_capture(cam_name, timeline, header, recv_time_ns):
+    """Với header v2: cập nhật thống kê sequence/độ trễ, trả về thời điểm chụp theo đồng hồ server."""
+    if header.sequence is None:
+        return None
+    capture_time_ns, gap = timeline.observe(header, recv_time_ns)
+    if rate_controller is not None:
+        rate_controller.observe_ingest_lag(camera_devices.get(cam_name), timeline.last_latency_ns / 1e9)
+    elif ingest_channel is not None:
+        add_rate_sample('lag', cam_name, timeline.last_latency_ns / 1e9)
+    if gap:
+        frames_lost_total.labels(cam_name).inc(gap)
+        session = sessions.current()
+        if session is not None:
+            session.count_lost(cam_name, gap)
+        log("TCP", f"{cam_name}: MẤT {gap} frame (sequence nhảy tới {header.sequence}).", LOG_WARNING)
+    return capture_time_ns
+
+
+def store_frame(cam_name, cam_dir, image_data, buffer=None, recv_time_ns=None, capture_time_ns=None, sequence=None,
+                flags=0):
+    """
+    Tầng lưu trữ dùng chung cho mọi chế độ ingest: đếm frame vào phiên ghi hiện tại và
+    chuyển cho writer (hàng đợi nền hoặc ghi đồng bộ nếu WRITER_THREADS=0) vào thư mục
+    camera của phiên. Camera đạt MAX_FRAMES thì phiên dừng (SYNC_STOP); frame tới sau đó
+    bị bỏ nhưng kết nối vẫn giữ cho take kế tiếp. Trả về False nếu frame bị bỏ.
+    cam_dir: DATA_DIR/<subdir> của listener (tên thư mục camera trong phiên).
+    buffer: bytearray mượn từ buffer_pool chứa image_data (trả lại pool sau khi ghi).
+    capture_time_ns / sequence / flags: từ header v2 (None / 0 nếu client dùng header legacy).
+    Payload được kiểm tra (FRAME_VALIDATE) trong writer thread, không phải ở đây.
+    """
+    session = sessions.for_frame(session_devices)
+    if session is None:
+        # phiên đã dừng (SYNC_STOP / MAX_FRAMES) mà thiết bị vẫn gửi: bỏ, không mở phiên mới
+        frames_unsessioned_total.labels(cam_name).inc()
+        if buffer is not None:
+            buffer_pool.release(buffer)
+        return False
+    frame = Frame(cam_name, session.cam_dir(os.path.basename(cam_dir)), image_data, recv_time_ns=recv_time_ns,
+                  buffer=buffer, capture_time_ns=capture_time_ns, sequence=sequence, flags=flags)
+    camera_last_frame_ns[cam_name] = frame.recv_time_ns
+    # preview chỉ nhận JPEG nhị phân nguyên vẹn (frame Base64 / hỏng được writer giải mã / loại sau)
+    if preview_cache is not None and not is_base64(image_data, flags) and check_jpeg(image_data) is None:
+        update_preview(cam_name, image_data, buffer, frame.timestamp_ns)
+    current_count = session.admit(cam_name, len(image_data), frame.timestamp_ns, MAX_FRAMES)
+    if not current_count:
+        # Camera đã đủ MAX_FRAMES trong phiên này
+        if buffer is not None:
+            buffer_pool.release(buffer)
+        return False
+    if live_aligners is not None:
+        alignment = live_aligners.get(session.path)
+        if alignment is not None:
+            alignment[0].add(cam_name, frame.timestamp_ns)
+    writer = get_frame_writer()
+    accepted = True
+    if WRITER_THREADS > 0:
+        accepted = writer.submit(frame)
+        if not accepted:
+            log("DISK", f"Hàng đợi ghi đầy, bỏ frame của {cam_name} (overflow={WRITER_OVERFLOW}).", LOG_WARNING)
+    else:
+        writer.write_now(frame)
+
+    if logger.enabled("TCP", LOG_DEBUG):
+        log("TCP", f"{cam_name} count={current_count} ({session.id})", LOG_DEBUG)
+
+    if MAX_FRAMES > 0 and current_count == MAX_FRAMES:
+        stop_at_max_frames(session, cam_name, current_count)
+    return accepted
+
+
+def stop_at_max_frames(session, cam_name, count):
+    """Camera đạt MAX_FRAMES: dừng phiên và phát SYNC_STOP (1 lần cho mỗi phiên)."""
+    if ingest_channel is not None:
+        # process ingest: phiên và cổng điều khiển nằm ở process chính
+        ingest_channel.send('max_frames', session.path, cam_name, count)
+        return
+    if sessions.stop(session, 'max_frames') is None:
+        return
+    log("TCP", f"ĐẠT GIỚI HẠN: {count} >= {MAX_FRAMES} cho {cam_name}. Gửi SYNC_STOP, dừng phiên {session.id}.")
+    try:
+        broadcast_command(control_udp_socket, b"SYNC_STOP")
+        log("UDP", "Đã phát SYNC_STOP do đạt giới hạn frame.")
+    except Exception as e:
+        log("UDP", f"Lỗi khi gửi SYNC_STOP: {e}")
+
+
+def update_preview(cam_name, image_data, buffer, timestamp_ns):
+    """
+    Thay frame mới nhất của camera cho preview. Buffer pool / bytes được giữ nguyên (không
+    copy); memoryview vào buffer của receiver (WRITER_THREADS=0) bị ghi đè ở frame sau nên
+    chỉ copy khi camera đang có người xem.
+    """
+    if buffer is not None or isinstance(image_data, bytes):
+        preview_cache.update(cam_name, image_data, buffer, timestamp_ns)
+    elif preview_cache.watched(cam_name):
+        preview_cache.update(cam_name, bytes(image_data), None, timestamp_ns)
+
+
+# ---------- Phiên ghi ----------
+
+def session_devices():
+    """Thiết bị đang kết nối (ghi vào manifest khi mở phiên)."""
+    estimates = clock_sync.estimates() if clock_sync is not None else {}
+    with devices_lock:
+        items = [dict(devices[d_id]) for d_id in list(control_clients) if d_id in devices]
+    for item in items:
+        item.pop('address', None)
+        estimate = estimates.get(item['deviceId'])
+        if estimate is not None:
+            # offset thô (đồng hồ thiết bị - server) chỉ để quy đổi offline; độ tin cậy xem 3 trường sau
+            item['clockOffsetMs'] = round(estimate.offset_ns / 1e6, 3)
+            item['clockUncertaintyMs'] = round(estimate.uncertainty_ns / 1e6, 3)
+            item['clockResidualMs'] = round(estimate.residual_ns / 1e6, 3)
+            item['clockDriftPpm'] = round(estimate.drift_ppm, 3)
+    return items
+
+
+def remember_drop_baseline(session):
+    if frame_writer is not None:
+        session_drop_baseline[session.id] = frame_writer.stats()['dropped']
+
+
+def open_live_alignment(session):
+    """ALIGN_LIVE: aligner riêng cho phiên, tuple ghi ra <phiên>/multiview.jsonl."""
+    out = open(os.path.join(session.path, MULTIVIEW_FILE), 'a', encoding='utf-8')
+    out_lock = threading.Lock()
+
+    def on_tuple(t):
+        frames = {cam: (f[0] if f is not None else None) for cam, f in t.frames.items()}
+        line = json.dumps({"anchorNs": t.anchor_ns, "complete": t.complete, "frames": frames})
+        with out_lock:
+            # frame tới muộn sau khi phiên đã đóng file thì bỏ tuple
+            if not out.closed:
+                out.write(line + '\n')
+
+    def close():
+        with out_lock:
+            out.close()
+
+    live_aligners[session.path] = (StreamingAligner(tolerance_ns=int(ALIGN_TOLERANCE_MS * 1e6), on_tuple=on_tuple),
+                                   close)
+
+
+def close_live_alignment(session):
+    """Phát nốt tuple đang chờ, đóng multiview.jsonl, ghi thống kê ghép vào manifest."""
+    alignment = live_aligners.pop(session.path, None)
+    if alignment is None:
+        return
+    aligner, close = alignment
+    aligner.flush()
+    close()
+    stats = aligner.stats()
+    session.extra["multiView"] = {"file": MULTIVIEW_FILE, "tuples": stats['emitted'],
+                                  "complete": stats['complete'], "missing": stats['missing']}
+
+
+def on_session_open(session):
+    remember_drop_baseline(session)
+    if live_aligners is not None:
+        open_live_alignment(session)
+    if ingest_workers is not None:
+        ingest_workers.broadcast('session_open', session.id, session.path, session.started_ns, session.reason)
+    log("SESSION", f"Mở phiên {session.id} ({session.reason or 'manual'}, {len(session.devices)} thiết bị) "
+                   f"-> {session.path}")
+
+
+def on_session_stop(session):
+    if ingest_workers is not None:
+        ingest_workers.broadcast('session_stop', session.path, session.stopped_ns, session.stop_reason)
+
+
+def close_session_storage(session):
+    """Chờ writer ghi xong frame của phiên, đóng file đang mở, tính số frame writer bỏ trong phiên."""
+    writer = frame_writer
+    baseline = session_drop_baseline.pop(session.id, {})
+    if writer is None:
+        return
+    if not writer.drain(SESSION_DRAIN_TIMEOUT):
+        log("SESSION", f"{session.id}: writer chưa ghi xong sau {SESSION_DRAIN_TIMEOUT:g}s, vẫn đóng phiên.",
+            LOG_WARNING)
+    writer.storage.close_cameras(session.cam_dirs())
+    quarantine.close_cameras(session.cam_dirs())
+    for cam, n in writer.stats()['dropped'].items():
+        if n > baseline.get(cam, 0) and cam in session.cameras:
+            session.count_dropped(cam, n - baseline.get(cam, 0))
+
+
+def collect_worker_session(session):
+    """INGEST_WORKERS: mỗi process ingest đóng phần phiên của mình và trả bộ đếm camera."""
+    finalizing_sessions.add(session.path)
+    try:
+        results = ingest_workers.call_all('finalize_session', session.path, timeout=SESSION_DRAIN_TIMEOUT + 5)
+    finally:
+        finalizing_sessions.discard(session.path)
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            log("SESSION", f"{session.id}: process ingest {index} không trả bộ đếm phiên ({result!r}).", LOG_WARNING)
+            continue
+        session.merge_cameras(*result)
+
+
+def finalize_session(session):
+    """Đóng phiên: chờ writer ghi xong frame của phiên, đóng file đang mở, bổ sung số liệu cho manifest."""
+    if ingest_workers is not None:
+        collect_worker_session(session)
+    else:
+        close_session_storage(session)
+    if live_aligners is not None:
+        close_live_alignment(session)
+
+    # Thiết bị gửi frame trong phiên nhưng không có trong danh sách lúc mở (vd phiên tự mở)
+    known = {d.get('subdir', '').lower() for d in session.devices}
+    with devices_lock:
+        for cam in list(session.cameras):
+            info = devices.get(camera_devices.get(cam))
+            if cam not in known and info is not None:
+                item = dict(info)
+                item.pop('address', None)
+                session.devices.append(item)
+    session.extra.update({"storage": STORAGE_FORMAT, "maxFrames": MAX_FRAMES})
+    if VIDEO_MUX:
+        videos = [os.path.basename(MuxingStorage.video_path(d)) for d in session.cam_dirs()]
+        session.extra["videos"] = sorted(v for v in videos if os.path.exists(os.path.join(session.path, v)))
+
+    totals = session.manifest()['totals']
+    log("SESSION", f"Đóng phiên {session.id}: {totals['frames']} frame ({totals['bytes'] / (1024 * 1024):.1f} MB), "
+                   f"đã ghi {totals['written']}, bỏ {totals['dropped'] + totals['discarded']}, "
+                   f"hỏng {totals['corrupt']}, mất {totals['lost']} ({session.stop_reason}).")
+
+
+sessions.on_open = on_session_open
+sessions.on_stop = on_session_stop
+sessions.on_finalize = finalize_session
+
+
+def start_session(reason):
+    """Mở phiên ghi mới (SYNC_START); phiên trước, nếu còn mở, được đóng."""
+    try:
+        return sessions.open(session_devices(), reason)
+    except OSError as e:
+        log("SESSION", f"Không tạo được thư mục phiên trong {DATA_DIR}: {e}", LOG_ERROR)
+        return None
+
+
+def broadcast_sync_stop(sock, reason):
+    """Dừng phiên ghi hiện tại rồi phát SYNC_STOP tới mọi thiết bị."""
+    session = sessions.stop(reason=reason)
+    if session is not None:
+        log("SESSION", f"Dừng phiên {session.id} ({reason}), đóng sau {SESSION_CLOSE_GRACE:g}s.")
+    broadcast_command(sock, b"SYNC_STOP")
+
+
+def broadcast_command(sock, message_bytes, message_for=None):
+    """
+    Gửi lệnh tới TẤT CẢ client đã đăng ký trong 1 lượt; thiết bị hỗ trợ ACK được gửi lại tới khi xác nhận.
+    message_for(deviceId) -> bytes | None: nội dung riêng cho từng thiết bị (None = bỏ qua thiết bị đó).
+    Trả về CommandDispatch.CommandStatus (None nếu không có thiết bị nào).
+    """
+    targets = []
+    for d_id, d_addr in list(control_clients.items()):
+        payload = message_bytes if message_for is None else message_for(d_id)
+        if payload is not None:
+            targets.append((d_id, d_addr, payload.decode('utf-8')))
+    if not targets:
+        return None
+    if command_dispatcher is None:
+        log("UDP", "Chưa mở UDP control socket – không gửi được lệnh.")
+        return None
+
+    command = message_bytes.decode('utf-8').split(' ', 1)[0]
+    status = command_dispatcher.dispatch(command, targets, sock.sendto if sock is not None else None)
+    log("UDP", f"Đã gửi {command} #{status.command_id} tới {len(targets)} thiết bị "
+               f"(burst {status.burst_spread_ns / 1e6:.3f} ms).")
+    return status
+
+
+def on_command_complete(status):
+    command_burst_seconds.observe(status.burst_spread_ns / 1e9)
+    for d_id, state in status.states().items():
+        delivery = status.deliveries[d_id]
+        if delivery.latency_ns is not None:
+            command_ack_seconds.labels(d_id).observe(delivery.latency_ns / 1e9)
+        elif state in (DELIVERY_LOST, DELIVERY_FAILED):
+            command_lost_total.labels(d_id).inc()
+    log("UDP", status.summary())
+
+
+def client_monitor_loop():
+    """Xoá thiết bị quá CLIENT_TIMEOUT giây không gửi HEARTBEAT / gói điều khiển nào."""
+    while True:
+        time.sleep(1.0)
+        if command_dispatcher is None:
+            continue
+        for d_id in command_dispatcher.expired():
+            log("UDP", f"Phát hiện client CHẾT: {d_id} (không có tín hiệu > {CLIENT_TIMEOUT:g}s). "
+                       f"Đang xóa khỏi danh sách.")
+            control_clients.pop(d_id, None)
+            command_dispatcher.forget(d_id)
+            if rate_controller is not None:
+                rate_controller.remove(d_id)
+
+
+def broadcast_sync_start(sock):
+    """
+    Phát SYNC_START. Nếu SYNC_START_DELAY_MS > 0: chọn thời điểm bắt đầu trong tương lai
+    theo đồng hồ server và gửi 'SYNC_START <device_ns>' đã quy đổi sang đồng hồ từng thiết bị
+    (thiết bị chưa đo đồng hồ nhận SYNC_START thường đúng thời điểm đó).
+    Mỗi SYNC_START mở 1 phiên ghi mới.
+    """
+    start_session('sync_start')
+    if SYNC_START_DELAY_MS <= 0 or clock_sync is None:
+        broadcast_command(sock, b"SYNC_START")
+        return
+
+    start_ns = time.time_ns() + SYNC_START_DELAY_MS * 1_000_000
+    estimates = clock_sync.estimates()
+    legacy = []
+
+    def message_for(d_id):
+        estimate = estimates.get(d_id)
+        if estimate is None:
+            legacy.append(d_id)
+            return None
+        return f"SYNC_START {estimate.server_to_device(start_ns)}".encode('utf-8')
+
+    broadcast_command(sock, b"SYNC_START", message_for=message_for)
+    if legacy:
+        legacy_ids = set(legacy)
+        threading.Timer(
+            max(0.0, (start_ns - time.time_ns()) / 1e9),
+            broadcast_command, args=(sock, b"SYNC_START"),
+            kwargs={"message_for": lambda d_id: b"SYNC_START" if d_id in legacy_ids else None},
+        ).start()
+    log("UDP", f"SYNC_START hẹn sau {SYNC_START_DELAY_MS} ms ({len(estimates)} thiết bị có ước lượng đồng hồ, "
+               f"{len(legacy)} thiết bị nhận lệnh thường).")
+
+
+def clock_sync_loop():
+    """Định kỳ đo lại đồng hồ mọi thiết bị đang có địa chỉ UDP."""
+    while True:
+        time.sleep(CLOCK_SYNC_INTERVAL)
+        if clock_sync is None:
+            continue
+        for d_id, d_addr in list(control_clients.items()):
+            clock_sync.start_round(d_id, d_addr)
+
 
-    if internal_sock is not None:
-        internal_sock.close()
+def set_rate_capability(device_id, message):
+    """CONNECT/REGISTER: thiết bị khai báo "rateControl": 1 (kèm maxFps, jpegQuality) nhận gợi ý tốc độ."""
+    if rate_controller is None:
+        return
+    if not message.get('rateControl'):
+        rate_controller.remove(device_id)
+        return
+    try:
+        fps = float(message.get('maxFps') or 15)
+        quality = int(message.get('jpegQuality') or 80)
+    except (TypeError, ValueError):
+        fps, quality = 15.0, 80
+    rate_controller.set_device(device_id, fps, quality)
+
+
+def rate_control_loop():
+    """Đánh giá tải mỗi RATE_CONTROL_INTERVAL giây và gửi gợi ý RATE tới thiết bị."""
+    while True:
+        time.sleep(RATE_CONTROL_INTERVAL)
+        writer = current_writer()
+        fill = writer.queue_depth() / writer.queue_size if writer is not None and WRITER_THREADS > 0 else 0.0
+        for d_id, target, changed in rate_controller.tick(fill, RATE_CONTROL_INTERVAL):
+            if changed:
+                log("RATE", f"{d_id} -> nấc {target.level}: {target.fps:g} fps, JPEG {target.quality} "
+                            f"(trễ {target.lag_s * 1000:.0f} ms, hàng đợi {fill:.0%}).")
+            addr = control_clients.get(d_id)
+            if addr is None or control_udp_socket is None:
+                continue
+            payload = json.dumps({"type": "RATE", "level": target.level, "fps": target.fps,
+                                  "quality": target.quality}).encode('utf-8')
+            try:
+                control_udp_socket.sendto(payload, addr)
+            except OSError as e:
+                log("RATE", f"Lỗi gửi RATE tới {d_id}: {e}", LOG_WARNING)
 
 
 # ---------- Dynamic device quản lý ----------
 
     """Load devices từ file, đồng thời khởi động TCP server cho mỗi device."""
 def load_devices():
+    """
+    Load devices từ snapshot + journal. Listener TCP KHÔNG được mở ở đây: chỉ mở khi
+    device kết nối lại (CONNECT/REGISTER, xem ensure_camera_listener) nên khởi động
+    nhanh dù registry có hàng nghìn device cũ.
+    """
     global devices, next_dynamic_port
 
-    if not os.path.exists(DEVICES_FILE):
+    try:
+        loaded, skipped = device_journal.load()
+    except Exception as e:
+        log("STATE", f"Không đọc được {DEVICES_FILE}: {e}", LOG_ERROR)
         return
+    if skipped:
+        log("STATE", f"Bỏ qua {skipped} dòng hỏng trong {device_journal.journal_path}.", LOG_WARNING)
+
+    with devices_lock:
+        devices.update(loaded)
+        dedicated = [d.get('port', BASE_CAM_PORT - 1) for d in devices.values() if not d.get('mux')]
+        if dedicated:
+            next_dynamic_port = max(max(dedicated) + 1, BASE_CAM_PORT)
+        for did, item in devices.items():
+            if item.get('subdir'):
+                camera_devices[item['subdir'].lower()] = did
+
+    log("STATE", f"Đã load {len(loaded)} devices từ {DEVICES_FILE} "
+                 f"(+{device_journal.journal_entries} thay đổi trong journal).")
+    for did in loaded:
+        notify_device_changed(did)
+    if device_journal.journal_entries:
+        compact_devices()
+
+
+def notify_device_changed(device_id):
+    """Báo cho device_listeners (không giữ devices_lock; listener phải nhanh, không chặn)."""
+    for listener in list(device_listeners):
+        try:
+            listener(device_id)
+        except Exception as e:
+            log("STATE", f"Lỗi listener device {device_id}: {e}", LOG_WARNING)
+
 
+def save_device(info):
+    """Ghi thay đổi của 1 device vào journal (O(1), không ghi lại cả danh sách) và báo listener."""
     try:
-        with open(DEVICES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            with devices_lock:
-                for item in data:
-                    did = item.get('deviceId')
-                    if not did:
-                        continue
-                    devices[did] = item
-
-                if devices:
-                    max_port = max(d.get('port', BASE_CAM_PORT - 1) for d in devices.values())
-                    next_dynamic_port = max(max_port + 1, BASE_CAM_PORT)
-
-            # Start TCP server cho từng device đã tồn tại
-            for item in data:
-                did = item.get('deviceId')
-                port = item.get('port')
-                subdir = item.get('subdir')
-                if not did or not port or not subdir:
-                    continue
-                cam_dir = os.path.join(DATA_DIR, subdir)
-                if not os.path.exists(cam_dir):
-                    os.makedirs(cam_dir, exist_ok=True)
-
-                cam_name = subdir.lower()
-                with frame_counters_lock:
-                    frame_counters.setdefault(cam_name, 0)
-                if cam_name not in stop_events:
-                    stop_events[cam_name] = threading.Event()
-
-                threading.Thread(target=start_tcp_server, args=(port, cam_dir), daemon=True).start()
-
-            log("STATE", f"Đã load {len(devices)} devices từ {DEVICES_FILE}")
+        with devices_lock:
+            record = dict(info)
+        if device_journal.put(record):
+            compact_devices()
     except Exception as e:
-        log("STATE", f"Không đọc được devices.json: {e}")
+        log("STATE", f"Lỗi khi lưu device {info.get('deviceId')}: {e}", LOG_ERROR)
+    notify_device_changed(info.get('deviceId'))
 
 
-def save_devices():
-    """Ghi danh sách devices ra file JSON."""
+def compact_devices():
+    """Ghi snapshot devices.json đầy đủ (nguyên tử) và làm rỗng journal."""
     try:
         with devices_lock:
-            data = list(devices.values())
-        with open(DEVICES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        log("STATE", f"Đã lưu {len(data)} devices vào {DEVICES_FILE}")
+            data = [dict(d) for d in devices.values()]
+        device_journal.compact(data)
+        log("STATE", f"Đã lưu snapshot {len(data)} devices vào {DEVICES_FILE}")
     except Exception as e:
-        log("STATE", f"Lỗi khi lưu devices.json: {e}")
+        log("STATE", f"Lỗi khi lưu {DEVICES_FILE}: {e}", LOG_ERROR)
+
+
+def ensure_camera_listener(info):
+    """Mở listener TCP riêng cho device nếu chưa mở ở port hiện tại (device dùng cổng chung thì bỏ qua)."""
+    subdir = info.get('subdir')
+    port = info.get('port')
+    if info.get('mux') or not subdir or not port:
+        return
+    cam_name = subdir.lower()
+    with devices_lock:
+        if camera_listeners.get(cam_name) == port:
+            return
+        camera_listeners[cam_name] = port
+    stop_events.setdefault(cam_name, threading.Event())
+    start_camera_listener(port, os.path.join(DATA_DIR, subdir))
 
 
 def sanitize_subdir(name: str) -> str:
@@ -222,29 +1345,47 @@ def sanitize_subdir(name: str) -> str:
     return s or "cam"
 
 
-def register_device(device_id: str, name: str, address) -> dict:
+def register_device(device_id: str, name: str, address, mux: bool = False) -> dict:
     """
     Tạo mới (hoặc lấy lại) device:
-      - Cấp port TCP mới
-      - Tạo folder subdir trong DATA_DIR
-      - Start TCP server nhận ảnh
-      - Lưu vào devices + devices.json
+      - Cấp port TCP mới (hoặc dùng INGEST_PORT chung nếu mux=True: client hỗ trợ handshake)
+      - Đặt subdir (thư mục camera trong mỗi phiên ghi DATA_DIR/<session>/)
+      - Start TCP server nhận ảnh nếu chưa mở (không cần với mux)
+      - Lưu vào devices + journal devices
     """
     global next_dynamic_port
 
     with devices_lock:
-        if device_id in devices:
-            info = devices[device_id]
+        info = devices.get(device_id)
+        # (INGEST_PORT có thể đã đổi sau khi khởi động lại)
+        switched = info is not None and (bool(info.get('mux')) != mux or (mux and info['port'] != INGEST_PORT))
+        if switched:
+            # Client đổi khả năng handshake: chuyển giữa cổng ingest chung và cổng riêng
+            if mux:
+                info['mux'] = True
+                info['port'] = INGEST_PORT
+            else:
+                info.pop('mux', None)
+                info['port'] = next_dynamic_port
+                next_dynamic_port += 1
+
+    if info is not None:
+        ensure_camera_listener(info)
+        if switched:
+            save_device(info)
+            log("STATE", f"Device {device_id} chuyển sang {'cổng ingest chung' if mux else 'cổng riêng'} {info['port']}.")
+        else:
             log("STATE", f"Device đã tồn tại: {info}")
-            return info
+        return info
 
-        port = next_dynamic_port
-        next_dynamic_port += 1
+    with devices_lock:
+        if mux:
+            port = INGEST_PORT
+        else:
+            port = next_dynamic_port
+            next_dynamic_port += 1
 
         subdir = sanitize_subdir(name or device_id)
-        cam_dir = os.path.join(DATA_DIR, subdir)
-        if not os.path.exists(cam_dir):
-            os.makedirs(cam_dir, exist_ok=True)
 
         info = {
             "deviceId": device_id,
@@ -253,36 +1394,72 @@ def register_device(device_id: str, name: str, address) -> dict:
             "subdir": subdir,
             "address": address
         }
+        if mux:
+            info["mux"] = True
         devices[device_id] = info
 
         cam_name = subdir.lower()
-        with frame_counters_lock:
-            frame_counters.setdefault(cam_name, 0)
+        camera_devices[cam_name] = device_id
         if cam_name not in stop_events:
             stop_events[cam_name] = threading.Event()
 
     # Start TCP server ngoài lock
-    threading.Thread(target=start_tcp_server, args=(port, cam_dir), daemon=True).start()
-    save_devices()
+    ensure_camera_listener(info)
+    save_device(info)
     log("STATE", f"Tạo device mới: {info}")
     return info
 
 
+def negotiate_frame_protocol(info, client_version):
+    """
+    Thoả thuận phiên bản header frame TCP khi CONNECT: client gửi 'frameProtocol'
+    (phiên bản cao nhất nó hỗ trợ), server ghi phiên bản dùng chung vào device info
+    trả về. Client cũ không gửi trường này -> giữ header legacy (v1).
+    """
+    try:
+        version = max(1, min(int(client_version or 1), FRAME_PROTOCOL_VERSION))
+    except (TypeError, ValueError):
+        version = 1
+    with devices_lock:
+        changed = info.get('frameProtocol', 1) != version
+        info['frameProtocol'] = version
+    if changed:
+        save_device(info)
+    return version
+
+
 # ---------- UDP Điều khiển ----------
 
 def listen_for_control():
     """
     Lắng nghe các gói tin UDP (JSON) để điều khiển START/STOP/CONNECT/REGISTER.
     """
-    global control_clients, control_udp_socket
+    global control_clients, control_udp_socket, clock_sync, command_dispatcher
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     control_udp_socket = udp_socket
+    command_dispatcher = CommandDispatcher(
+        udp_socket.sendto,
+        retry_interval=COMMAND_RETRY_MS / 1000.0,
+        retries=COMMAND_RETRIES,
+        client_timeout=CLIENT_TIMEOUT,
+        on_complete=on_command_complete,
+    )
+    if CLIENT_TIMEOUT > 0:
+        threading.Thread(target=client_monitor_loop, name="client-monitor", daemon=True).start()
+    if rate_controller is not None:
+        threading.Thread(target=rate_control_loop, name="rate-control", daemon=True).start()
+    if CLOCK_SYNC:
+        clock_sync = ClockSyncService(udp_socket.sendto, samples_per_round=CLOCK_SYNC_SAMPLES)
+        if CLOCK_SYNC_INTERVAL > 0:
+            threading.Thread(target=clock_sync_loop, name="clock-sync", daemon=True).start()
     udp_socket.bind((HOST_IP, CONTROL_PORT))
     log("UDP", f"Server điều khiển đang lắng nghe tại cổng {CONTROL_PORT}")
 
     while True:
         try:
             raw_data, addr = udp_socket.recvfrom(8192)
+            # Thời điểm nhận (t3 của CLOCK_PONG) phải lấy ngay sau recvfrom
+            recv_ns = time.time_ns()
 
             try:
                 decoded_data = raw_data.decode('utf-8')
@@ -306,29 +1483,55 @@ def listen_for_control():
             if device_id not in control_clients or control_clients[device_id] != addr:
                 log("UDP", f"Cập nhật vị trí client: {device_id} -> {addr}")
             control_clients[device_id] = addr
+            command_dispatcher.seen(device_id, heartbeat=msg_type == "HEARTBEAT")
+
+            if msg_type == "ACK":
+                command_dispatcher.handle_ack(device_id, message)
+                continue
+
+            if msg_type == "HEARTBEAT":
+                continue
+
+            if msg_type == "CLOCK_PONG":
+                if clock_sync is not None:
+                    clock_sync.handle_pong(device_id, message, recv_ns)
+                continue
 
             if msg_type == "REGISTER":
                 log("UDP", f"Client {device_id} yêu cầu ĐĂNG KÝ.")
+                with devices_lock:
+                    info = devices.get(device_id)
+                if info is not None:
+                    ensure_camera_listener(info)
+                command_dispatcher.set_ack_capable(device_id, bool(message.get('commandAck')))
+                if 'rateControl' in message:
+                    set_rate_capability(device_id, message)
                 udp_socket.sendto("ACK_REGISTER".encode('utf-8'), addr)
+                if clock_sync is not None:
+                    clock_sync.start_round(device_id, addr)
 
             elif msg_type == "START":
                 log("UDP", f"Nhận lệnh START từ {device_id}. Đang kích hoạt toàn bộ...")
-                response = "SYNC_START".encode('utf-8')
-                broadcast_command(udp_socket, response)
+                broadcast_sync_start(udp_socket)
                 log("UDP", "Đã gửi lệnh SYNC_START tới tất cả client đã đăng ký.")
 
             elif msg_type == "STOP":
                 log("UDP", f"Nhận lệnh STOP từ {device_id}. Đang dừng toàn bộ...")
-                response = "SYNC_STOP".encode('utf-8')
-                broadcast_command(udp_socket, response)
+                broadcast_sync_stop(udp_socket, 'stop')
                 log("UDP", "Đã gửi lệnh SYNC_STOP tới tất cả client đã đăng ký.")
 
             elif msg_type == "CONNECT":
                 # NEW: Tạo device mới + trả về danh sách devices
                 name = message.get('name') or device_id
-                info = register_device(device_id, name, addr)
+                mux = INGEST_PORT > 0 and bool(message.get('ingestHandshake'))
+                info = register_device(device_id, name, addr, mux)
+                command_dispatcher.set_ack_capable(device_id, bool(message.get('commandAck')))
+                set_rate_capability(device_id, message)
+                negotiate_frame_protocol(info, message.get('frameProtocol'))
+                # Chỉ trả về device đang kết nối (registry có thể chứa hàng nghìn device cũ,
+                # vượt giới hạn 1 datagram UDP)
                 with devices_lock:
-                    all_devices = list(devices.values())
+                    all_devices = [devices[d_id] for d_id in list(control_clients) if d_id in devices]
                 resp_bytes = json.dumps(all_devices, ensure_ascii=False).encode('utf-8')
                 udp_socket.sendto(resp_bytes, addr)
                 log("UDP", f"CONNECT từ {device_id} -> tạo/giữ {info}, gửi lại {len(all_devices)} device(s).")
@@ -371,38 +1574,586 @@ def start_tcp_server(port, cam_dir):
         log("INIT", f"Server TCP {cam_name} trên cổng {port} đã dừng.")
 
 
+# ---------- Ingest asyncio (1 event loop cho mọi camera) ----------
+
+def get_ingest_loop():
+    """Trả về event loop ingest dùng chung, khởi động thread chạy loop nếu chưa có."""
+    global ingest_loop
+    with ingest_loop_lock:
+        if ingest_loop is None:
+            loop = asyncio.new_event_loop()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.run_forever()
+
+            threading.Thread(target=run, name="ingest-loop", daemon=True).start()
+            ingest_loop = loop
+            log("INIT", "Đã khởi động event loop ingest (INGEST_MODE=asyncio).")
+        return ingest_loop
+
+
+def close_async_server(cam_name):
+    """Đóng server asyncio của camera (gọi bên trong event loop)."""
+    server = async_servers.pop(cam_name, None)
+    if server is not None:
+        server.close()
+        log("INIT", f"Server TCP {cam_name} (asyncio) đã dừng.")
+
+
+async def handle_tcp_client_async(reader, writer, cam_dir):
+    """
+    Phiên bản asyncio của handle_tcp_client: cùng giao thức (header v1/v2 + N bytes),
+    đọc bằng StreamReader.readexactly và đẩy frame hoàn chỉnh sang tầng lưu trữ
+    (store_frame chạy trong executor nếu có thể chặn: ghi đồng bộ hoặc overflow=block).
+    """
+    cam_name = os.path.basename(cam_dir).lower()
+    addr = writer.get_extra_info('peername')
+    loop = asyncio.get_running_loop()
+    timeline = capture_timelines[cam_name] = CaptureTimeline(lambda: capture_clock_offset(cam_name))
+    m_frames = frames_received_total.labels(cam_name)
+    m_bytes = bytes_received_total.labels(cam_name)
+    m_receive = frame_receive_seconds.labels(cam_name)
+    log("TCP", f"Kết nối MỚI từ {addr} -> camera: {cam_name}")
+    track_connection(cam_name, 1)
+
+    try:
+        while True:
+            event = stop_events.get(cam_name)
+            if event is not None and event.is_set():
+                log("TCP", f"Server camera {cam_name} đã dừng. Đóng kết nối {addr}.")
+                close_async_server(cam_name)
+                break
+
+            try:
+                length_data = await reader.readexactly(4)
+            except asyncio.IncompleteReadError:
+                log("TCP", f"Client {addr} đã đóng kết nối (Không nhận được header).")
+                break
+
+            try:
+                if length_data == FRAME_MAGIC:
+                    header, extra = parse_header_v2(await reader.readexactly(FRAME_HEADER_V2.size))
+                    if extra:
+                        await reader.readexactly(extra)
+                else:
+                    header = FrameHeader(1, 0, None, None, struct.unpack('>I', length_data)[0])
+            except asyncio.IncompleteReadError:
+                log("TCP", f"Client {addr} đã đóng kết nối giữa header.")
+                break
+
+            frame_length = header.length
+            if MAX_FRAME_SIZE > 0 and frame_length > MAX_FRAME_SIZE:
+                frames_oversize_total.labels(cam_name).inc()
+                log("TCP", f"LỖI: Frame {frame_length} bytes vượt MAX_FRAME_SIZE={MAX_FRAME_SIZE}. Đóng kết nối {addr}.")
+                break
+            if logger.enabled("TCP", LOG_DEBUG):
+                log("TCP", f"Chuẩn bị nhận frame kích thước: {frame_length} bytes", LOG_DEBUG)
+
+            started = time.perf_counter()
+            try:
+                data = await reader.readexactly(frame_length)
+            except asyncio.IncompleteReadError as e:
+                frames_short_total.labels(cam_name).inc()
+                log("TCP", f"LỖI: Dữ liệu không đủ. Cần {frame_length}, nhận được {len(e.partial)}. Bỏ qua frame này.")
+                break
+            recv_time_ns = time.time_ns()
+            m_receive.observe(time.perf_counter() - started)
+            m_frames.inc()
+            m_bytes.inc(frame_length)
+
+            try:
+                capture_time_ns = observe_capture(cam_name, timeline, header, recv_time_ns)
+                args = (cam_name, cam_dir, data, None, recv_time_ns, capture_time_ns, header.sequence,
+                        header.flags)
+                if WRITER_THREADS > 0 and WRITER_OVERFLOW != OVERFLOW_BLOCK and MAX_FRAMES <= 0 \
+                        and sessions.current() is not None:
+                    # submit không bao giờ chặn và không thể mở / dừng phiên (mkdir + manifest,
+                    # SYNC_STOP qua UDP) -> gọi thẳng trên event loop
+                    store_frame(*args)
+                else:
+                    await loop.run_in_executor(None, store_frame, *args)
+            except Exception as e:
+                log("TCP", f"Lỗi khi giải mã/lưu ảnh: {e}")
+
+    except ConnectionResetError:
+        log("TCP", f"Client {addr} ngắt kết nối đột ngột (ConnectionReset).")
+    except Exception as e:
+        log("TCP", f"Lỗi không xác định với {addr}: {e}")
+    finally:
+        writer.close()
+        track_connection(cam_name, -1)
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        log("TCP", f"Đã đóng socket với {addr}")
+
+
+async def serve_tcp_port_async(port, cam_dir):
+    """Mở port TCP cho 1 camera trên event loop ingest dùng chung."""
+    cam_name = os.path.basename(cam_dir).lower()
+    event = stop_events.get(cam_name)
+    if event is not None and event.is_set():
+        return
+    try:
+        server = await asyncio.start_server(
+            lambda r, w: handle_tcp_client_async(r, w, cam_dir),
+            HOST_IP, port, reuse_address=True, backlog=5,
+        )
+    except Exception as e:
+        log("INIT", f"Lỗi server TCP {cam_name}: {e}")
+        return
+    async_servers[cam_name] = server
+    log("INIT", f"Đã mở cổng TCP {port} (asyncio) để nhận ảnh vào: {cam_dir} (camera: {cam_name})")
+
+
+def start_camera_listener(port, cam_dir):
+    """Mở listener TCP cho 1 camera theo INGEST_MODE (asyncio hoặc thread), hoặc giao cho process ingest."""
+    if ingest_workers is not None:
+        cam_name = os.path.basename(cam_dir).lower()
+        worker_listeners[cam_name] = (port, cam_dir)
+        ingest_workers.send(ingest_workers.assign(cam_name), 'listen', port, cam_dir)
+        return
+    if INGEST_MODE == 'asyncio':
+        asyncio.run_coroutine_threadsafe(serve_tcp_port_async(port, cam_dir), get_ingest_loop())
+    else:
+        threading.Thread(target=start_tcp_server, args=(port, cam_dir), daemon=True).start()
+
+
+# ---------- Cổng ingest dùng chung (INGEST_PORT) ----------
+
+def resolve_ingest_device(hello):
+    """Handshake -> (trạng thái HANDSHAKE_*, cam_dir của thiết bị)."""
+    if hello is None:
+        return HANDSHAKE_MALFORMED, None
+    if hello.get('token') != AUTH_TOKEN:
+        return HANDSHAKE_BAD_TOKEN, None
+    with devices_lock:
+        info = devices.get(str(hello['deviceId']))
+        subdir = info['subdir'] if info is not None else None
+    if subdir is None:
+        return HANDSHAKE_UNKNOWN_DEVICE, None
+    event = stop_events.get(subdir.lower())
+    if event is not None and event.is_set():
+        return HANDSHAKE_STOPPED, None
+    return HANDSHAKE_OK, os.path.join(DATA_DIR, subdir)
+
+
+def handle_ingest_client(conn, addr):
+    """Đọc handshake trên cổng chung rồi chuyển kết nối cho handle_tcp_client của camera tương ứng."""
+    try:
+        conn.settimeout(INGEST_HANDSHAKE_TIMEOUT)
+        status, cam_dir = resolve_ingest_device(read_handshake(conn))
+        conn.sendall(bytes((status,)))
+        conn.settimeout(None)
+    except (OSError, IncompleteFrameError) as e:
+        log("TCP", f"Handshake từ {addr} lỗi: {e}", LOG_WARNING)
+        conn.close()
+        return
+    if status != HANDSHAKE_OK:
+        log("TCP", f"Từ chối kết nối ingest {addr} (handshake status {status}).", LOG_WARNING)
+        conn.close()
+        return
+    if ingest_workers is not None:
+        hand_off_connection(conn, addr, cam_dir)
+        return
+    handle_tcp_client(conn, addr, cam_dir)
+
+
+def serve_ingest_port():
+    """Listener TCP chung cho mọi thiết bị hỗ trợ handshake (1 thread / kết nối)."""
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        tcp_socket.bind((HOST_IP, INGEST_PORT))
+        tcp_socket.listen(128)
+    except OSError as e:
+        log("INIT", f"Không mở được cổng ingest chung {INGEST_PORT}: {e}", LOG_ERROR)
+        tcp_socket.close()
+        return
+    log("INIT", f"Đã mở cổng ingest chung TCP {INGEST_PORT} (handshake).")
+    while True:
+        try:
+            conn, addr = tcp_socket.accept()
+        except OSError as e:
+            log("INIT", f"Lỗi accept cổng ingest chung: {e}", LOG_ERROR)
+            continue
+        threading.Thread(target=handle_ingest_client, args=(conn, addr), daemon=True).start()
+
+
+async def handle_ingest_client_async(reader, writer):
+    """Phiên bản asyncio của handle_ingest_client."""
+    addr = writer.get_extra_info('peername')
+    try:
+        raw = await asyncio.wait_for(reader.readexactly(HANDSHAKE_HEADER.size), INGEST_HANDSHAKE_TIMEOUT)
+        length = parse_handshake_header(raw)
+        hello = None
+        if length is not None:
+            body = await asyncio.wait_for(reader.readexactly(length), INGEST_HANDSHAKE_TIMEOUT)
+            hello = parse_handshake_body(body)
+        status, cam_dir = resolve_ingest_device(hello)
+        writer.write(bytes((status,)))
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+        log("TCP", f"Handshake từ {addr} lỗi: {e!r}", LOG_WARNING)
+        writer.close()
+        return
+    if status != HANDSHAKE_OK:
+        log("TCP", f"Từ chối kết nối ingest {addr} (handshake status {status}).", LOG_WARNING)
+        writer.close()
+        return
+    await handle_tcp_client_async(reader, writer, cam_dir)
+
+
+async def serve_ingest_port_async():
+    try:
+        await asyncio.start_server(handle_ingest_client_async, HOST_IP, INGEST_PORT,
+                                   reuse_address=True, backlog=128)
+    except Exception as e:
+        log("INIT", f"Không mở được cổng ingest chung {INGEST_PORT}: {e}", LOG_ERROR)
+        return
+    log("INIT", f"Đã mở cổng ingest chung TCP {INGEST_PORT} (asyncio, handshake).")
+
+
+def start_ingest_server():
+    """Mở cổng ingest chung nếu INGEST_PORT > 0."""
+    if INGEST_PORT <= 0:
+        return
+    # ingest nhiều process: process chính chỉ handshake rồi chuyển socket (luôn dùng thread)
+    if INGEST_MODE == 'asyncio' and ingest_workers is None:
+        asyncio.run_coroutine_threadsafe(serve_ingest_port_async(), get_ingest_loop())
+    else:
+        threading.Thread(target=serve_ingest_port, name="ingest-port", daemon=True).start()
+
+
+# ---------- Ingest nhiều process (INGEST_WORKERS > 0) ----------
+
+def current_writer():
+    """Writer để đọc trạng thái (UI, metrics, điều khiển tốc độ): của process này hoặc tổng hợp từ các process ingest."""
+    return ingest_writer if ingest_workers is not None else frame_writer
+
+
+def start_ingest_workers():
+    """Khởi động INGEST_WORKERS process ingest; process chính chỉ còn điều khiển, phiên ghi, UI, metrics."""
+    global ingest_workers
+    ingest_workers = WorkerPool(
+        INGEST_WORKERS, ingest_worker_main,
+        on_message=on_worker_message,
+        on_call=on_worker_call,
+        on_start=on_worker_start,
+        on_exit=lambda index, code: log("INGEST", f"Process ingest {index} thoát bất thường (exit {code}), "
+                                                  f"khởi động lại.", LOG_ERROR),
+        on_error=lambda e, message: log("INGEST", f"Lỗi xử lý tin {message[0]!r} từ process ingest: {e!r}",
+                                        LOG_ERROR),
+    ).start()
+    log("INIT", f"Ingest: {INGEST_WORKERS} process (pid {', '.join(map(str, ingest_workers.pids()))}), "
+                f"camera chia đều theo lượt kết nối.")
+    if ALIGN_LIVE:
+        log("INIT", "ALIGN_LIVE chưa hỗ trợ INGEST_WORKERS > 0 - tắt.", LOG_WARNING)
+    if PREVIEW_PORT > 0:
+        log("INIT", f"Preview (PREVIEW_PORT={PREVIEW_PORT}) chưa hỗ trợ INGEST_WORKERS > 0 - tắt.", LOG_WARNING)
+    return ingest_workers
+
+
+def on_worker_start(index):
+    """Process ingest vừa khởi động (lại): mở lại listener riêng của các camera thuộc process đó."""
+    worker_clock_sent.pop(index, None)
+    # process mới chưa có trạng thái đứng hình của camera
+    for cam_name in list(frozen_cameras):
+        if ingest_workers.owner(cam_name) == index:
+            report_camera_freeze(cam_name, False, *frozen_cameras[cam_name])
+    for cam_name, (port, cam_dir) in list(worker_listeners.items()):
+        if ingest_workers.owner(cam_name) == index:
+            ingest_workers.send(index, 'listen', port, cam_dir)
+
+
+def on_worker_call(index, op, *args):
+    if op == 'open_session':
+        # frame tới khi chưa có phiên (vd server khởi động lại giữa take): như SessionManager.for_frame
+        session = sessions.for_frame(session_devices)
+        if session is None:
+            return None
+        return (session.id, session.path, session.started_ns, session.reason,
+                session.stopped_ns, session.stop_reason)
+    raise ValueError(f"không hỗ trợ {op!r}")
+
+
+def on_worker_message(index, message):
+    kind = message[0]
+    if kind == 'stats':
+        apply_worker_report(index, message[1])
+    elif kind == 'max_frames':
+        _, path, cam_name, count = message
+        session = sessions.find(path)
+        if session is not None:
+            stop_at_max_frames(session, cam_name, count)
+    elif kind == 'freeze':
+        report_camera_freeze(*message[1:])
+
+
+def apply_worker_report(index, report):
+    """Gộp báo cáo định kỳ của process ingest: metrics, trạng thái camera, writer, bộ đếm phiên, tải."""
+    worker_metric_snapshots[index] = report['metrics']
+    for metric in INGEST_METRICS:
+        metric.merge(s.get(metric.name, {}) for s in list(worker_metric_snapshots.values()))
+    camera_last_frame_ns.update(report['lastFrame'])
+    with camera_connections_lock:
+        camera_connections.update(report['connections'])
+    if report['writer'] is not None:
+        ingest_writer.update(index, report['writer'])
+    for path, cameras in report['sessions'].items():
+        session = sessions.find(path)
+        if session is not None and path not in finalizing_sessions:
+            session.merge_cameras(cameras)
+    if rate_controller is not None:
+        for kind, observe in (('lag', rate_controller.observe_ingest_lag),
+                              ('wait', rate_controller.observe_queue_wait)):
+            for cam, (total, n) in report['rate'][kind].items():
+                observe(camera_devices.get(cam), total / n, count=n)
+    push_clock_estimates(index)
+
+
+def push_clock_estimates(index):
+    """Gửi ước lượng đồng hồ mới của các camera thuộc process ingest (tính capture time theo đồng hồ server)."""
+    if clock_sync is None:
+        return
+    estimates = clock_sync.estimates()
+    sent = worker_clock_sent.setdefault(index, {})
+    changed = {}
+    for cam_name, d_id in list(camera_devices.items()):
+        estimate = estimates.get(d_id)
+        if estimate is not None and sent.get(cam_name) != estimate.updated_ns \
+                and ingest_workers.owner(cam_name) == index:
+            changed[cam_name] = estimate
+            sent[cam_name] = estimate.updated_ns
+    if changed:
+        ingest_workers.send(index, 'clock', changed)
+
+
+def hand_off_connection(conn, addr, cam_dir):
+    """Cổng chung: chuyển kết nối đã handshake sang process ingest của camera."""
+    index = ingest_workers.assign(os.path.basename(cam_dir).lower())
+    try:
+        ingest_workers.send_socket(index, conn, 'connection', addr, cam_dir)
+    except (OSError, ValueError) as e:
+        log("TCP", f"Không chuyển được kết nối {addr} sang process ingest {index}: {e}", LOG_WARNING)
+    finally:
+        conn.close()
+
+
+# --- Phía process ingest ---
+
+def worker_log_file(index):
+    """LOG_FILE của process ingest: camserver.log -> camserver.ingest1.log (None = chỉ console)."""
+    if not LOG_FILE:
+        return None
+    root, ext = os.path.splitext(LOG_FILE)
+    return f"{root}.ingest{index}{ext}"
+
+
+def add_rate_sample(kind, cam_name, seconds):
+    samples = worker_rate_samples[kind]
+    total = samples.get(cam_name)
+    samples[cam_name] = (seconds, 1) if total is None else (total[0] + seconds, total[1] + 1)
+
+
+def worker_report_loop():
+    """Báo metrics / trạng thái camera / bộ đếm phiên về process chính mỗi INGEST_REPORT_INTERVAL giây."""
+    global worker_rate_samples
+    while True:
+        time.sleep(INGEST_REPORT_INTERVAL)
+        samples, worker_rate_samples = worker_rate_samples, {'lag': {}, 'wait': {}}
+        writer = frame_writer
+        report = {
+            "metrics": {metric.name: metric.snapshot() for metric in INGEST_METRICS},
+            "lastFrame": dict(camera_last_frame_ns),
+            "connections": dict(camera_connections),
+            "writer": writer.stats() if writer is not None else None,
+            "sessions": {s.path: s.cameras_snapshot() for s in sessions.sessions()},
+            "rate": samples,
+        }
+        try:
+            ingest_channel.send('stats', report)
+        except (OSError, ValueError):
+            return
+
+
+def adopt_connection(sock, addr, cam_dir):
+    """Nhận kết nối cổng chung đã handshake ở process chính."""
+    stop_events.setdefault(os.path.basename(cam_dir).lower(), threading.Event())
+    if INGEST_MODE == 'asyncio':
+        asyncio.run_coroutine_threadsafe(handle_adopted_async(sock, cam_dir), get_ingest_loop())
+    else:
+        threading.Thread(target=handle_tcp_client, args=(sock, addr, cam_dir), daemon=True).start()
+
+
+async def handle_adopted_async(sock, cam_dir):
+    reader, writer = await asyncio.open_connection(sock=sock)
+    await handle_tcp_client_async(reader, writer, cam_dir)
+
+
+def finalize_worker_session(path):
+    """Phiên đóng ở process chính: ghi nốt, đóng file của camera trong process này, trả (bộ đếm, thư mục camera)."""
+    session = sessions.find(path)
+    if session is None:
+        return {}, []
+    close_session_storage(session)
+    sessions.pop(path)
+    return session.cameras_snapshot(), session.cam_dirs()
+
+
+def on_supervisor_message(message):
+    kind = message[0]
+    if kind == 'listen':
+        _, port, cam_dir = message
+        stop_events.setdefault(os.path.basename(cam_dir).lower(), threading.Event())
+        start_camera_listener(port, cam_dir)
+    elif kind == 'socket':
+        _, sock, _, addr, cam_dir = message
+        adopt_connection(sock, addr, cam_dir)
+    elif kind == 'session_open':
+        sessions.apply_open(*message[1:])
+    elif kind == 'session_stop':
+        sessions.apply_stop(*message[1:])
+    elif kind == 'clock':
+        camera_clock_estimates.update(message[1])
+    elif kind == 'stop_cameras':
+        for event in stop_events.values():
+            event.set()
+
+
+def on_supervisor_call(op, *args):
+    if op == 'finalize_session':
+        return finalize_worker_session(*args)
+    raise ValueError(f"không hỗ trợ {op!r}")
+
+
+def ingest_worker_main(index, conn):
+    """
+    Điểm vào process ingest (multiprocessing 'spawn' import lại CamServer.py nên cấu hình
+    đọc lại từ cùng environment / .env): nhận TCP và ghi storage cho camera được gán cho
+    index, phiên ghi là bản sao của process chính.
+    """
+    global ingest_channel, sessions, rate_controller, logger, log_prefix
+    # Ctrl+C gửi tới cả nhóm process: process chính đóng phiên rồi mới báo process ingest dừng
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ingest_channel = Channel(conn)
+    logger.close()
+    logger = create_logger(worker_log_file(index))
+    log_prefix = f"[ingest {index}] "
+    # điều khiển tốc độ ở process chính (nhận mẫu độ trễ qua báo cáo định kỳ)
+    rate_controller = None
+    sessions = SessionMirror(
+        close_grace=SESSION_CLOSE_GRACE,
+        request_open=lambda: ingest_channel.call('open_session', timeout=5.0),
+        on_open=remember_drop_baseline,
+    )
+    start_thumbnailer()
+    get_frame_writer()
+    threading.Thread(target=worker_report_loop, name="ingest-report", daemon=True).start()
+    log("INIT", f"Process ingest {index} (pid {os.getpid()}) sẵn sàng.")
+
+    run_worker(ingest_channel, on_supervisor_message, on_supervisor_call,
+               on_error=lambda e, message: log("INGEST", f"Lỗi xử lý tin {message[0]!r}: {e!r}", LOG_ERROR))
+
+    # process chính gửi 'shutdown' hoặc đã thoát
+    for event in stop_events.values():
+        event.set()
+    if frame_writer is not None:
+        frame_writer.stop()
+    if thumbnailer is not None:
+        thumbnailer.close(wait=False)
+    log("INIT", f"Process ingest {index} đã dừng.")
+    logger.close()
+
+
 # ---------- UI Tkinter hiển thị devices ----------
 
+def wait_forever():
+    """Giữ process sống khi không có UI."""
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        log("MAIN", "Ctrl+C — thoát.")
+    if maintenance is not None:
+        maintenance.stop()
+    if ingest_workers is not None:
+        ingest_workers.broadcast('stop_cameras')
+    sessions.close()
+    if ingest_workers is not None:
+        ingest_workers.stop()
+    if frame_writer is not None:
+        frame_writer.stop()
+    if thumbnailer is not None:
+        thumbnailer.close(wait=False)
+    compact_devices()
+    logger.close()
+
+
 def start_ui():
     """UI đơn giản trên PC để xem danh sách device đang config."""
+    if HEADLESS:
+        wait_forever()
+        return
     try:
         import tkinter as tk
         from tkinter import ttk
         import sys
+        import webbrowser
     except Exception as e:
         log("UI", f"Không thể khởi tạo UI Tkinter: {e}")
         # fallback: giữ process sống bằng vòng lặp
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            log("MAIN", "Ctrl+C — thoát.")
+        wait_forever()
         return
 
     root = tk.Tk()
     root.title("Camera PC Server - Connected Devices")
 
-    cols = ("deviceId", "name", "port", "subdir")
+    cols = ("deviceId", "name", "port", "subdir", "state", "fps", "KB/s", "last frame",
+            "clock ± (ms)", "residual (ms)", "drift (ppm)", "ack (ms)", "rate (fps/q)")
     tree = ttk.Treeview(root, columns=cols, show="headings")
+    narrow = {"port", "state", "fps", "KB/s", "last frame"}
     for c in cols:
         tree.heading(c, text=c)
-        tree.column(c, width=150, anchor="w")
+        tree.column(c, width=80 if c in narrow else 150, anchor="w")
+    tree.tag_configure("frozen", background="#ffd6d6")
     tree.pack(fill="both", expand=True)
 
     # --- Thanh trạng thái ---
     status_label = tk.Label(root, text=f"UDP control port: {CONTROL_PORT}", anchor="w")
     status_label.pack(fill="x", padx=5)
 
+    # --- Ảnh thu nhỏ mới nhất của từng camera (THUMBNAILS=1, cần Pillow) ---
+    thumb_frame = None
+    thumb_labels = {}   # camera -> (Label, đường dẫn ảnh đang hiện)
+    if thumbnailer is not None:
+        try:
+            from PIL import Image, ImageTk
+            thumb_frame = tk.Frame(root)
+            thumb_frame.pack(fill="x", padx=5)
+        except Exception as e:
+            log("UI", f"Không hiển thị được ảnh thu nhỏ: {e}", LOG_WARNING)
+
+    def refresh_thumbs():
+        for cam, (_, path) in sorted(thumbnailer.latest().items()):
+            label, shown = thumb_labels.get(cam, (None, None))
+            if path == shown:
+                continue
+            try:
+                with Image.open(path) as img:
+                    img.thumbnail((160, 120))
+                    photo = ImageTk.PhotoImage(img)
+            except OSError:
+                continue
+            if label is None:
+                label = tk.Label(thumb_frame, text=cam, compound="top")
+                label.pack(side="left", padx=2)
+            label.config(image=photo)
+            label.image = photo  # giữ tham chiếu, không thì Tk hiện ảnh trống
+            thumb_labels[cam] = (label, path)
+
     # --- Hàng nút điều khiển START/STOP ---
     button_frame = tk.Frame(root)
     button_frame.pack(fill="x", padx=5, pady=5)
@@ -414,7 +2165,7 @@ def start_ui():
             log("UI", "Không có UDP control socket – chưa có client nào gửi CONNECT/REGISTER?")
             return
         try:
-            broadcast_command(control_udp_socket, b"SYNC_START")
+            broadcast_sync_start(control_udp_socket)
             log("UI", "Đã gửi SYNC_START tới tất cả thiết bị.")
         except Exception as e:
             log("UI", f"Lỗi khi gửi SYNC_START: {e}")
@@ -426,7 +2177,7 @@ def start_ui():
             log("UI", "Không có UDP control socket – chưa có client nào gửi CONNECT/REGISTER?")
             return
         try:
-            broadcast_command(control_udp_socket, b"SYNC_STOP")
+            broadcast_sync_stop(control_udp_socket, 'ui')
             log("UI", "Đã gửi SYNC_STOP tới tất cả thiết bị.")
         except Exception as e:
             log("UI", f"Lỗi khi gửi SYNC_STOP: {e}")
@@ -451,36 +2202,158 @@ def start_ui():
     )
     stop_btn.pack(side="left")
 
+    def on_preview():
+        """Mở trang xem trước live trên trình duyệt."""
+        if preview_server is None:
+            log("UI", "Preview đang tắt (PREVIEW_PORT=0 hoặc INGEST_WORKERS > 0) hoặc không mở được cổng.")
+            return
+        webbrowser.open(f"http://{PREVIEW_HOST}:{PREVIEW_PORT}/")
+
+    preview_btn = tk.Button(
+        button_frame,
+        text="PREVIEW",
+        command=on_preview,
+        width=12
+    )
+    preview_btn.pack(side="left", padx=(5, 0))
+
+    # Hàng thay đổi theo sự kiện registry: listener chỉ đẩy deviceId vào hàng đợi (gọi từ thread mạng),
+    # refresh() lấy ra và cập nhật đúng các hàng đó thay vì xoá / chèn lại cả bảng.
+    changed_ids = queue.SimpleQueue()
+    device_listeners.append(changed_ids.put)
+    for d_id in list(devices):
+        changed_ids.put(d_id)
+    static_values = {}      # deviceId -> (deviceId, name, port, subdir)
+    row_cameras = {}        # deviceId -> cam_name (key của counter theo camera)
+    row_values = {}         # deviceId -> giá trị đang hiện trên Treeview
+    prev_counters = {}      # camera -> (frames, bytes, monotonic) lần refresh trước
+    shown_session = [None]
+
+    def live_columns(d_id, cam_name, clocks, acks, rates, now, now_ns):
+        """Cột live của 1 device từ counter sẵn có (không lấy lock của đường nhận frame)."""
+        frames = frames_received_total.value(cam_name)
+        nbytes = bytes_received_total.value(cam_name)
+        prev = prev_counters.get(cam_name)
+        prev_counters[cam_name] = (frames, nbytes, now)
+        fps = kbps = ""
+        if prev is not None and now > prev[2]:
+            fps = f"{(frames - prev[0]) / (now - prev[2]):.1f}"
+            kbps = f"{(nbytes - prev[1]) / (now - prev[2]) / 1024:.0f}"
+        last_ns = camera_last_frame_ns.get(cam_name)
+        age = (now_ns - last_ns) / 1e9 if last_ns is not None else None
+        if age is not None and age < 2:
+            state = "FROZEN" if cam_name in frozen_cameras else "streaming"
+        elif camera_connections.get(cam_name, 0) > 0:
+            state = "tcp"
+        elif d_id in control_clients:
+            state = "online"
+        else:
+            state = "offline"
+        clock = clocks.get(d_id)
+        rate = rates.get(d_id)
+        return (
+            state,
+            fps,
+            kbps,
+            f"{age:.1f}s" if age is not None else "",
+            f"{clock.rtt_ns / 2e6:.3f}" if clock is not None else "",
+            f"{clock.residual_ns / 1e6:.3f}" if clock is not None else "",
+            f"{clock.drift_ppm:.1f}" if clock is not None else "",
+            f"{acks[d_id] / 1e6:.3f}" if d_id in acks else "",
+            f"{rate.fps:g}/{rate.quality} (L{rate.level})" if rate is not None else "",
+        )
+
     def refresh():
-        with devices_lock:
-            data = list(devices.values())
-
-        # Clear
-        for item in tree.get_children():
-            tree.delete(item)
-
-        for d in data:
-            tree.insert(
-                "",
-                "end",
-                values=(
-                    d.get("deviceId", ""),
-                    d.get("name", ""),
-                    d.get("port", ""),
-                    os.path.join(DATA_DIR, d.get("subdir", "")),
-                ),
-            )
+        clocks = clock_sync.estimates() if clock_sync is not None else {}
+        acks = dict(command_dispatcher.last_latency_ns) if command_dispatcher is not None else {}
+        rates = rate_controller.targets() if rate_controller is not None else {}
+        session = sessions.current()
+
+        writer = current_writer()
+        if writer is not None:
+            status = (f"UDP control port: {CONTROL_PORT} | Writer queue: {writer.queue_depth()}/{writer.queue_size}"
+                      f" | đã ghi: {writer.written} | bỏ: {sum(dict(writer.dropped).values())}")
+            if ingest_workers is not None:
+                status += f" | ingest: {ingest_workers.alive()}/{INGEST_WORKERS} process"
+            if session is not None:
+                status += f" | phiên: {session.id} ({session.total_frames()} frame)"
+            else:
+                status += " | phiên: (chưa ghi)"
+            alignment = live_aligners.get(session.path) if live_aligners and session is not None else None
+            if alignment is not None:
+                al = alignment[0].stats()
+                status += f" | multi-view: {al['complete']}/{al['emitted']} đủ camera"
+            if thumbnailer is not None:
+                ts = thumbnailer.stats()
+                status += f" | ảnh thu nhỏ: {ts['thumbnails']} (bỏ {ts['shed']})"
+            if frozen_cameras:
+                status += f" | ĐỨNG HÌNH: {', '.join(sorted(frozen_cameras))}"
+            status_label.config(text=status)
+        if thumb_frame is not None:
+            refresh_thumbs()
+
+        # Cột tĩnh: chỉ đọc lại device vừa đổi (hoặc tất cả khi đổi phiên: đường dẫn subdir đổi theo)
+        changed = set()
+        while True:
+            try:
+                changed.add(changed_ids.get_nowait())
+            except queue.Empty:
+                break
+        session_path = session.path if session is not None else DATA_DIR
+        if session_path != shown_session[0]:
+            shown_session[0] = session_path
+            changed.update(static_values)
+        for d_id in sorted(changed, key=str):
+            info = devices.get(d_id)
+            if info is None:
+                static_values.pop(d_id, None)
+                row_cameras.pop(d_id, None)
+                row_values.pop(d_id, None)
+                if tree.exists(d_id):
+                    tree.delete(d_id)
+                continue
+            static_values[d_id] = (d_id, info.get("name", ""), info.get("port", ""),
+                                   os.path.join(session_path, info.get("subdir", "")))
+            row_cameras[d_id] = info.get("subdir", "").lower()
+
+        # Cột live: chỉ gọi Treeview cho hàng có giá trị khác lần trước
+        now, now_ns = time.monotonic(), time.time_ns()
+        for d_id, static in static_values.items():
+            values = static + live_columns(d_id, row_cameras[d_id], clocks, acks, rates, now, now_ns)
+            if row_values.get(d_id) == values:
+                continue
+            tags = ("frozen",) if values[len(static)] == "FROZEN" else ()
+            if d_id in row_values:
+                tree.item(d_id, values=values, tags=tags)
+            else:
+                tree.insert("", "end", iid=d_id, values=values, tags=tags)
+            row_values[d_id] = values
         root.after(1000, refresh)  # refresh mỗi 1s
 
     def on_close():
         # 1. Gửi tín hiệu dừng cho các camera
         for ev in stop_events.values():
             ev.set()
-
-        # 2. Lưu lại devices nếu cần
-        save_devices()
-
-        # 3. Destroy UI rồi thoát hẳn
+        if maintenance is not None:
+            maintenance.stop()
+
+        if ingest_workers is not None:
+            ingest_workers.broadcast('stop_cameras')
+
+        # 2. Đóng phiên ghi (manifest), ghi nốt các frame còn trong hàng đợi
+        sessions.close()
+        if ingest_workers is not None:
+            ingest_workers.stop()
+        if frame_writer is not None:
+            frame_writer.stop()
+        if thumbnailer is not None:
+            thumbnailer.close(wait=False)
+
+        # 3. Ghi snapshot devices (gộp journal)
+        compact_devices()
+        logger.close()
+
+        # 4. Destroy UI rồi thoát hẳn
         root.destroy()
         sys.exit(0)
 
@@ -500,10 +2373,38 @@ def main():
     print(f"   IP Hiện tại: {socket.gethostbyname(socket.gethostname())}")
     print(f"   Token: {AUTH_TOKEN}")
     print(f"   UDP Control Port: {CONTROL_PORT}")
+    print(f"   Ingest mode: {INGEST_MODE}"
+          + (f" x {INGEST_WORKERS} process" if INGEST_WORKERS > 0 else ""))
+    print(f"   Ingest port chung: {INGEST_PORT if INGEST_PORT > 0 else 'OFF'}")
+    print(f"   Storage: {STORAGE_FORMAT} (mỗi phiên ghi: {DATA_DIR}/session_<thời gian>/<camera>/)")
+    print(f"   Kiểm tra JPEG: {'ON (frame hỏng -> <camera>/quarantine/)' if FRAME_VALIDATE else 'OFF'}")
+    print(f"   Phát hiện đứng hình: {f'{FREEZE_FRAMES} frame giống nhau' if FREEZE_FRAMES > 0 else 'OFF'}"
+          + (" + perceptual" if freeze_detector is not None and freeze_detector.perceptual else "")
+          + (", dedup storage" if STORAGE_DEDUP else ""))
+    print(f"   Video mux: {'ON (.mkv mỗi camera / phiên)' if VIDEO_MUX else 'OFF'}")
+    print(f"   Ảnh thu nhỏ: {f'1/{THUMB_EVERY_N} frame -> <camera>/thumbs/' if THUMBNAILS else 'OFF'}")
+    print(f"   Preview: {f'http://{PREVIEW_HOST}:{PREVIEW_PORT}/' if preview_cache is not None else 'OFF'}")
+    print(f"   Bảo trì DATA_DIR: {maintenance_summary()}")
+    print(f"   Clock sync: {'ON' if CLOCK_SYNC else 'OFF'} (SYNC_START delay: {SYNC_START_DELAY_MS} ms)")
     print("============================================")
 
-    # Load devices đã lưu (nếu có) & start TCP cho chúng
+    if FREEZE_PERCEPTUAL and not PERCEPTUAL_AVAILABLE:
+        log("INIT", "FREEZE_PERCEPTUAL=1 nhưng chưa cài Pillow (pip install pillow) - chỉ so hash nội dung.",
+            LOG_WARNING)
+
+    # Khởi động writer nền (hoặc các process ingest) trước khi nhận frame
+    if INGEST_WORKERS > 0:
+        start_ingest_workers()
+    else:
+        start_thumbnailer()
+        get_frame_writer()
+    start_metrics_server()
+    start_preview_server()
+    start_maintenance()
+
+    # Load devices đã lưu (nếu có); listener TCP mở khi từng device kết nối lại
     load_devices()
+    start_ingest_server()
 
     # Chạy luồng UDP (Điều khiển)
     threading.Thread(target=listen_for_control, daemon=True).start()
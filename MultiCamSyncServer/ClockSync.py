@@ -0,0 +1,222 @@
+"""
+Ước lượng lệch đồng hồ server <-> thiết bị kiểu NTP qua cổng UDP điều khiển.
+
+Mỗi vòng đo, server gửi nhiều gói CLOCK_PING tới thiết bị:
+    server -> device : {"type": "CLOCK_PING", "id": n, "t0": server_ns}
+    device -> server : {"type": "CLOCK_PONG", "deviceId", "token", "id": n, "t0", "t1", "t2"}
+t1/t2 là thời điểm thiết bị nhận/gửi (đồng hồ monotonic của thiết bị), server ghi t3 khi
+nhận PONG. Với mỗi mẫu:
+    offset = ((t1 - t0) + (t2 - t3)) / 2      (đồng hồ thiết bị - đồng hồ server)
+    rtt    = (t3 - t0) - (t2 - t1)
+Mỗi vòng chỉ giữ mẫu có RTT nhỏ nhất (ít bị nhiễu hàng đợi Wi-Fi nhất). Ước lượng là
+đường thẳng offset theo thời gian khớp qua các vòng gần đây (hồi quy có trọng số 1/RTT²,
+bỏ vòng có RTT quá lớn so với vòng tốt nhất), lấy giá trị tại vòng mới nhất: 1 vòng Wi-Fi
+nhiễu không kéo lệch offset tới RTT/2. Độ bất định: RTT tốt nhất / 2 và residual của phép khớp.
+
+Đồng hồ server là time.time_ns() (cùng đồng hồ dùng cho timestamp frame).
+"""
+import collections
+import json
+import math
+import threading
+import time
+
+# Vòng có RTT > RTT tốt nhất * MAX_RTT_FACTOR + RTT_SLACK_NS coi là nhiễu, không dùng để khớp
+MAX_RTT_FACTOR = 2.0
+RTT_SLACK_NS = 1_000_000
+
+ClockSample = collections.namedtuple('ClockSample', 't0 t1 t2 t3 offset_ns rtt_ns')
+
+
+class ClockEstimate:
+    """Ước lượng đồng hồ của 1 thiết bị: device_ns ≈ server_ns + offset_ns + drift * (server_ns - ref_ns)."""
+    __slots__ = ('offset_ns', 'rtt_ns', 'drift', 'ref_ns', 'rounds', 'updated_ns', 'residual_ns')
+
+    def __init__(self, offset_ns, rtt_ns, drift, ref_ns, rounds, updated_ns, residual_ns=0):
+        self.offset_ns = offset_ns
+        # RTT tốt nhất trong các vòng dùng để khớp (sai số mỗi mẫu <= RTT/2)
+        self.rtt_ns = rtt_ns
+        self.drift = drift
+        self.ref_ns = ref_ns
+        self.rounds = rounds
+        self.updated_ns = updated_ns
+        # độ lệch chuẩn (có trọng số) của các vòng so với đường đã khớp
+        self.residual_ns = residual_ns
+
+    @property
+    def drift_ppm(self):
+        return self.drift * 1e6
+
+    @property
+    def uncertainty_ns(self):
+        """Độ bất định ước lượng: RTT/2 của mẫu tốt nhất + residual của phép khớp."""
+        return self.rtt_ns / 2 + self.residual_ns
+
+    def offset_at(self, server_ns):
+        return self.offset_ns + self.drift * (server_ns - self.ref_ns)
+
+    def server_to_device(self, server_ns):
+        return int(server_ns + self.offset_at(server_ns))
+
+    def device_to_server(self, device_ns):
+        # offset thay đổi rất chậm (drift ~ ppm) nên lấy offset tại ref là đủ cho bước đầu
+        approx = device_ns - self.offset_ns
+        return int(device_ns - self.offset_at(approx))
+
+    def as_dict(self):
+        return {
+            "offset_ms": self.offset_ns / 1e6,
+            "rtt_ms": self.rtt_ns / 1e6,
+            "residual_ms": self.residual_ns / 1e6,
+            "drift_ppm": self.drift_ppm,
+            "rounds": self.rounds,
+            "age_s": (time.time_ns() - self.updated_ns) / 1e9,
+        }
+
+
+def compute_sample(t0, t1, t2, t3):
+    offset = ((t1 - t0) + (t2 - t3)) // 2
+    rtt = (t3 - t0) - (t2 - t1)
+    return ClockSample(t0, t1, t2, t3, offset, rtt)
+
+
+class DeviceClock:
+    """Các mẫu đo của 1 thiết bị và ước lượng hiện tại."""
+
+    def __init__(self, max_rounds=32):
+        # mẫu tốt nhất (min RTT) của mỗi vòng đã xong
+        self.best_per_round = collections.deque(maxlen=max_rounds)
+        self.current_round = []
+        self.estimate = None
+        # đang có vòng đo chạy (REGISTER và vòng định kỳ không được chồng lên nhau)
+        self.in_flight = False
+
+    def add_sample(self, sample):
+        self.current_round.append(sample)
+
+    def finish_round(self):
+        if not self.current_round:
+            return self.estimate
+        best = min(self.current_round, key=lambda s: s.rtt_ns)
+        self.current_round = []
+        self.best_per_round.append(best)
+        self.estimate = self._fit()
+        return self.estimate
+
+    def _fit(self):
+        """
+        Khớp offset = a + drift * (t0 - ref) qua các vòng (trọng số 1/RTT², bỏ vòng RTT lớn),
+        trả về ước lượng tại ref = t0 của vòng mới nhất.
+        """
+        samples = list(self.best_per_round)
+        latest = samples[-1]
+        best_rtt = min(s.rtt_ns for s in samples)
+        limit = best_rtt * MAX_RTT_FACTOR + RTT_SLACK_NS
+        kept = [s for s in samples if s.rtt_ns <= limit]
+        # trừ mốc (số nguyên) trước khi tính bằng float: offset / t0 cỡ 1e18 ns
+        ref, base = latest.t0, latest.offset_ns
+        xs = [s.t0 - ref for s in kept]
+        ys = [s.offset_ns - base for s in kept]
+        ws = [1.0 / max(s.rtt_ns, 1) ** 2 for s in kept]
+        sw = sum(ws)
+        mx = sum(w * x for w, x in zip(ws, xs)) / sw
+        my = sum(w * y for w, y in zip(ws, ys)) / sw
+        drift = 0.0
+        if len(kept) >= 3:
+            sxx = sum(w * (x - mx) ** 2 for w, x in zip(ws, xs))
+            if sxx > 0:
+                drift = sum(w * (x - mx) * (y - my) for w, x, y in zip(ws, xs, ys)) / sxx
+        intercept = my - drift * mx
+        residual = math.sqrt(sum(w * (y - intercept - drift * x) ** 2 for w, x, y in zip(ws, xs, ys)) / sw)
+        return ClockEstimate(base + int(round(intercept)), best_rtt, drift, ref, len(samples), latest.t3,
+                             int(round(residual)))
+
+
+class ClockSyncService:
+    """
+    Điều phối các vòng đo đồng hồ cho mọi thiết bị.
+    send(payload_bytes, addr) gửi datagram qua socket điều khiển.
+    """
+
+    def __init__(self, send, samples_per_round=8, sample_interval=0.03, round_timeout=1.0):
+        self.send = send
+        self.samples_per_round = samples_per_round
+        self.sample_interval = sample_interval
+        self.round_timeout = round_timeout
+        self._clocks = {}
+        self._pending = {}  # ping id -> (device_id, t0)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _clock(self, device_id):
+        clock = self._clocks.get(device_id)
+        if clock is None:
+            clock = self._clocks[device_id] = DeviceClock()
+        return clock
+
+    def run_round(self, device_id, addr):
+        """
+        Gửi samples_per_round gói CLOCK_PING rồi chốt ước lượng (chặn ~ samples * interval + timeout).
+        Thiết bị đang có vòng đo khác chạy thì bỏ qua vòng này, trả về ước lượng hiện có.
+        """
+        with self._lock:
+            clock = self._clock(device_id)
+            if clock.in_flight:
+                return clock.estimate
+            clock.in_flight = True
+        sent = []
+        try:
+            for _ in range(self.samples_per_round):
+                with self._lock:
+                    ping_id = self._next_id
+                    self._next_id += 1
+                    t0 = time.time_ns()
+                    self._pending[ping_id] = (device_id, t0)
+                sent.append(ping_id)
+                msg = json.dumps({"type": "CLOCK_PING", "id": ping_id, "t0": t0}).encode('utf-8')
+                try:
+                    self.send(msg, addr)
+                except OSError:
+                    with self._lock:
+                        self._pending.pop(ping_id, None)
+                time.sleep(self.sample_interval)
+            time.sleep(self.round_timeout)
+            with self._lock:
+                return clock.finish_round()
+        finally:
+            with self._lock:
+                # Bỏ ping không có phản hồi của vòng này
+                for ping_id in sent:
+                    self._pending.pop(ping_id, None)
+                clock.in_flight = False
+
+    def start_round(self, device_id, addr):
+        threading.Thread(target=self.run_round, args=(device_id, addr), name=f"clock-sync-{device_id}",
+                         daemon=True).start()
+
+    def handle_pong(self, device_id, message, t3=None):
+        """Xử lý CLOCK_PONG (gọi từ luồng UDP điều khiển ngay khi nhận gói)."""
+        if t3 is None:
+            t3 = time.time_ns()
+        try:
+            ping_id = int(message['id'])
+            t1 = int(message['t1'])
+            t2 = int(message['t2'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        with self._lock:
+            pending = self._pending.pop(ping_id, None)
+            if pending is None or pending[0] != device_id:
+                return None
+            sample = compute_sample(pending[1], t1, t2, t3)
+            self._clock(device_id).add_sample(sample)
+            return sample
+
+    def estimate(self, device_id):
+        with self._lock:
+            clock = self._clocks.get(device_id)
+            return clock.estimate if clock is not None else None
+
+    def estimates(self):
+        with self._lock:
+            return {did: c.estimate for did, c in self._clocks.items() if c.estimate is not None}
@@ -0,0 +1,262 @@
+"""
+Phát lệnh điều khiển UDP tới nhiều thiết bị có xác nhận (ACK) và gửi lại.
+
+Thiết bị hỗ trợ ACK (khai báo "commandAck": 1 khi CONNECT/REGISTER) nhận lệnh dạng JSON:
+    server -> device : {"type": "COMMAND", "id": n, "cmd": "SYNC_START"}
+    device -> server : {"type": "ACK", "deviceId", "token", "id": n}
+Thiết bị cũ nhận chuỗi lệnh thô như trước (không ACK, không gửi lại).
+Thiết bị phải bỏ qua lệnh trùng id (do server gửi lại khi mất ACK).
+
+Mọi gói của 1 lệnh được dựng sẵn rồi gửi liền 1 lượt để giảm chênh lệch thời điểm
+giữa thiết bị đầu và cuối; các gói chưa có ACK được 1 thread nền gửi lại với
+backoff tăng dần.
+
+Phát hiện client chết dựa trên thời điểm nhận gói gần nhất (HEARTBEAT hoặc bất kỳ
+gói điều khiển nào), không phụ thuộc lỗi socket riêng của Windows.
+"""
+import heapq
+import json
+import threading
+import time
+
+# Trạng thái giao lệnh của từng thiết bị
+DELIVERY_PENDING = 'pending'
+DELIVERY_ACKED = 'acked'
+DELIVERY_LOST = 'lost'
+DELIVERY_UNCONFIRMED = 'unconfirmed'   # thiết bị cũ: đã gửi, không có ACK để xác nhận
+DELIVERY_FAILED = 'failed'             # sendto lỗi
+
+
+class _Delivery:
+    __slots__ = ('device_id', 'addr', 'payload', 'needs_ack', 'first_sent_ns', 'attempts', 'acked_ns', 'state')
+
+    def __init__(self, device_id, addr, payload, needs_ack):
+        self.device_id = device_id
+        self.addr = addr
+        self.payload = payload
+        self.needs_ack = needs_ack
+        self.first_sent_ns = None
+        self.attempts = 0
+        self.acked_ns = None
+        self.state = DELIVERY_PENDING
+
+    @property
+    def latency_ns(self):
+        if self.acked_ns is None or self.first_sent_ns is None:
+            return None
+        return self.acked_ns - self.first_sent_ns
+
+
+class CommandStatus:
+    """Kết quả giao 1 lệnh tới các thiết bị."""
+
+    def __init__(self, command_id, command, send):
+        self.command_id = command_id
+        self.command = command
+        self.send = send
+        self.deliveries = {}
+        self.burst_spread_ns = 0
+        self._done = threading.Event()
+
+    def _check_done(self):
+        if all(d.state != DELIVERY_PENDING for d in self.deliveries.values()):
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Chờ tới khi mọi thiết bị đã ACK hoặc hết lượt gửi lại."""
+        return self._done.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def states(self):
+        return {d_id: d.state for d_id, d in self.deliveries.items()}
+
+    def latencies_ms(self):
+        """{deviceId: độ trễ từ lần gửi đầu tới khi nhận ACK (ms)} của các thiết bị đã ACK."""
+        return {d_id: d.latency_ns / 1e6 for d_id, d in self.deliveries.items() if d.latency_ns is not None}
+
+    def summary(self):
+        states = self.states()
+        acked = [d for d, s in states.items() if s == DELIVERY_ACKED]
+        lost = [d for d, s in states.items() if s in (DELIVERY_LOST, DELIVERY_FAILED)]
+        legacy = [d for d, s in states.items() if s == DELIVERY_UNCONFIRMED]
+        latencies = self.latencies_ms()
+        text = (f"{self.command} #{self.command_id}: {len(acked)} ACK"
+                f", {len(legacy)} không xác nhận, burst {self.burst_spread_ns / 1e6:.3f} ms")
+        if latencies:
+            text += f", trễ ACK max {max(latencies.values()):.2f} ms"
+        if lost:
+            text += f", MẤT: {', '.join(lost)}"
+        return text
+
+
+class CommandDispatcher:
+    """
+    send(payload_bytes, addr): gửi datagram qua socket điều khiển.
+    retry_interval: thời gian chờ ACK trước lần gửi lại đầu tiên (giây), nhân đôi mỗi lần.
+    retries: số lần gửi lại tối đa.
+    client_timeout: quá số giây này không nhận gói nào từ 1 thiết bị đã từng gửi HEARTBEAT
+    thì coi thiết bị đó là chết (0 = tắt).
+    on_complete(status): gọi khi 1 lệnh giao xong (từ thread gửi lại hoặc thread nhận ACK).
+    """
+
+    def __init__(self, send, retry_interval=0.05, retries=3, client_timeout=30.0, on_complete=None):
+        self.send = send
+        self.retry_interval = retry_interval
+        self.retries = retries
+        self.client_timeout = client_timeout
+        self.on_complete = on_complete
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # id khởi tạo theo thời gian: vẫn tăng dần sau khi server khởi động lại (thiết bị bỏ id cũ)
+        self._next_id = time.time_ns() // 1_000_000
+        self._inflight = {}       # command id -> CommandStatus
+        self._retry_heap = []     # (deadline monotonic, command id, deviceId)
+        self._ack_capable = set()
+        self._heartbeat = set()   # thiết bị có gửi HEARTBEAT (mới áp dụng timeout)
+        self._last_seen = {}      # deviceId -> time.monotonic()
+        self.last_latency_ns = {}  # deviceId -> độ trễ ACK gần nhất
+        self._thread = threading.Thread(target=self._retry_loop, name="command-retry", daemon=True)
+        self._thread.start()
+
+    # ---------- Thông tin thiết bị ----------
+
+    def set_ack_capable(self, device_id, capable):
+        with self._lock:
+            if capable:
+                self._ack_capable.add(device_id)
+            else:
+                self._ack_capable.discard(device_id)
+
+    def seen(self, device_id, heartbeat=False):
+        """Ghi nhận vừa nhận gói từ thiết bị (gọi từ luồng UDP điều khiển)."""
+        with self._lock:
+            self._last_seen[device_id] = time.monotonic()
+            if heartbeat:
+                self._heartbeat.add(device_id)
+
+    def expired(self, now=None):
+        """Danh sách thiết bị quá client_timeout không có tín hiệu."""
+        if self.client_timeout <= 0:
+            return []
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [d for d in self._heartbeat
+                    if now - self._last_seen.get(d, now) > self.client_timeout]
+
+    def forget(self, device_id):
+        with self._lock:
+            self._heartbeat.discard(device_id)
+            self._last_seen.pop(device_id, None)
+            self.last_latency_ns.pop(device_id, None)
+
+    # ---------- Gửi lệnh ----------
+
+    def dispatch(self, command, targets, send=None):
+        """
+        Gửi lệnh tới danh sách targets [(deviceId, addr, payload_text)] trong 1 lượt.
+        payload_text là chuỗi lệnh (vd 'SYNC_START' hoặc 'SYNC_START <ns>').
+        Trả về CommandStatus (không chờ ACK).
+        """
+        send = send or self.send
+        with self._lock:
+            command_id = self._next_id
+            self._next_id += 1
+            status = CommandStatus(command_id, command, send)
+            for device_id, addr, text in targets:
+                needs_ack = device_id in self._ack_capable
+                if needs_ack:
+                    payload = json.dumps({"type": "COMMAND", "id": command_id, "cmd": text}).encode('utf-8')
+                else:
+                    payload = text.encode('utf-8')
+                status.deliveries[device_id] = _Delivery(device_id, addr, payload, needs_ack)
+            self._inflight[command_id] = status
+
+        # Gửi liền 1 lượt (không log / không khoá trong vòng lặp)
+        deliveries = list(status.deliveries.values())
+        first = last = None
+        for d in deliveries:
+            d.first_sent_ns = last = time.perf_counter_ns()
+            if first is None:
+                first = last
+            try:
+                send(d.payload, d.addr)
+            except OSError:
+                d.state = DELIVERY_FAILED
+            d.attempts = 1
+        if first is not None:
+            status.burst_spread_ns = last - first
+
+        deadline = time.monotonic() + self.retry_interval
+        with self._cond:
+            for d in deliveries:
+                if d.state != DELIVERY_PENDING:
+                    continue
+                if d.needs_ack:
+                    heapq.heappush(self._retry_heap, (deadline, command_id, d.device_id))
+                else:
+                    d.state = DELIVERY_UNCONFIRMED
+            self._finish_if_done(status)
+            self._cond.notify()
+        return status
+
+    def handle_ack(self, device_id, message, recv_ns=None):
+        """Xử lý ACK (gọi từ luồng UDP điều khiển ngay khi nhận gói)."""
+        recv_ns = time.perf_counter_ns() if recv_ns is None else recv_ns
+        try:
+            command_id = int(message['id'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        with self._lock:
+            status = self._inflight.get(command_id)
+            if status is None:
+                return None
+            d = status.deliveries.get(device_id)
+            if d is None or d.state != DELIVERY_PENDING:
+                return None
+            d.acked_ns = recv_ns
+            d.state = DELIVERY_ACKED
+            self.last_latency_ns[device_id] = d.latency_ns
+            self._finish_if_done(status)
+            return d.latency_ns
+
+    def _finish_if_done(self, status):
+        # gọi khi đang giữ self._lock
+        status._check_done()
+        if status.done and self._inflight.pop(status.command_id, None) is not None:
+            if self.on_complete is not None:
+                threading.Thread(target=self.on_complete, args=(status,), daemon=True).start()
+
+    # ---------- Gửi lại ----------
+
+    def _retry_loop(self):
+        while True:
+            resend = []
+            with self._cond:
+                while not self._retry_heap:
+                    self._cond.wait()
+                deadline, command_id, device_id = self._retry_heap[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._retry_heap)
+                status = self._inflight.get(command_id)
+                d = status.deliveries.get(device_id) if status is not None else None
+                if d is None or d.state != DELIVERY_PENDING:
+                    continue
+                if d.attempts > self.retries:
+                    d.state = DELIVERY_LOST
+                    self._finish_if_done(status)
+                    continue
+                backoff = self.retry_interval * (2 ** d.attempts)
+                d.attempts += 1
+                heapq.heappush(self._retry_heap, (time.monotonic() + backoff, command_id, device_id))
+                resend.append((status.send, d))
+            for send, d in resend:
+                try:
+                    send(d.payload, d.addr)
+                except OSError:
+                    pass
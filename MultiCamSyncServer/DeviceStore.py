@@ -0,0 +1,121 @@
+"""
+Lưu danh sách device bền vững: snapshot devices.json + journal ghi nối tiếp.
+
+    devices.json     snapshot (JSON list như phiên bản cũ, đọc được bằng tay)
+    devices.journal  mỗi dòng 1 thay đổi: {"op": "put", "device": {...}}
+
+Mỗi CONNECT chỉ ghi thêm 1 dòng vào journal (chi phí không phụ thuộc số device đã lưu);
+khi journal dài hơn compact_every dòng (hoặc lúc tắt server) snapshot được ghi lại đầy đủ
+qua file tạm + fsync + os.replace rồi journal được làm rỗng. Crash giữa chừng:
+    - dòng journal cuối ghi dở -> bỏ qua khi load
+    - crash trong lúc ghi snapshot -> snapshot cũ còn nguyên (replace là nguyên tử)
+    - crash sau khi replace, trước khi làm rỗng journal -> replay lại các "put" đã có
+      trong snapshot, kết quả không đổi
+"""
+import json
+import os
+import threading
+
+
+def write_json_atomic(path, data, indent=None):
+    """Ghi JSON ra file tạm cùng thư mục, fsync rồi os.replace (không bao giờ để lại file ghi dở)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # fsync thư mục để bản thân thao tác rename cũng bền (không làm được trên Windows)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class DeviceJournal:
+    """
+    snapshot_path: devices.json; journal_path mặc định <snapshot>.journal bỏ đuôi .json.
+    fsync: fsync journal sau mỗi lần ghi (device mới không bị mất khi mất điện).
+    compact_every: số dòng journal tối đa trước khi ghi lại snapshot.
+    """
+
+    def __init__(self, snapshot_path, journal_path=None, fsync=True, compact_every=1000):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or os.path.splitext(snapshot_path)[0] + '.journal'
+        self.fsync = fsync
+        self.compact_every = compact_every
+        self.journal_entries = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Đọc snapshot + replay journal. Trả về (dict deviceId -> info, số dòng journal hỏng bị bỏ)."""
+        devices = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                for item in data:
+                    if isinstance(item, dict) and item.get('deviceId'):
+                        devices[item['deviceId']] = item
+
+        skipped = 0
+        entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        device = entry['device'] if entry.get('op') == 'put' else None
+                    except (ValueError, KeyError, AttributeError):
+                        skipped += 1
+                        continue
+                    if isinstance(device, dict) and device.get('deviceId'):
+                        devices[device['deviceId']] = device
+                        entries += 1
+        self.journal_entries = entries
+        return devices, skipped
+
+    def _open(self):
+        if self._file is None:
+            directory = os.path.dirname(os.path.abspath(self.journal_path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+        return self._file
+
+    def put(self, device):
+        """Ghi thêm 1 device (mới hoặc đã đổi). Trả về True nếu nên compact."""
+        line = json.dumps({"op": "put", "device": device}, ensure_ascii=False) + "\n"
+        with self._lock:
+            f = self._open()
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self.journal_entries += 1
+            return self.compact_every > 0 and self.journal_entries >= self.compact_every
+
+    def compact(self, devices):
+        """Ghi snapshot đầy đủ (list device) rồi làm rỗng journal."""
+        with self._lock:
+            write_json_atomic(self.snapshot_path, list(devices), indent=2)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(self.journal_path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_entries = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
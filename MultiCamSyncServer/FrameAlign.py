@@ -0,0 +1,351 @@
+"""
+Ghép frame giữa các camera thành bộ đa góc nhìn (multi-view tuple) theo thời gian.
+
+- Offline: lấy 1 camera làm mốc (reference), với mỗi frame mốc tìm frame gần nhất
+  của từng camera khác bằng searchsorted trên mảng timestamp đã sắp xếp; lệch quá
+  tolerance thì coi là thiếu (-1). Vector hoá bằng numpy nếu có, không thì dùng bisect.
+- Live: StreamingAligner nhận frame khi tới và phát tuple ngay khi đủ camera hoặc
+  khi cửa sổ thời gian đã trôi qua.
+- Báo cáo theo camera: tỉ lệ khớp, độ lệch trung bình, drift (ppm) và jitter.
+
+CLI:
+    python FrameAlign.py <session_dir> [--tolerance-ms 100] [--reference cam] [--complete-only] [--csv out.csv]
+"""
+import argparse
+import bisect
+import collections
+import csv
+import os
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # numpy là tuỳ chọn, thiếu thì dùng bản thuần Python
+    np = None
+
+from FrameIndex import INDEX_FILE, FrameIndex
+from FrameWriter import format_frame_time, parse_frame_filename
+
+MISSING = -1
+
+
+# ---------- Nạp timestamp ----------
+
+def load_camera_timestamps(cam_dir):
+    """Timestamp (ns, đã sắp xếp) của 1 camera: từ frames.idx nếu có, không thì từ tên file JPEG."""
+    if os.path.exists(os.path.join(cam_dir, INDEX_FILE)):
+        with FrameIndex(cam_dir) as index:
+            timestamps = index.timestamps()
+        if np is not None:
+            timestamps.sort(kind='stable')
+        else:
+            timestamps.sort()
+        return timestamps
+    timestamps = [ts for ts in (parse_frame_filename(n) for n in os.listdir(cam_dir)) if ts is not None]
+    timestamps.sort()
+    return _as_array(timestamps)
+
+
+def load_session(data_dir, cameras=None):
+    """{ camera: timestamps } cho mọi thư mục camera trong data_dir (hoặc danh sách cameras)."""
+    if cameras is None:
+        cameras = sorted(e.name for e in os.scandir(data_dir) if e.is_dir())
+    result = {}
+    for cam in cameras:
+        timestamps = load_camera_timestamps(os.path.join(data_dir, cam))
+        if len(timestamps):
+            result[cam] = timestamps
+    return result
+
+
+def _as_array(values):
+    if np is not None:
+        return np.asarray(values, dtype=np.int64)
+    return list(values)
+
+
+# ---------- Ghép offline ----------
+
+class AlignmentResult:
+    """
+    Kết quả ghép offline.
+    cameras: thứ tự cột; anchors: timestamp mốc (ns) từng tuple;
+    indices[c][k]: vị trí frame của camera c trong tuple k (MISSING nếu không có);
+    offsets[c][k]: độ lệch timestamp (ns) so với mốc.
+    """
+
+    def __init__(self, cameras, reference, anchors, indices, offsets):
+        self.cameras = cameras
+        self.reference = reference
+        self.anchors = anchors
+        self.indices = indices
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def complete_mask(self):
+        if np is not None:
+            return np.all(np.stack([self.indices[c] for c in self.cameras]) != MISSING, axis=0)
+        return [all(self.indices[c][k] != MISSING for c in self.cameras) for k in range(len(self))]
+
+    def tuples(self):
+        """Duyệt (anchor_ns, { camera: index | None })."""
+        for k in range(len(self)):
+            yield int(self.anchors[k]), {
+                c: (None if self.indices[c][k] == MISSING else int(self.indices[c][k])) for c in self.cameras
+            }
+
+
+def _match_numpy(ref, ts, tolerance_ns):
+    pos = np.searchsorted(ts, ref)
+    left = np.clip(pos - 1, 0, len(ts) - 1)
+    right = np.clip(pos, 0, len(ts) - 1)
+    d_left = np.abs(ref - ts[left])
+    d_right = np.abs(ts[right] - ref)
+    best = np.where(d_right < d_left, right, left)
+    offsets = ts[best] - ref
+    ok = np.abs(offsets) <= tolerance_ns
+    return np.where(ok, best, MISSING), np.where(ok, offsets, 0)
+
+
+def _match_python(ref, ts, tolerance_ns):
+    indices, offsets = [], []
+    n = len(ts)
+    for t in ref:
+        pos = bisect.bisect_left(ts, t)
+        best = None
+        for j in (pos - 1, pos):
+            if 0 <= j < n and (best is None or abs(ts[j] - t) < abs(ts[best] - t)):
+                best = j
+        if best is not None and abs(ts[best] - t) <= tolerance_ns:
+            indices.append(best)
+            offsets.append(ts[best] - t)
+        else:
+            indices.append(MISSING)
+            offsets.append(0)
+    return indices, offsets
+
+
+def align(timestamps, tolerance_ns=100_000_000, reference=None):
+    """
+    Ghép frame của nhiều camera theo camera mốc.
+    timestamps: { camera: dãy timestamp ns đã sắp xếp }.
+    reference: camera làm mốc (mặc định: camera nhiều frame nhất).
+    """
+    cameras = sorted(timestamps)
+    if not cameras:
+        return AlignmentResult([], None, _as_array([]), {}, {})
+    if reference is None:
+        reference = max(cameras, key=lambda c: len(timestamps[c]))
+    ref = _as_array(timestamps[reference])
+    match = _match_numpy if np is not None else _match_python
+    indices, offsets = {}, {}
+    for cam in cameras:
+        ts = _as_array(timestamps[cam])
+        if cam == reference:
+            indices[cam] = np.arange(len(ref)) if np is not None else list(range(len(ref)))
+            offsets[cam] = np.zeros(len(ref), dtype=np.int64) if np is not None else [0] * len(ref)
+        elif len(ts) == 0:
+            indices[cam] = np.full(len(ref), MISSING) if np is not None else [MISSING] * len(ref)
+            offsets[cam] = np.zeros(len(ref), dtype=np.int64) if np is not None else [0] * len(ref)
+        else:
+            indices[cam], offsets[cam] = match(ref, ts, tolerance_ns)
+    return AlignmentResult(cameras, reference, ref, indices, offsets)
+
+
+# ---------- Báo cáo drift / jitter ----------
+
+def _linear_fit(x, y):
+    """Hồi quy tuyến tính y = a*x + b; trả về (a, b, độ lệch chuẩn phần dư)."""
+    n = len(x)
+    if n < 2:
+        return 0.0, (float(y[0]) if n else 0.0), 0.0
+    if np is not None:
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        a, b = np.polyfit(x, y, 1)
+        return float(a), float(b), float(np.std(y - (a * x + b)))
+    mx = sum(x) / n
+    my = sum(y) / n
+    sxx = sum((xi - mx) ** 2 for xi in x)
+    a = sum((xi - mx) * (yi - my) for xi, yi in zip(x, y)) / sxx if sxx else 0.0
+    b = my - a * mx
+    var = sum((yi - (a * xi + b)) ** 2 for xi, yi in zip(x, y)) / n
+    return a, b, var ** 0.5
+
+
+def report(result, timestamps=None):
+    """
+    Thống kê theo camera: matched, match_rate, mean_offset_ms, drift_ppm
+    (độ dốc độ lệch so với mốc), jitter_ms (độ lệch chuẩn phần dư) và
+    interval_jitter_ms (độ lệch chuẩn khoảng cách giữa 2 frame liên tiếp).
+    """
+    stats = {}
+    for cam in result.cameras:
+        idx = result.indices[cam]
+        off = result.offsets[cam]
+        if np is not None:
+            mask = np.asarray(idx) != MISSING
+            x = (np.asarray(result.anchors)[mask] - (result.anchors[0] if len(result) else 0)) / 1e9
+            y = np.asarray(off)[mask]
+            matched = int(mask.sum())
+        else:
+            pairs = [(result.anchors[k], off[k]) for k in range(len(result)) if idx[k] != MISSING]
+            x = [(a - result.anchors[0]) / 1e9 for a, _ in pairs]
+            y = [o for _, o in pairs]
+            matched = len(pairs)
+        slope, intercept, resid = _linear_fit(x, y)
+        entry = {
+            "matched": matched,
+            "match_rate": matched / len(result) if len(result) else 0.0,
+            "mean_offset_ms": (float(sum(y)) / matched / 1e6) if matched else 0.0,
+            "drift_ppm": slope / 1e3,  # ns lệch mỗi giây -> phần triệu
+            "jitter_ms": resid / 1e6,
+        }
+        if timestamps is not None and len(timestamps.get(cam, [])) > 2:
+            ts = timestamps[cam]
+            if np is not None:
+                entry["interval_jitter_ms"] = float(np.std(np.diff(np.asarray(ts)))) / 1e6
+            else:
+                diffs = [b - a for a, b in zip(ts, ts[1:])]
+                mean = sum(diffs) / len(diffs)
+                entry["interval_jitter_ms"] = (sum((d - mean) ** 2 for d in diffs) / len(diffs)) ** 0.5 / 1e6
+        stats[cam] = entry
+    return stats
+
+
+# ---------- Ghép live ----------
+
+MultiViewTuple = collections.namedtuple('MultiViewTuple', 'anchor_ns frames complete')
+
+
+class StreamingAligner:
+    """
+    Ghép live khi frame tới (mỗi camera phải tới theo thứ tự thời gian).
+
+    Frame sớm nhất đang chờ làm mốc; mỗi camera góp frame đầu tiên nằm trong
+    [mốc, mốc + tolerance]. Tuple được phát khi đủ mọi camera đã biết, hoặc khi
+    frame mới nhất đã vượt mốc quá tolerance + max_lateness (camera chậm bị coi là thiếu).
+    on_tuple(MultiViewTuple) với frames = { camera: (timestamp_ns, payload) | None }.
+    """
+
+    def __init__(self, tolerance_ns=100_000_000, max_lateness_ns=500_000_000, on_tuple=None):
+        self.tolerance_ns = tolerance_ns
+        self.max_lateness_ns = max_lateness_ns
+        self.on_tuple = on_tuple
+        self._pending = {}
+        self._latest_ns = None
+        self._lock = threading.Lock()
+        self.emitted = 0
+        self.complete = 0
+        self.missing = collections.Counter()
+
+    def add_camera(self, cam):
+        with self._lock:
+            self._pending.setdefault(cam, collections.deque())
+
+    def remove_camera(self, cam):
+        with self._lock:
+            self._pending.pop(cam, None)
+            ready = self._collect()
+        self._emit(ready)
+
+    def add(self, cam, timestamp_ns, payload=None):
+        with self._lock:
+            self._pending.setdefault(cam, collections.deque()).append((timestamp_ns, payload))
+            if self._latest_ns is None or timestamp_ns > self._latest_ns:
+                self._latest_ns = timestamp_ns
+            ready = self._collect()
+        self._emit(ready)
+
+    def flush(self):
+        """Phát mọi tuple còn đang chờ (dùng khi SYNC_STOP / kết thúc)."""
+        with self._lock:
+            ready = self._collect(force=True)
+        self._emit(ready)
+
+    def _collect(self, force=False):
+        ready = []
+        while True:
+            heads = [(q[0][0], cam) for cam, q in self._pending.items() if q]
+            if not heads:
+                return ready
+            anchor = min(heads)[0]
+            window_end = anchor + self.tolerance_ns
+            frames = {}
+            for cam, q in self._pending.items():
+                frames[cam] = q[0] if q and q[0][0] <= window_end else None
+            complete = all(f is not None for f in frames.values())
+            expired = self._latest_ns - anchor > self.tolerance_ns + self.max_lateness_ns
+            if not (complete or expired or force):
+                return ready
+            for cam, f in frames.items():
+                if f is not None:
+                    self._pending[cam].popleft()
+                else:
+                    self.missing[cam] += 1
+            self.emitted += 1
+            if complete:
+                self.complete += 1
+            ready.append(MultiViewTuple(anchor, frames, complete))
+
+    def _emit(self, ready):
+        if self.on_tuple is not None:
+            for t in ready:
+                self.on_tuple(t)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "emitted": self.emitted,
+                "complete": self.complete,
+                "missing": dict(self.missing),
+                "pending": {cam: len(q) for cam, q in self._pending.items()},
+            }
+
+
+# ---------- CLI ----------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ghép frame đa camera theo thời gian")
+    parser.add_argument('data_dir', help="thư mục phiên ghi (DATA_DIR/<session>) chứa các thư mục camera")
+    parser.add_argument('--tolerance-ms', type=float, default=100.0)
+    parser.add_argument('--reference', help="camera làm mốc (mặc định: camera nhiều frame nhất)")
+    parser.add_argument('--complete-only', action='store_true', help="chỉ xuất tuple đủ mọi camera")
+    parser.add_argument('--csv', help="ghi danh sách tuple ra file CSV")
+    args = parser.parse_args(argv)
+
+    timestamps = load_session(args.data_dir)
+    if not timestamps:
+        print("Không có frame nào.")
+        return 1
+    result = align(timestamps, int(args.tolerance_ms * 1e6), args.reference)
+    complete = result.complete_mask()
+    n_complete = int(sum(complete))
+    print(f"Mốc: {result.reference} | {len(result)} tuple, {n_complete} đủ {len(result.cameras)} camera")
+    for cam, s in report(result, timestamps).items():
+        line = (f"  {cam}: khớp {s['matched']} ({s['match_rate']:.1%}), lệch TB {s['mean_offset_ms']:.2f} ms, "
+                f"drift {s['drift_ppm']:.1f} ppm, jitter {s['jitter_ms']:.2f} ms")
+        if 'interval_jitter_ms' in s:
+            line += f", jitter khoảng frame {s['interval_jitter_ms']:.2f} ms"
+        print(line)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            w = csv.writer(f)
+            w.writerow(['anchor'] + result.cameras)
+            for k, (anchor, frames) in enumerate(result.tuples()):
+                if args.complete_only and not complete[k]:
+                    continue
+                w.writerow([format_frame_time(anchor)] + [
+                    '' if frames[c] is None else format_frame_time(int(timestamps[c][frames[c]]))
+                    for c in result.cameras
+                ])
+        print(f"Đã ghi {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Kiểm tra nhanh payload frame trước khi ghi, không giải mã ảnh:
+
+- JPEG phải bắt đầu bằng SOI (FF D8) và có EOI (FF D9) trong EOI_SEARCH byte cuối
+  (encoder có thể đệm thêm vài byte sau EOI). Trong dữ liệu nén JPEG byte FF luôn được
+  nhồi thành FF 00, nên thiếu EOI ở cuối nghĩa là frame bị cắt.
+- Payload Base64 (cờ FLAG_BASE64 của header v2, hoặc tự nhận dạng: Base64 của FF D8 FF
+  luôn bắt đầu bằng "/9j/") được giải mã rồi mới kiểm tra như trên.
+
+Chỉ đọc vài byte đầu / cuối nên chi phí không phụ thuộc kích thước ảnh (trừ khi phải giải
+mã Base64). Chạy trong writer thread (FrameWriter validator), không chặn thread mạng.
+Frame hỏng được lưu nguyên payload vào <camera>/quarantine/ để kiểm tra sau:
+
+    DATA_DIR/<session>/<camera>/quarantine/bad_%Y%m%d_%H%M%S_%f_<lý do>.bin
+"""
+import binascii
+import collections
+import os
+import threading
+
+from FrameReceiver import FLAG_BASE64
+from FrameWriter import format_frame_time
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+# Base64 của FF D8 FF (SOI + marker kế tiếp)
+BASE64_SOI = b'/9j/'
+EOI_SEARCH = 64
+
+QUARANTINE_DIR = 'quarantine'
+
+# Lý do frame bị loại
+REASON_EMPTY = 'empty'            # payload quá ngắn
+REASON_NO_SOI = 'no_soi'          # không bắt đầu bằng SOI (không phải JPEG)
+REASON_TRUNCATED = 'truncated'    # không thấy EOI ở cuối (frame bị cắt)
+REASON_BASE64 = 'base64'          # payload Base64 nhưng đã tắt giải mã
+REASON_BAD_BASE64 = 'bad_base64'  # Base64 hỏng
+REASONS = (REASON_EMPTY, REASON_NO_SOI, REASON_TRUNCATED, REASON_BASE64, REASON_BAD_BASE64)
+
+
+def check_jpeg(data):
+    """Lý do payload (bytes / memoryview) không phải JPEG hoàn chỉnh, None nếu hợp lệ."""
+    n = len(data)
+    if n < 4:
+        return REASON_EMPTY
+    if data[:2] != SOI:
+        return REASON_NO_SOI
+    if EOI not in bytes(data[max(0, n - EOI_SEARCH):]):
+        return REASON_TRUNCATED
+    return None
+
+
+def is_base64(data, flags=0):
+    return bool(flags & FLAG_BASE64) or data[:4] == BASE64_SOI
+
+
+class FrameValidator:
+    """
+    validator cho FrameWriter: validator(frame) -> None nếu hợp lệ, lý do (REASON_*) nếu hỏng.
+    Payload Base64 được giải mã và thay vào frame.data (frame.flags bỏ FLAG_BASE64),
+    sau đó gọi on_decode(frame). decode_base64=False: coi payload Base64 là hỏng (REASON_BASE64).
+    """
+
+    def __init__(self, decode_base64=True, on_decode=None):
+        self.decode_base64 = decode_base64
+        self.on_decode = on_decode
+
+    def __call__(self, frame):
+        data = frame.data
+        if is_base64(data, frame.flags):
+            if not self.decode_base64:
+                return REASON_BASE64
+            try:
+                data = binascii.a2b_base64(data)
+            except (binascii.Error, ValueError):
+                return REASON_BAD_BASE64
+            frame.data = data
+            frame.flags &= ~FLAG_BASE64
+            if self.on_decode is not None:
+                self.on_decode(frame)
+        return check_jpeg(data)
+
+
+def quarantine_path(cam_dir, timestamp_ns, reason):
+    return os.path.join(cam_dir, QUARANTINE_DIR, f"bad_{format_frame_time(timestamp_ns)}_{reason}.bin")
+
+
+class Quarantine:
+    """
+    Lưu payload frame hỏng vào <camera>/quarantine/, tối đa max_files file cho mỗi thư mục
+    camera (luồng hỏng liên tục không làm đầy đĩa); vượt thì chỉ đếm. max_files=0: chỉ đếm.
+    close_cameras() khi phiên đóng để bộ đếm không lớn dần theo số phiên.
+    """
+
+    def __init__(self, max_files=100):
+        self.max_files = max(0, max_files)
+        self._lock = threading.Lock()
+        self._files = collections.Counter()
+        self.saved = 0
+        self.skipped = 0
+
+    def put(self, frame, reason):
+        """Ghi payload frame (gọi trước khi trả buffer). Trả về đường dẫn, None nếu không lưu."""
+        with self._lock:
+            if self._files[frame.cam_dir] >= self.max_files:
+                self.skipped += 1
+                return None
+            self._files[frame.cam_dir] += 1
+        path = quarantine_path(frame.cam_dir, frame.timestamp_ns, reason)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(frame.data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.saved += 1
+        return path
+
+    def close_cameras(self, cam_dirs):
+        """Phiên đã đóng: bỏ bộ đếm file của các thư mục camera của phiên."""
+        with self._lock:
+            for cam_dir in cam_dirs:
+                self._files.pop(cam_dir, None)
@@ -0,0 +1,428 @@
+"""
+Index frame nhị phân theo camera, đọc bằng mmap + bisect.
+
+Mỗi thư mục camera có:
+    frames.idx    header + các bản ghi cố định 32 bytes:
+                  timestamp ns (i64) | sequence (u64) | file id (u32) | offset (u64) | length (u32)
+    frames.names  tên file segment, 1 dòng / file (file id = số thứ tự dòng)
+sequence là sequence thiết bị (header v2), hoặc bộ đếm nối tiếp của writer với frame legacy.
+File id JPEG_FILE_ID nghĩa là frame nằm trong file JPEG riêng, tên suy ra từ timestamp
+(frame_<timestamp>.jpg), nên chế độ lưu jpeg không làm phình frames.names.
+
+Ingest ghi nối tiếp index (FrameIndexer); FrameIndex mở bằng mmap để tìm frame
+gần thời điểm T trong O(log n) mà không cần liệt kê thư mục.
+
+Timestamp trong index là timestamp thật của frame và thường tăng dần, nhưng không được
+đảm bảo: hiệu chỉnh lại clock offset có thể làm frame sau mang timestamp cũ hơn. Không
+kẹp (clamp) timestamp khi ghi vì tên file JPEG suy ra từ timestamp và các công cụ đọc cần
+thời điểm thật; thay vào đó FrameIndex phát hiện index không đơn điệu khi map và tra cứu
+qua một hoán vị đã sắp xếp theo timestamp (vị trí i luôn là thứ tự theo thời gian).
+
+CLI:
+    python FrameIndex.py rebuild <data_dir | session_dir | cam_dir>
+    python FrameIndex.py lookup  <cam_dir> <YYYYmmdd_HHMMSS_ffffff | epoch giây>
+"""
+import argparse
+import bisect
+import collections
+import mmap
+import os
+import struct
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # numpy là tuỳ chọn (chỉ dùng cho timestamps())
+    np = None
+
+from FrameWriter import format_frame_time, frame_filename, parse_frame_filename, parse_frame_time
+from SegmentStore import SegmentReader, list_segments
+
+INDEX_FILE = 'frames.idx'
+NAMES_FILE = 'frames.names'
+
+INDEX_MAGIC = b'MCFI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHH')
+INDEX_RECORD = struct.Struct('<qQIQI')
+
+JPEG_FILE_ID = 0xFFFFFFFF
+
+FrameRecord = collections.namedtuple('FrameRecord', 'timestamp_ns sequence path offset length')
+
+
+def _read_names(cam_dir):
+    try:
+        with open(os.path.join(cam_dir, NAMES_FILE), 'r', encoding='utf-8') as f:
+            return [line.rstrip('\n') for line in f]
+    except FileNotFoundError:
+        return []
+
+
+# ---------- Ghi index (phía ingest) ----------
+
+class FrameIndexWriter:
+    """Ghi nối tiếp index của 1 camera."""
+
+    def __init__(self, cam_dir):
+        self.cam_dir = cam_dir
+        self.path = os.path.join(cam_dir, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.names = {name: i for i, name in enumerate(_read_names(cam_dir))}
+        self._names_file = None
+        self.next_sequence = 0
+
+        self._file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        size = self._file.seek(0, os.SEEK_END)
+        if size < INDEX_HEADER.size:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_RECORD.size))
+        else:
+            # Cắt bản ghi cuối bị ghi dở (crash giữa chừng)
+            body = (size - INDEX_HEADER.size) // INDEX_RECORD.size * INDEX_RECORD.size
+            self._file.truncate(INDEX_HEADER.size + body)
+            if body:
+                self._file.seek(INDEX_HEADER.size + body - INDEX_RECORD.size)
+                last = INDEX_RECORD.unpack(self._file.read(INDEX_RECORD.size))
+                self.next_sequence = last[1] + 1
+            self._file.seek(0, os.SEEK_END)
+
+    def _file_id(self, name):
+        file_id = self.names.get(name)
+        if file_id is None:
+            if self._names_file is None:
+                self._names_file = open(os.path.join(self.cam_dir, NAMES_FILE), 'a', encoding='utf-8')
+            self._names_file.write(name + '\n')
+            self._names_file.flush()
+            file_id = self.names[name] = len(self.names)
+        return file_id
+
+    def append(self, timestamp_ns, length, file_name=None, offset=0, sequence=None):
+        """Thêm 1 frame. file_name=None: frame là file JPEG riêng. Trả về sequence đã dùng."""
+        with self.lock:
+            if sequence is None:
+                sequence = self.next_sequence
+            file_id = JPEG_FILE_ID if file_name is None else self._file_id(file_name)
+            self._file.write(INDEX_RECORD.pack(timestamp_ns, sequence, file_id, offset, length))
+            self.next_sequence = max(self.next_sequence, sequence + 1)
+            return sequence
+
+    def flush(self):
+        with self.lock:
+            self._file.flush()
+
+    def close(self):
+        with self.lock:
+            for f in (self._file, self._names_file):
+                if f is not None:
+                    try:
+                        f.close()
+                    except Exception:
+                        pass
+
+
+class FrameIndexer:
+    """Quản lý FrameIndexWriter của mọi camera, dùng chung bởi các storage."""
+
+    def __init__(self):
+        self._writers = {}
+        self._lock = threading.Lock()
+
+    def writer(self, cam_dir):
+        with self._lock:
+            w = self._writers.get(cam_dir)
+            if w is None:
+                w = self._writers[cam_dir] = FrameIndexWriter(cam_dir)
+            return w
+
+    def append(self, cam_dir, timestamp_ns, length, file_name=None, offset=0, sequence=None):
+        return self.writer(cam_dir).append(timestamp_ns, length, file_name, offset, sequence)
+
+    def flush(self):
+        with self._lock:
+            writers = list(self._writers.values())
+        for w in writers:
+            w.flush()
+
+    def close_cameras(self, cam_dirs):
+        with self._lock:
+            writers = [self._writers.pop(d) for d in cam_dirs if d in self._writers]
+        for w in writers:
+            w.close()
+
+    def close(self):
+        with self._lock:
+            writers = list(self._writers.values())
+            self._writers = {}
+        for w in writers:
+            w.close()
+
+
+# ---------- Đọc index (mmap) ----------
+
+class _Timestamps:
+    """Dãy timestamp ảo trên mmap để dùng trực tiếp với bisect."""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        return self._index.timestamp_at(i)
+
+
+class FrameIndex:
+    """
+    Đọc index 1 camera qua mmap; tìm kiếm theo timestamp bằng bisect.
+
+    Vị trí i (entry/timestamp_at/read/find...) là thứ tự theo timestamp. Index ghi nối
+    tiếp không đơn điệu (clock offset hiệu chỉnh lại) thì _order giữ hoán vị bản ghi đã
+    sắp xếp ổn định; index đơn điệu (trường hợp thường gặp) không tốn thêm bộ nhớ.
+    """
+
+    def __init__(self, cam_dir):
+        self.cam_dir = cam_dir
+        self.path = os.path.join(cam_dir, INDEX_FILE)
+        self._file = None
+        self._mm = None
+        self._count = 0
+        self._order = None
+        self._names = []
+        self.refresh()
+
+    def refresh(self):
+        """Map lại file (gọi khi index đã được ingest ghi thêm)."""
+        self._unmap()
+        self._names = _read_names(self.cam_dir)
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INDEX_HEADER.size:
+            return
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = INDEX_HEADER.unpack_from(self._mm)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or record_size != INDEX_RECORD.size:
+            self._unmap()
+            raise ValueError(f"{self.path}: không phải frame index hợp lệ")
+        self._count = (size - INDEX_HEADER.size) // INDEX_RECORD.size
+        self._order = self._sorted_order()
+
+    def _raw_timestamps(self):
+        """Timestamp theo thứ tự ghi trong file."""
+        if np is not None:
+            # Mỗi bản ghi 32 bytes, timestamp (int64) là trường đầu tiên
+            records = np.frombuffer(self._mm, dtype=np.int64, offset=INDEX_HEADER.size,
+                                    count=self._count * INDEX_RECORD.size // 8)
+            return records.reshape(self._count, -1)[:, 0].copy()
+        return [self._raw_timestamp(i) for i in range(self._count)]
+
+    def _raw_timestamp(self, record):
+        return struct.unpack_from('<q', self._mm, INDEX_HEADER.size + record * INDEX_RECORD.size)[0]
+
+    def _sorted_order(self):
+        """None nếu timestamp không giảm; không thì hoán vị bản ghi theo timestamp (ổn định)."""
+        if self._count < 2:
+            return None
+        timestamps = self._raw_timestamps()
+        if np is not None:
+            if not (timestamps[1:] < timestamps[:-1]).any():
+                return None
+            return np.argsort(timestamps, kind='stable')
+        if all(a <= b for a, b in zip(timestamps, timestamps[1:])):
+            return None
+        return sorted(range(self._count), key=timestamps.__getitem__)
+
+    def _record(self, i):
+        return i if self._order is None else int(self._order[i])
+
+    def __len__(self):
+        return self._count
+
+    def timestamp_at(self, i):
+        return self._raw_timestamp(self._record(i))
+
+    def timestamps(self):
+        """Toàn bộ timestamp (numpy int64 nếu có numpy, không thì list) theo thứ tự thời gian."""
+        if self._count == 0:
+            return np.zeros(0, dtype=np.int64) if np is not None else []
+        timestamps = self._raw_timestamps()
+        if self._order is None:
+            return timestamps
+        if np is not None:
+            return timestamps[self._order]
+        return [timestamps[r] for r in self._order]
+
+    def entry(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        ts, seq, file_id, offset, length = INDEX_RECORD.unpack_from(
+            self._mm, INDEX_HEADER.size + self._record(i) * INDEX_RECORD.size)
+        if file_id == JPEG_FILE_ID:
+            name = frame_filename(ts)
+        else:
+            name = self._names[file_id]
+        return FrameRecord(ts, seq, os.path.join(self.cam_dir, name), offset, length)
+
+    def find(self, timestamp_ns):
+        """Vị trí đầu tiên có timestamp >= timestamp_ns (bisect_left)."""
+        return bisect.bisect_left(_Timestamps(self), timestamp_ns)
+
+    def nearest(self, timestamp_ns):
+        """Vị trí frame có timestamp gần timestamp_ns nhất (None nếu index rỗng)."""
+        if self._count == 0:
+            return None
+        i = self.find(timestamp_ns)
+        if i == 0:
+            return 0
+        if i == self._count:
+            return i - 1
+        before, after = self.timestamp_at(i - 1), self.timestamp_at(i)
+        return i - 1 if timestamp_ns - before <= after - timestamp_ns else i
+
+    def between(self, start_ns, end_ns):
+        """range các vị trí có start_ns <= timestamp < end_ns."""
+        return range(self.find(start_ns), self.find(end_ns))
+
+    def read(self, i):
+        """Đọc payload của frame thứ i."""
+        record = self.entry(i)
+        with open(record.path, 'rb') as f:
+            f.seek(record.offset)
+            return f.read(record.length)
+
+    def _unmap(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._count = 0
+        self._order = None
+
+    def close(self):
+        self._unmap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---------- Dựng lại index từ dữ liệu đã có ----------
+
+def scan_camera_dir(cam_dir):
+    """Quét file JPEG và segment của 1 camera. Trả về list (timestamp, sequence|None, file_name|None, offset, length)."""
+    items = []
+    for entry in os.scandir(cam_dir):
+        if entry.is_file():
+            ts = parse_frame_filename(entry.name)
+            if ts is not None:
+                items.append((ts, None, None, 0, entry.stat().st_size))
+    for path in list_segments(cam_dir):
+        name = os.path.basename(path)
+        with SegmentReader(path) as reader:
+            for e in reader.entries:
+                items.append((e.timestamp_ns, e.sequence, name, e.offset, e.length))
+    items.sort(key=lambda item: item[0])
+    return items
+
+
+def rebuild_index(cam_dir):
+    """Ghi lại frames.idx / frames.names của 1 camera (atomic: ghi file tạm rồi rename). Trả về số frame."""
+    items = scan_camera_dir(cam_dir)
+    names = {}
+    next_sequence = 0
+    tmp_idx = os.path.join(cam_dir, INDEX_FILE + '.tmp')
+    tmp_names = os.path.join(cam_dir, NAMES_FILE + '.tmp')
+    with open(tmp_idx, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_RECORD.size))
+        for ts, seq, name, offset, length in items:
+            if seq is None:
+                seq = next_sequence
+            next_sequence = max(next_sequence, seq + 1)
+            if name is None:
+                file_id = JPEG_FILE_ID
+            else:
+                file_id = names.setdefault(name, len(names))
+            f.write(INDEX_RECORD.pack(ts, seq, file_id, offset, length))
+    with open(tmp_names, 'w', encoding='utf-8') as f:
+        for name in names:
+            f.write(name + '\n')
+    os.replace(tmp_names, os.path.join(cam_dir, NAMES_FILE))
+    os.replace(tmp_idx, os.path.join(cam_dir, INDEX_FILE))
+    return len(items)
+
+
+def _is_camera_dir(path):
+    for entry in os.scandir(path):
+        if entry.is_file() and (parse_frame_filename(entry.name) is not None or entry.name.startswith('seg_')):
+            return True
+    return False
+
+
+def _camera_dirs(path):
+    """Thư mục camera trong path: chính nó, các thư mục con, hoặc thư mục camera của từng phiên ghi."""
+    if _is_camera_dir(path):
+        return [path]
+    cam_dirs = []
+    for entry in os.scandir(path):
+        if not entry.is_dir():
+            continue
+        if _is_camera_dir(entry.path):
+            cam_dirs.append(entry.path)
+        else:
+            cam_dirs += [e.path for e in os.scandir(entry.path) if e.is_dir() and _is_camera_dir(e.path)]
+    return cam_dirs
+
+
+def _cmd_rebuild(args):
+    cam_dirs = _camera_dirs(args.path)
+    for cam_dir in sorted(cam_dirs):
+        count = rebuild_index(cam_dir)
+        print(f"{cam_dir}: {count} frame")
+
+
+def _parse_time_arg(text):
+    try:
+        return int(float(text) * 1e9)
+    except ValueError:
+        return parse_frame_time(text)
+
+
+def _cmd_lookup(args):
+    with FrameIndex(args.cam_dir) as index:
+        i = index.nearest(_parse_time_arg(args.time))
+        if i is None:
+            print("Index rỗng.")
+            return
+        record = index.entry(i)
+        print(f"#{i} seq={record.sequence} time={format_frame_time(record.timestamp_ns)} "
+              f"file={record.path} offset={record.offset} length={record.length}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index frame theo camera của CamServer")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_rebuild = sub.add_parser('rebuild', help="dựng lại index từ file JPEG/segment đã có")
+    p_rebuild.add_argument('path', help="DATA_DIR, thư mục 1 phiên ghi hoặc thư mục 1 camera")
+    p_rebuild.set_defaults(func=_cmd_rebuild)
+
+    p_lookup = sub.add_parser('lookup', help="tìm frame gần thời điểm nhất")
+    p_lookup.add_argument('cam_dir')
+    p_lookup.add_argument('time', help="YYYYmmdd_HHMMSS_ffffff hoặc epoch giây")
+    p_lookup.set_defaults(func=_cmd_lookup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
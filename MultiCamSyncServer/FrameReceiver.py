@@ -0,0 +1,297 @@
+"""
+Đường nhận frame TCP không copy (zero-copy) cho CamServer.
+
+Giao thức v1 (legacy): 4 bytes (length, big-endian) + N bytes payload.
+Giao thức v2: header có version, bắt đầu bằng magic 'MCF2' (thay cho 4 bytes length):
+    magic (4s) | version (u8) | flags (u8) | header_len (u16)
+    | sequence (u64) | capture_ns (i64, đồng hồ monotonic của thiết bị) | length (u32)
+Magic 'MCF2' nếu đọc như length v1 là ~1.3 GB (> MAX_FRAME_SIZE) nên server phân biệt
+được 2 loại header theo từng frame; header_len > 28 cho phép mở rộng sau này.
+Mỗi kết nối giữ 1 bytearray cấp phát sẵn và đọc thẳng vào đó bằng recv_into,
+frame trả về là memoryview trỏ vào buffer (không copy).
+Khi frame được chuyển sang thread khác (writer nền), payload được đọc vào
+buffer mượn từ BufferPool và trả lại pool sau khi ghi xong.
+
+Cổng ingest dùng chung (INGEST_PORT): trước frame đầu tiên client gửi handshake
+    magic 'MCH1' (4s) | length (u16) | JSON {"deviceId": ..., "token": ...}
+server trả 1 byte trạng thái (HANDSHAKE_*), OK thì các frame tiếp theo như trên.
+"""
+import collections
+import json
+import struct
+import threading
+
+FRAME_HEADER = struct.Struct('>I')
+
+FRAME_MAGIC = b'MCF2'
+FRAME_PROTOCOL_VERSION = 2
+# Phần header v2 sau magic
+FRAME_HEADER_V2 = struct.Struct('>BBHQqI')
+FRAME_HEADER_V2_SIZE = len(FRAME_MAGIC) + FRAME_HEADER_V2.size
+
+# Cờ trong header v2
+FLAG_BASE64 = 0x01  # payload là chuỗi Base64 của ảnh JPEG
+
+# version=1: header legacy (sequence/capture_ns = None)
+FrameHeader = collections.namedtuple('FrameHeader', 'version flags sequence capture_ns length')
+
+
+HANDSHAKE_MAGIC = b'MCH1'
+HANDSHAKE_HEADER = struct.Struct('>4sH')
+HANDSHAKE_MAX_SIZE = 1024
+
+# Byte trạng thái server trả về sau handshake
+HANDSHAKE_OK = 0
+HANDSHAKE_BAD_TOKEN = 1
+HANDSHAKE_UNKNOWN_DEVICE = 2
+HANDSHAKE_STOPPED = 3
+HANDSHAKE_MALFORMED = 4
+
+
+def pack_handshake(device_id, token):
+    body = json.dumps({"deviceId": device_id, "token": token}).encode('utf-8')
+    return HANDSHAKE_HEADER.pack(HANDSHAKE_MAGIC, len(body)) + body
+
+
+def parse_handshake_header(raw):
+    """6 bytes đầu handshake -> độ dài phần JSON, None nếu không đúng magic / quá dài."""
+    magic, length = HANDSHAKE_HEADER.unpack(raw)
+    if magic != HANDSHAKE_MAGIC or length > HANDSHAKE_MAX_SIZE:
+        return None
+    return length
+
+
+def parse_handshake_body(body):
+    """Phần JSON handshake -> dict (None nếu hỏng / thiếu deviceId)."""
+    try:
+        hello = json.loads(bytes(body).decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(hello, dict) or not hello.get('deviceId'):
+        return None
+    return hello
+
+
+def read_handshake(sock):
+    """Đọc handshake từ socket (chặn). Trả về dict hoặc None nếu sai định dạng."""
+    raw = bytearray(HANDSHAKE_HEADER.size)
+    n = recv_exactly_into(sock, memoryview(raw))
+    if n < len(raw):
+        raise IncompleteFrameError(len(raw), n)
+    length = parse_handshake_header(raw)
+    if length is None:
+        return None
+    body = bytearray(length)
+    n = recv_exactly_into(sock, memoryview(body))
+    if n < length:
+        raise IncompleteFrameError(length, n)
+    return parse_handshake_body(body)
+
+
+def parse_header_v2(rest):
+    """Giải mã phần header v2 sau magic. Trả về (FrameHeader, số bytes mở rộng cần bỏ qua)."""
+    version, flags, header_len, sequence, capture_ns, length = FRAME_HEADER_V2.unpack(rest)
+    extra = max(0, header_len - FRAME_HEADER_V2_SIZE)
+    return FrameHeader(version, flags, sequence, capture_ns, length), extra
+
+# Kích thước buffer ban đầu cho mỗi kết nối (tự nới rộng khi gặp frame lớn hơn)
+INITIAL_BUFFER_SIZE = 256 * 1024
+
+
+class FrameTooLargeError(ValueError):
+    """Header báo độ dài frame vượt quá giới hạn cho phép (thường do dữ liệu hỏng)."""
+
+    def __init__(self, frame_length, max_frame_size):
+        super().__init__(f"Frame {frame_length} bytes vượt giới hạn {max_frame_size} bytes")
+        self.frame_length = frame_length
+        self.max_frame_size = max_frame_size
+
+
+class IncompleteFrameError(EOFError):
+    """Client đóng kết nối giữa chừng header hoặc payload."""
+
+    def __init__(self, expected, received):
+        super().__init__(f"Cần {expected} bytes, nhận được {received}")
+        self.expected = expected
+        self.received = received
+
+
+class BufferPool:
+    """
+    Pool bytearray dùng lại giữa tầng nhận mạng và tầng ghi đĩa.
+    Buffer có thêm người giữ (retain, vd cache preview) chỉ về pool sau lần release cuối.
+    """
+
+    def __init__(self, max_buffers=64, min_size=INITIAL_BUFFER_SIZE):
+        self.max_buffers = max_buffers
+        self.min_size = min_size
+        self._free = []
+        self._refs = {}     # id(buffer) -> số người giữ (chỉ buffer đã retain, > 1)
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Lấy 1 buffer có len >= size (cấp phát mới nếu pool không có buffer đủ lớn)."""
+        with self._lock:
+            for i in range(len(self._free) - 1, -1, -1):
+                if len(self._free[i]) >= size:
+                    return self._free.pop(i)
+        return bytearray(max(size, self.min_size))
+
+    def retain(self, buf):
+        """Thêm 1 người giữ buffer (mỗi retain cần 1 release tương ứng)."""
+        with self._lock:
+            self._refs[id(buf)] = self._refs.get(id(buf), 1) + 1
+
+    def release(self, buf):
+        with self._lock:
+            refs = self._refs.pop(id(buf), 1)
+            if refs > 1:
+                if refs > 2:
+                    self._refs[id(buf)] = refs - 1
+                return
+            if len(self._free) < self.max_buffers:
+                self._free.append(buf)
+
+
+def recv_exactly_into(sock, view):
+    """
+    Đọc đúng len(view) bytes vào view bằng recv_into.
+    Trả về số bytes đã nhận (< len(view) nếu client đóng kết nối giữa chừng).
+    """
+    total = 0
+    size = len(view)
+    while total < size:
+        n = sock.recv_into(view[total:], size - total)
+        if n == 0:
+            break
+        total += n
+    return total
+
+
+class FrameReceiver:
+    """
+    Bộ nhận frame cho 1 kết nối TCP.
+
+    recv_frame() trả về memoryview của frame trong buffer nội bộ; view chỉ hợp lệ
+    tới lần gọi recv_frame() tiếp theo.
+    """
+
+    def __init__(self, sock, max_frame_size, initial_size=INITIAL_BUFFER_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._header = bytearray(FRAME_HEADER.size)
+        self._header_view = memoryview(self._header)
+        self._buffer = bytearray(min(initial_size, max_frame_size) if max_frame_size > 0 else initial_size)
+        self._view = memoryview(self._buffer)
+
+    def _ensure_capacity(self, frame_length):
+        if frame_length <= len(self._buffer):
+            return
+        new_size = max(frame_length, len(self._buffer) * 2)
+        if self.max_frame_size > 0:
+            new_size = min(new_size, self.max_frame_size)
+        self._view.release()
+        self._buffer = bytearray(new_size)
+        self._view = memoryview(self._buffer)
+
+    def read_header(self):
+        """
+        Đọc header (v1 hoặc v2). Trả về FrameHeader, hoặc None nếu client đóng kết nối
+        sạch trước header.
+        """
+        received = recv_exactly_into(self.sock, self._header_view)
+        if received == 0:
+            return None
+        if received != FRAME_HEADER.size:
+            raise IncompleteFrameError(FRAME_HEADER.size, received)
+        if self._header == FRAME_MAGIC:
+            rest = bytearray(FRAME_HEADER_V2.size)
+            received = recv_exactly_into(self.sock, memoryview(rest))
+            if received != len(rest):
+                raise IncompleteFrameError(len(rest), received)
+            header, extra = parse_header_v2(rest)
+            if extra:
+                skipped = recv_exactly_into(self.sock, memoryview(bytearray(extra)))
+                if skipped != extra:
+                    raise IncompleteFrameError(extra, skipped)
+        else:
+            header = FrameHeader(1, 0, None, None, FRAME_HEADER.unpack(self._header)[0])
+        if self.max_frame_size > 0 and header.length > self.max_frame_size:
+            raise FrameTooLargeError(header.length, self.max_frame_size)
+        return header
+
+    def read_payload(self, frame_length):
+        """Đọc payload frame_length bytes, trả về memoryview (không copy)."""
+        self._ensure_capacity(frame_length)
+        view = self._view[:frame_length]
+        received = recv_exactly_into(self.sock, view)
+        if received != frame_length:
+            raise IncompleteFrameError(frame_length, received)
+        return view
+
+    def read_payload_pooled(self, frame_length, pool):
+        """
+        Đọc payload vào buffer mượn từ pool (để chuyển quyền sở hữu sang thread khác).
+        Trả về (memoryview, buffer); người nhận phải gọi pool.release(buffer) khi xong.
+        """
+        buf = pool.acquire(frame_length)
+        view = memoryview(buf)[:frame_length]
+        received = recv_exactly_into(self.sock, view)
+        if received != frame_length:
+            view.release()
+            pool.release(buf)
+            raise IncompleteFrameError(frame_length, received)
+        return view, buf
+
+    def recv_frame(self):
+        """Nhận 1 frame hoàn chỉnh. Trả về memoryview hoặc None khi client đóng kết nối."""
+        header = self.read_header()
+        if header is None:
+            return None
+        return self.read_payload(header.length)
+
+
+class CaptureTimeline:
+    """
+    Theo dõi header v2 của 1 kết nối: quy đổi capture_ns (đồng hồ monotonic của
+    thiết bị) sang epoch ns của server, đếm frame mất (nhảy sequence) và đo độ trễ
+    đầu-cuối.
+
+    offset_provider(): trả về độ lệch đồng hồ thiết bị -> server (ns) nếu đã đo được
+    (đồng bộ đồng hồ); nếu không, dùng offset nhỏ nhất quan sát được trên kết nối
+    (tương ứng frame có độ trễ thấp nhất), khi đó latency là độ trễ vượt mức tốt nhất.
+    """
+
+    def __init__(self, offset_provider=None):
+        self.offset_provider = offset_provider
+        self.min_offset_ns = None
+        self.last_sequence = None
+        self.frames = 0
+        self.dropped = 0
+        self.reordered = 0
+        self.last_latency_ns = 0
+        self.max_latency_ns = 0
+
+    def observe(self, header, recv_time_ns):
+        """Cập nhật thống kê; trả về (capture_time_ns theo đồng hồ server, số frame mất trước frame này)."""
+        self.frames += 1
+        gap = 0
+        if self.last_sequence is not None:
+            if header.sequence > self.last_sequence + 1:
+                gap = header.sequence - self.last_sequence - 1
+                self.dropped += gap
+            elif header.sequence <= self.last_sequence:
+                self.reordered += 1
+        if self.last_sequence is None or header.sequence > self.last_sequence:
+            self.last_sequence = header.sequence
+
+        observed = recv_time_ns - header.capture_ns
+        if self.min_offset_ns is None or observed < self.min_offset_ns:
+            self.min_offset_ns = observed
+        offset = self.offset_provider() if self.offset_provider is not None else None
+        if offset is None:
+            offset = self.min_offset_ns
+        capture_time_ns = header.capture_ns + offset
+        self.last_latency_ns = recv_time_ns - capture_time_ns
+        self.max_latency_ns = max(self.max_latency_ns, self.last_latency_ns)
+        return capture_time_ns, gap
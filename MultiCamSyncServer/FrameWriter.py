@@ -0,0 +1,384 @@
+"""
+Tầng ghi đĩa chạy nền cho CamServer.
+
+Thread nhận mạng chỉ đẩy frame vào hàng đợi có giới hạn; một nhóm writer thread
+rút frame theo lô (batch), ghi ra storage và áp dụng chính sách fsync.
+Mỗi camera luôn được ghi bởi cùng 1 writer thread (chia shard theo tên camera)
+nên thứ tự frame trong từng camera được giữ nguyên.
+"""
+import collections
+import datetime
+import os
+import threading
+import time
+import zlib
+
+# Chính sách bền vững dữ liệu
+FSYNC_NONE = 'none'      # để OS tự flush
+FSYNC_BATCH = 'batch'    # fsync 1 lần sau mỗi lô
+FSYNC_FRAME = 'frame'    # fsync sau từng frame
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_BATCH, FSYNC_FRAME)
+
+# Chính sách khi hàng đợi đầy
+OVERFLOW_BLOCK = 'block'              # thread mạng chờ tới khi có chỗ
+OVERFLOW_DROP_OLDEST = 'drop-oldest'  # bỏ frame cũ nhất trong hàng đợi
+OVERFLOW_DROP_NEWEST = 'drop-newest'  # bỏ frame vừa tới
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+
+class Frame:
+    """1 frame đã nhận đủ, chờ ghi đĩa."""
+    __slots__ = ('cam_name', 'cam_dir', 'data', 'recv_time_ns', 'capture_time_ns', 'sequence',
+                 'flags', 'digest', 'buffer', 'enqueue_time')
+
+    def __init__(self, cam_name, cam_dir, data, recv_time_ns=None, buffer=None,
+                 capture_time_ns=None, sequence=None, flags=0):
+        self.cam_name = cam_name
+        self.cam_dir = cam_dir
+        # bytes hoặc memoryview (zero-copy) của payload
+        self.data = data
+        # Thời điểm server nhận đủ frame (epoch, nano giây)
+        self.recv_time_ns = recv_time_ns if recv_time_ns is not None else time.time_ns()
+        # Thời điểm chụp trên thiết bị đã quy đổi sang đồng hồ server (header v2), None nếu legacy
+        self.capture_time_ns = capture_time_ns
+        # Sequence do thiết bị đánh số (header v2), None nếu legacy
+        self.sequence = sequence
+        # Cờ header v2 (FLAG_*), 0 nếu legacy
+        self.flags = flags
+        # Hash nội dung (FreezeDetect.content_digest) nếu đã tính, để storage dedup frame lặp lại
+        self.digest = None
+        # bytearray gốc cần trả lại BufferPool sau khi ghi (None nếu data tự sở hữu bộ nhớ)
+        self.buffer = buffer
+        self.enqueue_time = None
+
+    @property
+    def timestamp_ns(self):
+        """Timestamp dùng cho tên file / segment / index: thời điểm chụp nếu có, không thì thời điểm nhận."""
+        return self.capture_time_ns if self.capture_time_ns is not None else self.recv_time_ns
+
+
+FRAME_TIME_FORMAT = "%Y%m%d_%H%M%S"
+
+
+def format_frame_time(timestamp_ns):
+    """Epoch ns -> '%Y%m%d_%H%M%S_%f' (giờ địa phương), tính bằng số nguyên để không lệch micro giây."""
+    dt = datetime.datetime.fromtimestamp(timestamp_ns // 1_000_000_000)
+    return f"{dt.strftime(FRAME_TIME_FORMAT)}_{(timestamp_ns // 1000) % 1_000_000:06d}"
+
+
+def parse_frame_time(text):
+    """Ngược lại của format_frame_time: '%Y%m%d_%H%M%S_%f' -> epoch ns."""
+    stamp, micros = text.rsplit('_', 1)
+    dt = datetime.datetime.strptime(stamp, FRAME_TIME_FORMAT)
+    return int(time.mktime(dt.timetuple())) * 1_000_000_000 + int(micros) * 1000
+
+
+def frame_filename(timestamp_ns):
+    """Tên file JPEG theo thời điểm nhận: frame_%Y%m%d_%H%M%S_%f.jpg"""
+    return f"frame_{format_frame_time(timestamp_ns)}.jpg"
+
+
+def parse_frame_filename(name):
+    """'frame_%Y%m%d_%H%M%S_%f.jpg' -> epoch ns (None nếu không đúng mẫu)."""
+    if not (name.startswith('frame_') and name.endswith('.jpg')):
+        return None
+    try:
+        return parse_frame_time(name[len('frame_'):-len('.jpg')])
+    except ValueError:
+        return None
+
+
+class JpegFileStorage:
+    """
+    Storage mặc định: mỗi frame 1 file JPEG trong thư mục camera.
+    indexer: FrameIndex.FrameIndexer (tuỳ chọn) để ghi index theo camera.
+    dedup: frame có digest trùng frame trước của camera được lưu bằng hard link tới file
+    trước đó thay vì ghi lại dữ liệu (hệ thống file không hỗ trợ link thì ghi bình thường).
+    """
+
+    def __init__(self, indexer=None, dedup=False):
+        self.indexer = indexer
+        self.dedup = dedup
+        # cam_dir -> (digest, đường dẫn file) frame ghi gần nhất
+        self._last = {}
+        self.deduplicated = 0
+
+    def _link_repeat(self, frame, filepath):
+        """Frame lặp lại y hệt frame trước: tạo hard link. Trả về False nếu phải ghi bình thường."""
+        last = self._last.get(frame.cam_dir)
+        if last is None or frame.digest is None or last[0] != frame.digest:
+            return False
+        try:
+            os.link(last[1], filepath)
+        except OSError:
+            return False
+        self.deduplicated += 1
+        return True
+
+    def write_batch(self, frames, fsync_policy, on_error=None):
+        """Ghi 1 lô frame. Trả về danh sách frame đã ghi thành công."""
+        written = []
+        pending = []
+        try:
+            for frame in frames:
+                try:
+                    filepath = os.path.join(frame.cam_dir, frame_filename(frame.timestamp_ns))
+                    if not (self.dedup and self._link_repeat(frame, filepath)):
+                        f = open(filepath, 'wb')
+                        try:
+                            f.write(frame.data)
+                            f.flush()
+                            if fsync_policy == FSYNC_FRAME:
+                                os.fsync(f.fileno())
+                        except Exception:
+                            f.close()
+                            raise
+                        if fsync_policy == FSYNC_BATCH:
+                            pending.append(f)
+                        else:
+                            f.close()
+                        if self.dedup and frame.digest is not None:
+                            self._last[frame.cam_dir] = (frame.digest, filepath)
+                    written.append(frame)
+                    if self.indexer is not None:
+                        self.indexer.append(frame.cam_dir, frame.timestamp_ns, len(frame.data), sequence=frame.sequence)
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(frame, e)
+            for f in pending:
+                os.fsync(f.fileno())
+        finally:
+            for f in pending:
+                f.close()
+            if self.indexer is not None:
+                self.indexer.flush()
+        return written
+
+    def close_cameras(self, cam_dirs):
+        """Đóng file đang mở của các thư mục camera không còn nhận frame (vd phiên ghi đã đóng)."""
+        for cam_dir in cam_dirs:
+            self._last.pop(cam_dir, None)
+        if self.indexer is not None:
+            self.indexer.close_cameras(cam_dirs)
+
+    def close(self):
+        if self.indexer is not None:
+            self.indexer.close()
+
+
+class _Shard:
+    def __init__(self, capacity):
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.capacity = capacity
+        # số lô đã lấy khỏi hàng đợi nhưng chưa ghi xong
+        self.busy = 0
+
+
+class FrameWriter:
+    """
+    Nhóm writer thread với hàng đợi có giới hạn.
+
+    submit() được gọi từ thread mạng; trả về False nếu frame bị bỏ
+    (drop-newest hoặc writer đã dừng).
+    on_batch(batch, written, write_seconds, dequeue_time): gọi sau mỗi lô (đo thời gian ghi,
+    thời gian chờ trong hàng đợi = dequeue_time - frame.enqueue_time), trước khi trả buffer;
+    lỗi trong on_batch được báo qua on_error(None, e) như lỗi storage.
+    validator(frame): kiểm tra frame trong writer thread trước khi ghi, trả về None nếu hợp lệ
+    (có thể thay frame.data, vd giải mã Base64) hoặc lý do frame hỏng; frame hỏng không ghi
+    xuống storage mà chuyển cho on_reject(frame, reason), trước khi trả buffer.
+    """
+
+    def __init__(self, storage, threads=2, queue_size=256, batch_size=16,
+                 fsync_policy=FSYNC_NONE, overflow_policy=OVERFLOW_BLOCK,
+                 buffer_pool=None, on_error=None, on_batch=None, validator=None, on_reject=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy không hợp lệ: {fsync_policy} (hợp lệ: {', '.join(FSYNC_POLICIES)})")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy không hợp lệ: {overflow_policy} (hợp lệ: {', '.join(OVERFLOW_POLICIES)})")
+        threads = max(1, threads)
+        self.storage = storage
+        self.batch_size = max(1, batch_size)
+        self.fsync_policy = fsync_policy
+        self.overflow_policy = overflow_policy
+        self.buffer_pool = buffer_pool
+        self.on_error = on_error
+        self.on_batch = on_batch
+        self.validator = validator
+        self.on_reject = on_reject
+        self.queue_size = max(threads, queue_size)
+        per_shard = max(1, self.queue_size // threads)
+        self._shards = [_Shard(per_shard) for _ in range(threads)]
+        self._threads = []
+        self._running = False
+
+        self._stats_lock = threading.Lock()
+        self.written = 0
+        self.written_bytes = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        # { cam_name: số frame bị bỏ do hàng đợi đầy }
+        self.dropped = {}
+
+    # ---------- Vòng đời ----------
+
+    def start(self):
+        self._running = True
+        for i, shard in enumerate(self._shards):
+            t = threading.Thread(target=self._run, args=(shard,), name=f"frame-writer-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5.0):
+        """Dừng nhận frame mới, ghi nốt hàng đợi rồi chờ writer thread kết thúc."""
+        self._running = False
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        self.storage.close()
+
+    def drain(self, timeout=10.0):
+        """Chờ mọi frame đã submit trước lúc gọi được ghi xong. Trả về False nếu hết thời gian."""
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            with shard.cond:
+                while shard.items or shard.busy:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._threads:
+                        return False
+                    shard.cond.wait(remaining)
+        return True
+
+    # ---------- Phía thread mạng ----------
+
+    def _shard_for(self, cam_name):
+        return self._shards[zlib.crc32(cam_name.encode('utf-8')) % len(self._shards)]
+
+    def submit(self, frame):
+        if not self._running:
+            self._drop(frame)
+            return False
+        shard = self._shard_for(frame.cam_name)
+        with shard.cond:
+            if len(shard.items) >= shard.capacity:
+                if self.overflow_policy == OVERFLOW_DROP_NEWEST:
+                    self._drop(frame)
+                    return False
+                if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self._drop(shard.items.popleft())
+                else:
+                    while len(shard.items) >= shard.capacity and self._running:
+                        shard.cond.wait()
+                    if not self._running:
+                        self._drop(frame)
+                        return False
+            frame.enqueue_time = time.monotonic()
+            shard.items.append(frame)
+            shard.cond.notify_all()
+        return True
+
+    def write_now(self, frame):
+        """Ghi đồng bộ trong thread gọi (dùng khi không bật writer thread)."""
+        self._write_batch([frame], time.monotonic())
+
+    # ---------- Writer thread ----------
+
+    def _run(self, shard):
+        while True:
+            with shard.cond:
+                while not shard.items and self._running:
+                    shard.cond.wait()
+                if not shard.items:
+                    return
+                batch = [shard.items.popleft() for _ in range(min(self.batch_size, len(shard.items)))]
+                shard.busy += 1
+                # báo cho thread mạng đang chờ (OVERFLOW_BLOCK) là đã có chỗ
+                shard.cond.notify_all()
+            try:
+                self._write_batch(batch, time.monotonic())
+            finally:
+                with shard.cond:
+                    shard.busy -= 1
+                    shard.cond.notify_all()
+
+    def _write_batch(self, batch, dequeue_time):
+        valid = batch if self.validator is None else self._validate(batch)
+        try:
+            written = self.storage.write_batch(valid, self.fsync_policy, self._on_frame_error) if valid else []
+        except Exception as e:
+            written = []
+            if self.on_error is not None:
+                self.on_error(None, e)
+        if self.on_batch is not None:
+            try:
+                self.on_batch(batch, written, time.monotonic() - dequeue_time, dequeue_time)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(None, e)
+        nbytes = sum(len(f.data) for f in written)
+        with self._stats_lock:
+            self.batches += 1
+            self.written += len(written)
+            self.written_bytes += nbytes
+        for frame in batch:
+            self._release(frame)
+
+    def _validate(self, batch):
+        valid = []
+        for frame in batch:
+            try:
+                reason = self.validator(frame)
+            except Exception as e:
+                reason = type(e).__name__
+            if reason is None:
+                valid.append(frame)
+                continue
+            with self._stats_lock:
+                self.rejected += 1
+            if self.on_reject is not None:
+                try:
+                    self.on_reject(frame, reason)
+                except Exception as e:
+                    if self.on_error is not None:
+                        self.on_error(frame, e)
+        return valid
+
+    def _on_frame_error(self, frame, exc):
+        with self._stats_lock:
+            self.failed += 1
+        if self.on_error is not None:
+            self.on_error(frame, exc)
+
+    def _drop(self, frame):
+        with self._stats_lock:
+            self.dropped[frame.cam_name] = self.dropped.get(frame.cam_name, 0) + 1
+        self._release(frame)
+
+    def _release(self, frame):
+        if frame.buffer is not None and self.buffer_pool is not None:
+            self.buffer_pool.release(frame.buffer)
+        frame.buffer = None
+        frame.data = None
+
+    # ---------- Thống kê ----------
+
+    def queue_depth(self):
+        return sum(len(s.items) for s in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "queue_size": self.queue_size,
+                "written": self.written,
+                "written_bytes": self.written_bytes,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "dropped": dict(self.dropped),
+            }
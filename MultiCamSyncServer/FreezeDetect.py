@@ -0,0 +1,126 @@
+"""
+Phát hiện camera đứng hình: pipeline camera trên điện thoại treo thì vẫn gửi lặp lại cùng 1 JPEG.
+
+Mỗi frame (trong writer thread, sau khi kiểm tra JPEG) được băm nhanh bằng crc32 + adler32
+của zlib (~0.3 ms / MB, nhả GIL) và so với frame trước của cùng camera. Tuỳ chọn thêm chữ ký
+perceptual 64 bit (dHash) tính trên ảnh giải mã ở 1/8 kích thước: libjpeg chỉ dùng hệ số DC
+của mỗi khối 8x8 nên rẻ hơn nhiều so với giải mã đầy đủ; 2 frame lệch <= max_distance bit
+coi là gần giống (ảnh đứng hình nhưng encoder nén lại / EXIF đổi timestamp).
+
+Khi camera gửi liên tiếp threshold frame giống hệt (hoặc gần giống), on_change(camera, True,
+match, count) được gọi 1 lần; frame khác đầu tiên sau đó gọi on_change(camera, False, match, count).
+
+frame.digest được gán để storage có thể lưu frame lặp lại y hệt bằng tham chiếu (dedup).
+Chữ ký perceptual cần Pillow (pip install pillow); không có Pillow thì PERCEPTUAL_AVAILABLE = False.
+"""
+import io
+import threading
+import zlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PERCEPTUAL_AVAILABLE = Image is not None
+
+MATCH_IDENTICAL = 'identical'   # mọi frame trong chuỗi giống hệt từng byte
+MATCH_SIMILAR = 'similar'       # có frame chỉ gần giống (chữ ký perceptual)
+
+
+def content_digest(data):
+    """Hash nhanh của payload: (độ dài, crc32, adler32)."""
+    return len(data), zlib.crc32(data), zlib.adler32(data)
+
+
+def perceptual_signature(data, size=8):
+    """dHash size*size bit của JPEG (bytes), giải mã ở 1/8 kích thước. None nếu không đọc được ảnh."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft('L', (max(1, img.width // 8), max(1, img.height // 8)))
+            small = img.convert('L').resize((size + 1, size))
+    except Exception:
+        return None
+    pixels = small.tobytes()
+    bits = 0
+    for y in range(size):
+        row = y * (size + 1)
+        for x in range(size):
+            bits = (bits << 1) | (pixels[row + x] > pixels[row + x + 1])
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class _CameraState:
+    __slots__ = ('digest', 'signature', 'run', 'identical', 'frozen')
+
+    def __init__(self):
+        self.digest = None
+        self.signature = None
+        self.run = 0              # số frame liên tiếp giống nhau (kể cả frame đầu chuỗi)
+        self.identical = True     # chuỗi hiện tại chỉ gồm frame giống hệt
+        self.frozen = False
+
+
+class FreezeDetector:
+    """
+    threshold: số frame liên tiếp giống nhau để báo đứng hình (0 = chỉ băm, không báo).
+    perceptual: so thêm chữ ký perceptual (cần Pillow), max_distance: số bit lệch tối đa.
+    on_change(cam_name, frozen, match, count): camera bắt đầu / hết đứng hình.
+    observe() của cùng 1 camera phải được gọi tuần tự (FrameWriter: 1 camera = 1 writer thread).
+    """
+
+    def __init__(self, threshold=30, perceptual=False, max_distance=4, on_change=None):
+        if perceptual and not PERCEPTUAL_AVAILABLE:
+            raise RuntimeError("Cần Pillow để so chữ ký perceptual (pip install pillow)")
+        self.threshold = max(0, threshold)
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self.on_change = on_change
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def _state(self, cam_name):
+        state = self._cameras.get(cam_name)
+        if state is None:
+            with self._lock:
+                state = self._cameras.setdefault(cam_name, _CameraState())
+        return state
+
+    def observe(self, frame):
+        """Cập nhật trạng thái camera với 1 frame. Trả về True nếu frame giống hệt frame trước."""
+        state = self._state(frame.cam_name)
+        digest = frame.digest = content_digest(frame.data)
+        identical = digest == state.digest
+        similar = identical
+        if self.perceptual and not identical:
+            signature = perceptual_signature(frame.data)
+            similar = (signature is not None and state.signature is not None
+                       and hamming(signature, state.signature) <= self.max_distance)
+            state.signature = signature
+        state.digest = digest
+        if similar:
+            state.run += 1
+            state.identical = state.identical and identical
+        else:
+            if state.frozen:
+                state.frozen = False
+                self._notify(frame.cam_name, False, state)
+            state.run = 1
+            state.identical = True
+        if not state.frozen and self.threshold > 0 and state.run >= self.threshold:
+            state.frozen = True
+            self._notify(frame.cam_name, True, state)
+        return identical
+
+    def _notify(self, cam_name, frozen, state):
+        if self.on_change is not None:
+            self.on_change(cam_name, frozen, MATCH_IDENTICAL if state.identical else MATCH_SIMILAR, state.run)
+
+    def frozen(self):
+        """{camera: (match, số frame)} các camera đang đứng hình."""
+        return {cam: (MATCH_IDENTICAL if s.identical else MATCH_SIMILAR, s.run)
+                for cam, s in list(self._cameras.items()) if s.frozen}
@@ -0,0 +1,341 @@
+"""
+Ingest nhiều process (INGEST_WORKERS > 0): mỗi process con nhận TCP và ghi storage cho
+1 nhóm camera (camera gán cho process đang ít camera nhất lúc mở listener / kết nối đầu
+tiên, giữ cố định tới khi tắt server), process chính (supervisor) giữ cổng điều khiển
+UDP, registry thiết bị, phiên ghi, UI và metrics.
+
+    supervisor                                   process ingest i
+    CONNECT/REGISTER  -> ('listen', port, dir)   mở listener TCP của camera
+    cổng chung: handshake -> ('socket', ...)     nhận socket đã handshake
+    mở / dừng phiên   -> ('session_open' ...)    phiên bản sao (đếm frame, MAX_FRAMES)
+    dừng phiên + SYNC_STOP <- ('max_frames' ...) camera đạt MAX_FRAMES
+    đóng phiên: call('finalize_session') ->      chờ writer, đóng file, trả bộ đếm
+    metrics, trạng thái camera <- ('stats', {...}) mỗi report_interval giây
+
+Trao đổi qua multiprocessing Pipe (pickle). Socket chuyển sang process con bằng
+socket.share() trên Windows, SCM_RIGHTS (multiprocessing.reduction) trên POSIX.
+Process con tạo bằng context 'spawn' (giống nhau trên mọi OS, không kế thừa thread /
+lock của supervisor) và được khởi động lại nếu chết bất thường.
+"""
+import collections
+import itertools
+import multiprocessing
+import socket
+import threading
+import time
+from multiprocessing import reduction
+
+
+class _Reply:
+    __slots__ = ('_event', 'value', 'error')
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set(self, value, error=None):
+        self.value = value
+        self.error = error
+        self._event.set()
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError(f"không có trả lời sau {timeout:g}s")
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.value
+
+
+class Channel:
+    """
+    1 đầu Pipe: gửi được từ nhiều thread, gọi có trả lời (call) và chuyển socket.
+    peer_pid: pid process bên kia (cần để chuyển socket).
+    """
+
+    def __init__(self, conn, peer_pid=None):
+        self.conn = conn
+        self.peer_pid = peer_pid
+        self._send_lock = threading.Lock()
+        self._calls = {}
+        self._call_ids = itertools.count(1)
+
+    def send(self, *message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def send_socket(self, sock, *message):
+        """Chuyển bản sao socket (kèm message) sang process bên kia; bên gửi vẫn tự đóng sock."""
+        with self._send_lock:
+            if hasattr(sock, 'share'):
+                self.conn.send(('socket', sock.share(self.peer_pid)) + message)
+            else:
+                self.conn.send(('socket', None) + message)
+                reduction.send_handle(self.conn, sock.fileno(), self.peer_pid)
+
+    def call_async(self, op, *args):
+        """Gửi yêu cầu op cho bên kia; trả về đối tượng có wait(timeout) -> giá trị trả lời."""
+        call_id = next(self._call_ids)
+        reply = self._calls[call_id] = _Reply()
+        try:
+            self.send('call', call_id, op, *args)
+        except Exception:
+            self._calls.pop(call_id, None)
+            raise
+        return reply
+
+    def call(self, op, *args, timeout=None):
+        return self.call_async(op, *args).wait(timeout)
+
+    def reply(self, call_id, value=None, error=None):
+        self.send('reply', call_id, value, error)
+
+    def recv(self):
+        """
+        Tin kế tiếp (chặn). Trả lời của call() được xử lý tại đây (trả về None);
+        ('socket', ...) trả về socket đã dựng lại. EOFError / OSError khi bên kia đóng.
+        """
+        message = self.conn.recv()
+        kind = message[0]
+        if kind == 'reply':
+            _, call_id, value, error = message
+            reply = self._calls.pop(call_id, None)
+            if reply is not None:
+                reply.set(value, error)
+            return None
+        if kind == 'socket':
+            shared = message[1]
+            if shared is None:
+                sock = socket.socket(fileno=reduction.recv_handle(self.conn))
+            else:
+                sock = socket.fromshare(shared)
+            return ('socket', sock) + message[2:]
+        return message
+
+    def fail_calls(self, error):
+        """Bên kia đã đóng: các call() đang chờ nhận lỗi ngay thay vì chờ hết timeout."""
+        calls, self._calls = self._calls, {}
+        for reply in calls.values():
+            reply.set(None, error)
+
+
+def dispatch(channel, message, on_message, on_call, on_error=None):
+    """Xử lý 1 tin: ('call', id, op, *args) -> trả lời bằng on_call(op, *args), còn lại -> on_message."""
+    try:
+        if message[0] == 'call':
+            _, call_id, op, *args = message
+            try:
+                value = on_call(op, *args)
+            except Exception as e:
+                channel.reply(call_id, error=repr(e))
+            else:
+                channel.reply(call_id, value)
+        else:
+            on_message(message)
+    except Exception as e:
+        if on_error is not None:
+            on_error(e, message)
+
+
+def run_worker(channel, on_message, on_call, on_error=None):
+    """
+    Vòng nhận tin trong process ingest. call chạy trong thread riêng (có thể lâu, vd chờ
+    writer ghi xong phiên). Trả về khi supervisor gửi 'shutdown' hoặc đóng Pipe.
+    """
+    while True:
+        try:
+            message = channel.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            continue
+        if message[0] == 'shutdown':
+            return
+        if message[0] == 'call':
+            threading.Thread(target=dispatch, args=(channel, message, on_message, on_call, on_error),
+                             daemon=True).start()
+        else:
+            dispatch(channel, message, on_message, on_call, on_error)
+
+
+class WorkerPool:
+    """
+    count process ingest chạy target(index, conn) (hàm cấp module để pickle được với 'spawn').
+    on_message(index, message): tin từ process index (gọi trong thread nhận của process đó).
+    on_call(index, op, *args): trả lời Channel.call() của process con.
+    on_start(index): process vừa khởi động (hoặc khởi động lại) - gửi trạng thái cho nó.
+    on_exit(index, exitcode): process chết bất thường, trước khi khởi động lại.
+    on_error(exc, message): lỗi khi xử lý 1 tin.
+    """
+
+    def __init__(self, count, target, on_message=None, on_call=None, on_start=None, on_exit=None,
+                 on_error=None, restart_delay=1.0):
+        self.count = max(1, count)
+        self.target = target
+        self.on_message = on_message
+        self.on_call = on_call
+        self.on_start = on_start
+        self.on_exit = on_exit
+        self.on_error = on_error
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self._ctx = multiprocessing.get_context('spawn')
+        self._workers = [None] * self.count   # (Process, Channel)
+        self._owners = {}                     # camera -> index process
+        self._owners_lock = threading.Lock()
+        self._stopping = False
+
+    def assign(self, cam_name):
+        """Process phụ trách camera: lần đầu chọn process đang ít camera nhất, sau đó giữ nguyên."""
+        index = self._owners.get(cam_name)
+        if index is None:
+            with self._owners_lock:
+                index = self._owners.get(cam_name)
+                if index is None:
+                    load = collections.Counter(self._owners.values())
+                    index = self._owners[cam_name] = min(range(self.count), key=lambda i: load[i])
+        return index
+
+    def owner(self, cam_name):
+        """Process đã gán cho camera (None nếu camera chưa kết nối lần nào)."""
+        return self._owners.get(cam_name)
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        return self
+
+    def _spawn(self, index):
+        parent_conn, child_conn = self._ctx.Pipe(duplex=True)
+        # không daemon: process ingest còn tạo process con (ảnh thu nhỏ)
+        process = self._ctx.Process(target=self.target, args=(index, child_conn), name=f"ingest-{index}")
+        process.start()
+        child_conn.close()
+        channel = Channel(parent_conn, process.pid)
+        self._workers[index] = (process, channel)
+        threading.Thread(target=self._recv_loop, args=(index, process, channel),
+                         name=f"ingest-{index}-recv", daemon=True).start()
+        if self.on_start is not None:
+            self.on_start(index)
+
+    def _recv_loop(self, index, process, channel):
+        on_message = (lambda message: self.on_message(index, message)) if self.on_message is not None \
+            else (lambda message: None)
+        on_call = lambda op, *args: self.on_call(index, op, *args)
+        while True:
+            try:
+                message = channel.recv()
+            except (EOFError, OSError):
+                break
+            if message is not None:
+                dispatch(channel, message, on_message, on_call, self.on_error)
+        channel.fail_calls(f"process ingest {index} đã thoát")
+        process.join(5.0)
+        if self._stopping:
+            return
+        if self.on_exit is not None:
+            self.on_exit(index, process.exitcode)
+        time.sleep(self.restart_delay)
+        if not self._stopping:
+            self.restarts += 1
+            self._spawn(index)
+
+    def pids(self):
+        return [w[0].pid for w in self._workers if w is not None]
+
+    def alive(self):
+        return sum(1 for w in self._workers if w is not None and w[0].is_alive())
+
+    def send(self, index, *message):
+        """Gửi tin cho 1 process; False nếu process đã đóng Pipe."""
+        try:
+            self._workers[index][1].send(*message)
+            return True
+        except (OSError, EOFError, ValueError):
+            return False
+
+    def send_socket(self, index, sock, *message):
+        self._workers[index][1].send_socket(sock, *message)
+
+    def broadcast(self, *message):
+        for index in range(self.count):
+            self.send(index, *message)
+
+    def call_all(self, op, *args, timeout=None):
+        """Gọi op ở mọi process song song. Trả về [giá trị | Exception] theo thứ tự process."""
+        pending = []
+        for _, channel in self._workers:
+            try:
+                pending.append(channel.call_async(op, *args))
+            except Exception as e:
+                pending.append(e)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = []
+        for reply in pending:
+            if isinstance(reply, Exception):
+                results.append(reply)
+                continue
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                results.append(reply.wait(remaining))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stop(self, timeout=5.0):
+        """Báo mọi process dừng (ghi nốt hàng đợi), chờ tối đa timeout giây rồi kill."""
+        self._stopping = True
+        self.broadcast('shutdown')
+        deadline = time.monotonic() + timeout
+        for process, _ in self._workers:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join(1.0)
+
+
+class WriterStatsView:
+    """
+    stats() writer do các process ingest báo về, cộng lại; cùng giao diện đọc với
+    FrameWriter (queue_depth(), queue_size, written, dropped...) cho UI / metrics /
+    điều khiển tốc độ ở supervisor.
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def update(self, index, stats):
+        self._stats[index] = stats
+
+    def _sum(self, key):
+        return sum(s[key] for s in list(self._stats.values()))
+
+    def queue_depth(self):
+        return self._sum('queue_depth')
+
+    @property
+    def queue_size(self):
+        return self._sum('queue_size') or 1
+
+    @property
+    def written(self):
+        return self._sum('written')
+
+    @property
+    def dropped(self):
+        dropped = collections.Counter()
+        for s in list(self._stats.values()):
+            dropped.update(s['dropped'])
+        return dict(dropped)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "queue_size": self.queue_size,
+            "written": self.written,
+            "written_bytes": self._sum('written_bytes'),
+            "failed": self._sum('failed'),
+            "rejected": self._sum('rejected'),
+            "batches": self._sum('batches'),
+            "dropped": self.dropped,
+        }
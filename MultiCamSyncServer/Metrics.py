@@ -0,0 +1,378 @@
+"""
+Đo đạc nội bộ cho CamServer: counter / gauge / histogram theo nhãn (camera, thiết bị...)
+xuất ra HTTP dạng Prometheus text, kèm profiler lấy mẫu stack cho các đường nóng.
+
+    GET /metrics                         -> Prometheus text format 0.0.4
+    GET /debug/profile?seconds=10&hz=200 -> stack gộp (collapsed, dùng cho flamegraph.pl / speedscope)
+                                            chỉ khi bật profiler
+
+Chi phí mỗi lần inc()/observe() là 1 lần lấy lock + vài phép cộng nên gọi được cho
+từng frame; các giá trị có sẵn ở nơi khác (độ sâu hàng đợi, offset đồng hồ...) được
+đọc lúc scrape qua collector thay vì cập nhật liên tục.
+"""
+import bisect
+import collections
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Bucket mặc định (giây): 50 µs .. 10 s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Child theo giá trị nhãn (được cache, giữ lại để gọi nhanh trên đường nóng)."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: cần nhãn {self.labelnames}, nhận {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def value(self, *values, default=0):
+        """Giá trị counter / gauge theo nhãn (không lấy lock, không tạo child mới; cho UI đọc định kỳ)."""
+        child = self._children.get(values)
+        return child.value if child is not None else default
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def snapshot(self):
+        """{nhãn: trạng thái child} để gửi sang process khác (xem merge)."""
+        return {values: child.state() for values, child in self._items()}
+
+    def merge(self, snapshots):
+        """
+        Đặt giá trị theo tổng các snapshot của nhiều process (vd process ingest):
+        counter / gauge cộng giá trị, histogram cộng từng bucket.
+        """
+        combined = {}
+        for snapshot in snapshots:
+            for values, state in snapshot.items():
+                combined.setdefault(values, []).append(state)
+        for values, states in combined.items():
+            child = self.labels(*values)
+            child.load(child.combine(states))
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.documentation}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in self._items():
+            child.render(self.name, self.labelnames, values, out)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def state(self):
+        return self.value
+
+    def load(self, state):
+        with self._lock:
+            self.value = state
+
+    @staticmethod
+    def combine(states):
+        return sum(states)
+
+    def render(self, name, labelnames, values, out):
+        out.append(f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}")
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def state(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def load(self, state):
+        counts, total, count = state
+        with self._lock:
+            self.counts = list(counts)
+            self.sum = total
+            self.count = count
+
+    @staticmethod
+    def combine(states):
+        counts = [sum(column) for column in zip(*(s[0] for s in states))]
+        return counts, sum(s[1] for s in states), sum(s[2] for s in states)
+
+    def render(self, name, labelnames, values, out):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            out.append(f"{name}_bucket{_format_labels(labelnames, values, ('le', _format_value(bound)))} "
+                       f"{cumulative}")
+        out.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        out.append(f"{name}_count{_format_labels(labelnames, values)} {count}")
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    """
+    Tập metric của process. collector(): hàm gọi lúc scrape, trả về danh sách
+    (name, kind, help, [(labels_dict, value), ...]) cho các giá trị đọc tại chỗ.
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        out = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            metric.render(out)
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                out.append(f"# collector lỗi: {_escape(e)}")
+                continue
+            for name, kind, documentation, samples in families:
+                out.append(f"# HELP {name} {documentation}")
+                out.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    out.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        out.append('')
+        return '\n'.join(out)
+
+
+# ---------- Profiler lấy mẫu ----------
+
+class SamplingProfiler:
+    """
+    Lấy mẫu stack mọi thread (sys._current_frames) theo tần số hz, gộp thành dạng
+    collapsed 'thread;file:func;file:func count'. Không cần cài thêm gì và không
+    chèn hook vào code đang chạy nên chỉ tốn CPU khi đang lấy mẫu.
+    """
+
+    def __init__(self, hz=100, thread_prefixes=None):
+        self.interval = 1.0 / max(1, hz)
+        self.thread_prefixes = tuple(thread_prefixes) if thread_prefixes else None
+        self._lock = threading.Lock()
+
+    def _thread_names(self):
+        return {t.ident: t.name for t in threading.enumerate()}
+
+    def sample(self, seconds, hz=None):
+        """Chặn trong `seconds` giây, trả về Counter {stack collapsed: số mẫu}."""
+        interval = 1.0 / max(1.0, hz) if hz else self.interval
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("profiler đang chạy")
+        try:
+            stacks = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            names = self._thread_names()
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    name = names.get(ident)
+                    if name is None:
+                        names = self._thread_names()
+                        name = names.get(ident, str(ident))
+                    if self.thread_prefixes and not name.startswith(self.thread_prefixes):
+                        continue
+                    parts = [f"{os.path.basename(fs.filename)}:{fs.name}" for fs in traceback.extract_stack(frame)]
+                    stacks[';'.join([name] + parts)] += 1
+                time.sleep(interval)
+            return stacks
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(stacks):
+        return '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common()) + '\n'
+
+
+# ---------- HTTP ----------
+
+class MetricsServer:
+    """HTTP server nền phục vụ /metrics (và /debug/profile nếu có profiler)."""
+
+    def __init__(self, registry, host='127.0.0.1', port=9108, profiler=None, max_profile_seconds=60):
+        self.registry = registry
+        self.profiler = profiler
+        self.max_profile_seconds = max_profile_seconds
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    self._reply(200, server.registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+                elif url.path == '/debug/profile' and server.profiler is not None:
+                    query = parse_qs(url.query)
+                    try:
+                        seconds = min(float(query.get('seconds', ['10'])[0]), server.max_profile_seconds)
+                        hz = float(query['hz'][0]) if 'hz' in query else None
+                        stacks = server.profiler.sample(seconds, hz)
+                    except (ValueError, RuntimeError) as e:
+                        self._reply(409, f"{e}\n", 'text/plain; charset=utf-8')
+                        return
+                    self._reply(200, SamplingProfiler.collapsed(stacks), 'text/plain; charset=utf-8')
+                else:
+                    self._reply(404, "not found\n", 'text/plain; charset=utf-8')
+
+            def _reply(self, status, body, content_type):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                # không in log truy cập (Prometheus scrape liên tục)
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,315 @@
+"""
+Xem trước live các camera qua HTTP (MJPEG), không đọc đĩa và không làm chậm ingest.
+
+    GET /                       -> trang HTML xem mọi camera
+    GET /cameras                -> JSON: camera có frame, sequence, tuổi frame, số người xem
+    GET /stream/<camera>?fps=N  -> multipart/x-mixed-replace (MJPEG, mở thẳng bằng trình duyệt / VLC / ffplay)
+    GET /snapshot/<camera>      -> 1 ảnh JPEG mới nhất
+
+LatestFrameCache giữ đúng 1 frame mới nhất mỗi camera (1 slot, không hàng đợi). Tầng
+ingest chỉ thay slot: frame trong buffer pool được giữ bằng BufferPool.retain (không
+copy), frame cũ được release khi bị thay. Mỗi người xem là 1 thread chờ frame có
+sequence mới hơn frame vừa gửi rồi luôn gửi frame mới nhất, nên người xem chậm tự bỏ
+qua frame trung gian thay vì dồn buffer; ghi socket chậm chỉ chặn thread của người đó.
+"""
+import contextlib
+import html
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+BOUNDARY = 'camframe'
+
+
+class PreviewFrame:
+    __slots__ = ('cam_name', 'data', 'buffer', 'seq', 'timestamp_ns', 'received_ns')
+
+    def __init__(self, cam_name, data, buffer, seq, timestamp_ns, received_ns):
+        self.cam_name = cam_name
+        self.data = data            # bytes / memoryview JPEG
+        self.buffer = buffer        # bytearray của buffer pool chứa data (None nếu data tự sở hữu)
+        self.seq = seq              # tăng dần theo camera, dùng để người xem biết có frame mới
+        self.timestamp_ns = timestamp_ns
+        self.received_ns = received_ns
+
+
+class _CameraSlot:
+    __slots__ = ('frame', 'viewers', 'cond')
+
+    def __init__(self):
+        self.frame = None
+        self.viewers = 0
+        self.cond = threading.Condition()
+
+
+class LatestFrameCache:
+    """
+    buffer_pool: BufferPool của server (giữ frame trong buffer mượn không cần copy).
+    Mỗi camera có Condition riêng: frame của camera này chỉ đánh thức người xem camera đó.
+    """
+
+    def __init__(self, buffer_pool=None):
+        self.buffer_pool = buffer_pool
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, cam_name):
+        slot = self._slots.get(cam_name)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.setdefault(cam_name, _CameraSlot())
+        return slot
+
+    def watched(self, cam_name):
+        """Camera đang có người xem (rẻ, gọi được cho từng frame)."""
+        slot = self._slots.get(cam_name)
+        return slot is not None and slot.viewers > 0
+
+    def update(self, cam_name, data, buffer=None, timestamp_ns=None):
+        """
+        Thay frame mới nhất của camera. buffer (bytearray của pool chứa data) được retain
+        tới khi frame bị thay; data không có buffer phải là dữ liệu không bị ghi đè sau đó.
+        """
+        if buffer is not None:
+            self.buffer_pool.retain(buffer)
+        now_ns = time.time_ns()
+        slot = self._slot(cam_name)
+        with slot.cond:
+            old = slot.frame
+            slot.frame = PreviewFrame(cam_name, data, buffer, old.seq + 1 if old is not None else 1,
+                                      timestamp_ns or now_ns, now_ns)
+            slot.cond.notify_all()
+        if old is not None:
+            self._release_buffer(old)
+
+    def acquire(self, cam_name, after_seq=0, timeout=None):
+        """
+        Frame mới nhất có seq > after_seq (chờ tối đa timeout giây), None nếu hết giờ.
+        Frame trả về được giữ cho tới release(frame): slot có bị thay thì buffer cũng
+        không về pool khi đang gửi.
+        """
+        slot = self._slot(cam_name)
+        with slot.cond:
+            if not slot.cond.wait_for(lambda: slot.frame is not None and slot.frame.seq > after_seq, timeout):
+                return None
+            frame = slot.frame
+            if frame.buffer is not None:
+                self.buffer_pool.retain(frame.buffer)
+        return frame
+
+    def release(self, frame):
+        self._release_buffer(frame)
+
+    def _release_buffer(self, frame):
+        if frame.buffer is not None:
+            self.buffer_pool.release(frame.buffer)
+
+    @contextlib.contextmanager
+    def watch(self, cam_name):
+        """Đánh dấu 1 người xem camera trong khối with."""
+        slot = self._slot(cam_name)
+        with slot.cond:
+            slot.viewers += 1
+        try:
+            yield slot
+        finally:
+            with slot.cond:
+                slot.viewers -= 1
+
+    def remove(self, cam_name):
+        """Bỏ frame đang giữ của camera (trả buffer về pool)."""
+        slot = self._slots.get(cam_name)
+        if slot is None:
+            return
+        with slot.cond:
+            old, slot.frame = slot.frame, None
+        if old is not None:
+            self._release_buffer(old)
+
+    def clear(self):
+        for cam_name in list(self._slots):
+            self.remove(cam_name)
+
+    def viewers(self):
+        """{camera: số người xem}."""
+        return {cam: slot.viewers for cam, slot in list(self._slots.items())}
+
+    def stats(self, now_ns=None):
+        """{camera: {"seq", "ageSeconds", "bytes", "viewers"}} cho /cameras."""
+        now_ns = time.time_ns() if now_ns is None else now_ns
+        out = {}
+        for cam, slot in sorted(list(self._slots.items())):
+            frame = slot.frame
+            out[cam] = {
+                "seq": frame.seq if frame is not None else 0,
+                "ageSeconds": round((now_ns - frame.received_ns) / 1e9, 3) if frame is not None else None,
+                "bytes": len(frame.data) if frame is not None else 0,
+                "viewers": slot.viewers,
+            }
+        return out
+
+
+# ---------- HTTP ----------
+
+_INDEX_HTML = """<!doctype html>
+<html><head><meta charset="utf-8"><title>CamServer preview</title>
+<style>body{{background:#111;color:#eee;font-family:sans-serif;margin:8px}}
+.cam{{display:inline-block;margin:4px;vertical-align:top}}
+.cam img{{max-width:{width}px;background:#222;display:block}}</style></head>
+<body><h3>CamServer preview</h3>{cameras}</body></html>
+"""
+
+
+class PreviewServer:
+    """
+    HTTP server nền phục vụ preview từ LatestFrameCache.
+    max_fps: giới hạn FPS mỗi người xem (0 = theo tốc độ camera), ?fps=N chỉ được giảm thêm.
+    cameras: hàm trả về danh sách camera cho trang chỉ mục (mặc định camera đã có frame).
+    idle_timeout: số giây chờ frame mới trước khi gửi lại frame cuối (giữ kết nối, phát hiện người xem đã đóng).
+    """
+
+    def __init__(self, cache, host='127.0.0.1', port=8090, max_fps=15.0, cameras=None, idle_timeout=5.0,
+                 snapshot_timeout=2.0, thumb_width=480):
+        self.cache = cache
+        self.max_fps = max_fps
+        self.cameras = cameras
+        self.idle_timeout = idle_timeout
+        self.snapshot_timeout = snapshot_timeout
+        self.thumb_width = thumb_width
+        self.streams_total = 0
+        self.frames_sent = 0
+        self._stopping = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/':
+                    self._reply(200, server.index_html().encode('utf-8'), 'text/html; charset=utf-8')
+                elif url.path == '/cameras':
+                    body = json.dumps(server.cache.stats(), ensure_ascii=False).encode('utf-8')
+                    self._reply(200, body, 'application/json')
+                elif url.path.startswith('/stream/'):
+                    query = parse_qs(url.query)
+                    try:
+                        fps = float(query['fps'][0]) if 'fps' in query else 0.0
+                    except ValueError:
+                        fps = 0.0
+                    server.stream(self, unquote(url.path[len('/stream/'):]), fps)
+                elif url.path.startswith('/snapshot/'):
+                    server.snapshot(self, unquote(url.path[len('/snapshot/'):]))
+                else:
+                    self._reply(404, b"not found\n", 'text/plain; charset=utf-8')
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="preview-http", daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def camera_names(self):
+        names = set(self.cache.stats())
+        if self.cameras is not None:
+            names.update(self.cameras())
+        return sorted(names)
+
+    def index_html(self):
+        items = []
+        for cam in self.camera_names():
+            name = html.escape(cam)
+            items.append(f'<div class="cam"><div>{name}</div><img src="/stream/{quote(cam)}" alt="{name}"></div>')
+        return _INDEX_HTML.format(width=self.thumb_width, cameras=''.join(items) or '<p>(chưa có camera)</p>')
+
+    def _interval(self, fps):
+        limits = [f for f in (self.max_fps, fps) if f and f > 0]
+        return 1.0 / min(limits) if limits else 0.0
+
+    def stream(self, handler, cam_name, fps=0.0):
+        """MJPEG: luôn gửi frame mới nhất, bỏ qua frame tới trong lúc đang gửi / chờ giới hạn FPS."""
+        interval = self._interval(fps)
+        handler.send_response(200)
+        handler.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        handler.send_header('Cache-Control', 'no-cache, private')
+        handler.send_header('Pragma', 'no-cache')
+        handler.end_headers()
+        self.streams_total += 1
+        last_seq = 0
+        try:
+            with self.cache.watch(cam_name):
+                while not self._stopping.is_set():
+                    frame = self.cache.acquire(cam_name, last_seq, self.idle_timeout)
+                    if frame is None:
+                        if last_seq:
+                            # camera im lặng: gửi lại frame cuối để giữ kết nối / phát hiện người xem đã đóng
+                            last_seq -= 1
+                        continue
+                    try:
+                        self._write_part(handler.wfile, frame)
+                    finally:
+                        self.cache.release(frame)
+                    last_seq = frame.seq
+                    self.frames_sent += 1
+                    if interval:
+                        self._stopping.wait(max(0.0, interval - (time.time_ns() - frame.received_ns) / 1e9))
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError, TimeoutError):
+            pass
+
+    @staticmethod
+    def _write_part(wfile, frame):
+        wfile.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame.data)}\r\n"
+                    f"X-Timestamp: {frame.timestamp_ns}\r\n\r\n".encode('ascii'))
+        wfile.write(frame.data)
+        wfile.write(b"\r\n")
+        wfile.flush()
+
+    def snapshot(self, handler, cam_name):
+        """
+        1 JPEG. Frame đang giữ cũ hơn snapshot_timeout (cache có thể chỉ được cập nhật khi
+        có người xem) thì chờ thêm frame mới, hết giờ vẫn trả frame cũ.
+        """
+        with self.cache.watch(cam_name):
+            frame = self.cache.acquire(cam_name, 0, self.snapshot_timeout)
+            if frame is not None and time.time_ns() - frame.received_ns > self.snapshot_timeout * 1e9:
+                newer = self.cache.acquire(cam_name, frame.seq, self.snapshot_timeout)
+                if newer is not None:
+                    self.cache.release(frame)
+                    frame = newer
+        if frame is None:
+            handler._reply(404, b"no frame\n", 'text/plain; charset=utf-8')
+            return
+        try:
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'image/jpeg')
+            handler.send_header('Content-Length', str(len(frame.data)))
+            handler.send_header('Cache-Control', 'no-cache')
+            handler.send_header('X-Timestamp', str(frame.timestamp_ns))
+            handler.end_headers()
+            handler.wfile.write(frame.data)
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        finally:
+            self.cache.release(frame)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,181 @@
+"""
+Điều khiển tốc độ gửi frame của điện thoại theo khả năng ghi của server (backpressure).
+
+Khi đĩa / CPU không theo kịp, server đọc TCP chậm lại, buffer TCP đầy và điện thoại bị
+chặn thất thường, frame tới trễ thành từng đợt. Thay vào đó server theo dõi:
+    - độ đầy hàng đợi writer (chung cho mọi camera)
+    - độ trễ ingest từng thiết bị: capture -> nhận (header v2) và thời gian chờ ghi
+rồi gửi gợi ý tốc độ qua cổng UDP điều khiển cho thiết bị khai báo "rateControl": 1:
+    server -> device : {"type": "RATE", "level": n, "fps": 10.0, "quality": 60}
+Mỗi thiết bị có 1 nấc (level) trên thang RATE_LEVELS; nấc 0 = FPS / chất lượng JPEG
+gốc của thiết bị (báo khi CONNECT: "maxFps", "jpegQuality").
+
+Hysteresis: giảm 1 nấc mỗi chu kỳ khi vượt ngưỡng cao, chỉ tăng lại 1 nấc sau khi
+dưới ngưỡng thấp liên tục up_after giây; giữa 2 ngưỡng thì giữ nguyên. Khi hàng đợi
+writer (tài nguyên chung) quá tải, mỗi chu kỳ chỉ giảm các thiết bị đang ở nấc cao
+nhất để tổng bitrate giảm dần và chia đều giữa các camera.
+Gợi ý được gửi lại định kỳ (UDP có thể mất gói, thiết bị chỉ việc áp dụng giá trị mới nhất).
+"""
+import collections
+import threading
+import time
+
+# Thang mặc định: (hệ số FPS so với FPS gốc, số điểm chất lượng JPEG bị giảm)
+DEFAULT_LEVELS = ((1.0, 0), (0.75, 0), (0.5, 10), (0.33, 20), (0.25, 25))
+
+RateTarget = collections.namedtuple('RateTarget', 'level fps quality lag_s')
+
+
+def parse_levels(text):
+    """'1:0,0.75:0,0.5:10' -> ((1.0, 0), (0.75, 0), (0.5, 10)); rỗng / hỏng -> DEFAULT_LEVELS."""
+    levels = []
+    for item in (text or '').split(','):
+        factor, _, drop = item.strip().partition(':')
+        if not factor:
+            continue
+        try:
+            levels.append((float(factor), int(drop or 0)))
+        except ValueError:
+            return DEFAULT_LEVELS
+    return tuple(levels) or DEFAULT_LEVELS
+
+
+class _DeviceRate:
+    __slots__ = ('nominal_fps', 'nominal_quality', 'level', 'ingest_lag', 'queue_wait', 'updated',
+                 'changed_at', 'calm_since', 'sent_at', 'sent_level')
+
+    def __init__(self, nominal_fps, nominal_quality):
+        self.nominal_fps = nominal_fps
+        self.nominal_quality = nominal_quality
+        self.level = 0
+        self.ingest_lag = 0.0   # EWMA capture -> nhận (giây)
+        self.queue_wait = 0.0   # EWMA thời gian chờ trong hàng đợi writer (giây)
+        self.updated = None
+        self.changed_at = 0.0
+        self.calm_since = None
+        self.sent_at = None
+        self.sent_level = None
+
+
+class RateController:
+    """
+    levels: thang (hệ số FPS, giảm chất lượng), nấc 0 phải là (1.0, 0).
+    queue_high / queue_low: ngưỡng độ đầy hàng đợi writer (0..1).
+    lag_high / lag_low: ngưỡng độ trễ ingest của từng thiết bị (giây).
+    up_after: số giây phải ổn định dưới ngưỡng thấp trước khi tăng lại 1 nấc.
+    refresh_interval: gửi lại gợi ý hiện tại sau mỗi khoảng này (giây).
+    """
+
+    def __init__(self, levels=DEFAULT_LEVELS, min_fps=1.0, min_quality=20, queue_high=0.7, queue_low=0.3,
+                 lag_high=0.5, lag_low=0.15, up_after=5.0, refresh_interval=10.0, smoothing=0.2):
+        self.levels = tuple(levels)
+        self.min_fps = min_fps
+        self.min_quality = min_quality
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.lag_high = lag_high
+        self.lag_low = lag_low
+        self.up_after = up_after
+        self.refresh_interval = refresh_interval
+        self.smoothing = smoothing
+        self.queue_fill = 0.0
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    # ---------- Thiết bị ----------
+
+    def set_device(self, device_id, nominal_fps, nominal_quality):
+        """Thiết bị hỗ trợ gợi ý tốc độ (gọi khi CONNECT/REGISTER); giữ nấc hiện tại nếu đã có."""
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                self._devices[device_id] = _DeviceRate(nominal_fps, nominal_quality)
+            else:
+                state.nominal_fps = nominal_fps
+                state.nominal_quality = nominal_quality
+                state.sent_at = None
+
+    def remove(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def _weight(self, count):
+        # count frame cùng giá trị (trung bình từ process ingest) = count lần làm mượt liên tiếp
+        return self.smoothing if count == 1 else 1.0 - (1.0 - self.smoothing) ** count
+
+    def observe_ingest_lag(self, device_id, seconds, now=None, count=1):
+        """Độ trễ capture -> nhận của 1 frame (gọi cho từng frame, rẻ) hoặc trung bình của count frame."""
+        state = self._devices.get(device_id)
+        if state is not None:
+            state.ingest_lag += self._weight(count) * (seconds - state.ingest_lag)
+            state.updated = time.monotonic() if now is None else now
+
+    def observe_queue_wait(self, device_id, seconds, now=None, count=1):
+        """Thời gian 1 frame (hoặc trung bình count frame) chờ trong hàng đợi writer."""
+        state = self._devices.get(device_id)
+        if state is not None:
+            state.queue_wait += self._weight(count) * (seconds - state.queue_wait)
+            state.updated = time.monotonic() if now is None else now
+
+    # ---------- Điều khiển ----------
+
+    def _target(self, state, lag):
+        factor, drop = self.levels[state.level]
+        fps = max(self.min_fps, round(state.nominal_fps * factor, 2))
+        quality = max(self.min_quality, state.nominal_quality - drop) if drop else state.nominal_quality
+        return RateTarget(state.level, fps, quality, lag)
+
+    def _lag(self, state, now, stale_after):
+        # Không còn frame mới (thiết bị dừng ghi) -> không còn trễ
+        if state.updated is None or now - state.updated > stale_after:
+            return 0.0
+        return max(state.ingest_lag, state.queue_wait)
+
+    def tick(self, queue_fill, interval, now=None):
+        """
+        Gọi mỗi `interval` giây với độ đầy hàng đợi writer hiện tại.
+        Trả về [(deviceId, RateTarget, nấc vừa đổi?)] cần gửi (nấc vừa đổi hoặc tới hạn gửi lại).
+        """
+        now = time.monotonic() if now is None else now
+        top = len(self.levels) - 1
+        out = []
+        with self._lock:
+            self.queue_fill = queue_fill
+            states = list(self._devices.items())
+            lags = {d: self._lag(s, now, 2 * interval) for d, s in states}
+            active = {d for d, s in states if s.updated is not None and now - s.updated <= 2 * interval}
+            queue_pressure = queue_fill >= self.queue_high
+            # quá tải chung: chỉ giảm các thiết bị đang gửi ở nấc cao nhất (nấc nhỏ nhất)
+            least_reduced = min((s.level for d, s in states if d in active and s.level < top), default=None)
+            for device_id, state in states:
+                lag = lags[device_id]
+                high = lag >= self.lag_high or (queue_pressure and device_id in active
+                                                and state.level == least_reduced)
+                calm = lag <= self.lag_low and queue_fill <= self.queue_low
+                if high:
+                    state.calm_since = None
+                    if state.level < top and now - state.changed_at >= interval * 0.9:
+                        state.level += 1
+                        state.changed_at = now
+                elif calm and state.level > 0:
+                    if state.calm_since is None:
+                        state.calm_since = now
+                    elif now - state.calm_since >= self.up_after:
+                        state.level -= 1
+                        state.changed_at = now
+                        state.calm_since = now
+                elif not calm:
+                    state.calm_since = None
+
+                changed = state.sent_level is not None and state.level != state.sent_level
+                if changed or state.sent_at is None or now - state.sent_at >= self.refresh_interval:
+                    state.sent_level = state.level
+                    state.sent_at = now
+                    out.append((device_id, self._target(state, lag), changed))
+        return out
+
+    def targets(self, now=None, stale_after=5.0):
+        """{deviceId: RateTarget} hiện tại (cho UI / metrics)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {d: self._target(s, self._lag(s, now, stale_after)) for d, s in self._devices.items()}
@@ -0,0 +1,409 @@
+"""
+Phát lại 1 phiên đã ghi vào CamServer như các điện thoại thật, để tái hiện tải thực tế:
+mỗi thư mục camera của phiên (frame_*.jpg, segment, đọc theo frames.idx nếu có) là 1 camera
+giả lập làm đúng CONNECT/REGISTER qua UDP (cổng riêng hoặc cổng chung + handshake) rồi gửi
+lại đúng payload đã ghi qua TCP theo nhịp thời gian gốc giữa các frame (giữ cả độ lệch giữa
+các camera):
+
+    --speed 1     đúng nhịp gốc;  --speed 10  nhanh gấp 10;  --speed 0  nhanh hết mức
+    --jitter-ms   trễ ngẫu nhiên thêm cho mỗi frame (0..N ms)
+    --disconnect-prob P   mỗi frame có xác suất P bị ngắt kết nối (--cut-frame: ngắt giữa
+                  frame), nối lại sau --reconnect-delay giây; frame tới hạn trong lúc mất
+                  kết nối bị bỏ như điện thoại thật
+    --seed        cố định jitter / ngắt kết nối để các lần chạy giống hệt nhau
+
+Header v2 giữ sequence gốc, capture time là lúc gửi (đồng hồ server) để đo độ trễ như
+BenchLoad. Payload được đọc trước khi chờ tới hạn nên thời gian đọc đĩa không làm lệch nhịp.
+
+Mặc định tự khởi động 1 CamServer cục bộ (HEADLESS=1, thư mục dữ liệu tạm), giống BenchLoad:
+    python Replay.py data/session_20250101_120000 --speed 1 --out replay.json
+    python Replay.py data/session_20250101_120000 --speed 0 --env INGEST_WORKERS=2 --env PROFILER=1
+    python Replay.py data/session_20250101_120000 --jitter-ms 30 --disconnect-prob 0.001 --seed 7
+    python Replay.py data/session_20250101_120000 --no-spawn --control-port 5000 --data-dir data
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from BenchLoad import (
+    IndexTail, ProcessSampler, SimCamera, percentiles_ms, spawn_server, stop_server, wait_manifest,
+)
+from FrameIndex import INDEX_FILE, FrameIndex, FrameRecord, scan_camera_dir
+from FrameReceiver import FRAME_PROTOCOL_VERSION
+from FrameWriter import frame_filename
+from Session import MANIFEST_FILE, list_sessions
+
+
+# ---------- Đọc phiên đã ghi ----------
+
+def load_camera(cam_dir):
+    """Danh sách FrameRecord của 1 camera theo thời gian: từ frames.idx nếu có, không thì quét thư mục."""
+    if os.path.exists(os.path.join(cam_dir, INDEX_FILE)):
+        with FrameIndex(cam_dir) as index:
+            records = [index.entry(i) for i in range(len(index))]
+    else:
+        # frame JPEG: scan_camera_dir không trả tên file (tên suy ra từ timestamp)
+        records = [FrameRecord(ts, seq, os.path.join(cam_dir, name if name is not None else frame_filename(ts)),
+                               offset, length)
+                   for ts, seq, name, offset, length in scan_camera_dir(cam_dir)]
+    records.sort(key=lambda r: r.timestamp_ns)
+    return records
+
+
+def load_session(session_dir, cameras=None, start=0.0, duration=0.0):
+    """
+    { tên thư mục camera: [FrameRecord] } của phiên. cameras: chỉ các camera này;
+    start / duration: cửa sổ thời gian (giây, tính từ frame đầu tiên của cả phiên; 0 = hết).
+    """
+    session = {}
+    for entry in sorted(os.scandir(session_dir), key=lambda e: e.name):
+        if not entry.is_dir() or (cameras and entry.name not in cameras):
+            continue
+        records = load_camera(entry.path)
+        if records:
+            session[entry.name] = records
+    if not session:
+        return session
+    t0 = min(records[0].timestamp_ns for records in session.values())
+    lo = t0 + int(start * 1e9)
+    hi = lo + int(duration * 1e9) if duration > 0 else None
+    return {name: [r for r in records if r.timestamp_ns >= lo and (hi is None or r.timestamp_ns < hi)]
+            for name, records in session.items()}
+
+
+def recorded_fps(records):
+    if len(records) < 2:
+        return 30.0
+    span = (records[-1].timestamp_ns - records[0].timestamp_ns) / 1e9
+    return (len(records) - 1) / span if span > 0 else 30.0
+
+
+class _FrameReader:
+    """Đọc payload theo FrameRecord, giữ file segment đang đọc mở."""
+
+    def __init__(self):
+        self._path = None
+        self._file = None
+
+    def read(self, record):
+        if record.path != self._path:
+            self.close()
+            self._file = open(record.path, 'rb')
+            self._path = record.path
+        self._file.seek(record.offset)
+        return self._file.read(record.length)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = self._path = None
+
+
+# ---------- Camera phát lại ----------
+
+class ReplayCamera(SimCamera):
+    """Camera giả lập gửi lại frame đã ghi của 1 thư mục camera."""
+
+    def __init__(self, index, args, cam_name, records, t0):
+        super().__init__(index, args, fps=round(recorded_fps(records), 2))
+        self.device_id = f"replay_{cam_name.lower()}"
+        self.name = cam_name
+        self.records = records
+        self.t0 = t0
+        self.rng = random.Random(f"{args.seed}:{cam_name}")
+        self.disconnects = 0
+        self.skipped = 0        # frame tới hạn lúc mất kết nối / bị giảm theo RATE
+        self.lag_ns = []        # lúc gửi - lúc tới hạn
+
+    def _due(self, record, start_at):
+        if self.args.speed <= 0:
+            return None
+        due = start_at + (record.timestamp_ns - self.t0) / 1e9 / self.args.speed
+        if self.args.jitter_ms > 0:
+            due += self.rng.uniform(0, self.args.jitter_ms / 1000.0)
+        return due
+
+    def _reconnect(self, sock, record, data):
+        """Ngắt kết nối (tuỳ chọn giữa frame) rồi nối lại sau reconnect_delay. Trả về socket mới (None nếu hỏng)."""
+        self.disconnects += 1
+        try:
+            if self.args.cut_frame:
+                header = self.frame_header(record.sequence, len(data))
+                sock.sendall(header + data[:len(data) // 2])
+                self.short += 1
+        except OSError:
+            pass
+        sock.close()
+        time.sleep(self.args.reconnect_delay)
+        try:
+            return self.open_stream()
+        except OSError:
+            self.errors += 1
+            return None
+
+    def stream(self, start_at):
+        args = self.args
+        reader = _FrameReader()
+        try:
+            sock = self.open_stream()
+        except OSError:
+            self.errors += 1
+            return
+        last_ts = None
+        resumed_at = None
+        try:
+            for record in self.records:
+                due = self._due(record, start_at)
+                # frame tới hạn trong lúc mất kết nối: điện thoại không gửi bù
+                if due is not None and resumed_at is not None and due < resumed_at:
+                    self.skipped += 1
+                    continue
+                # RATE của server giảm FPS: bỏ frame dày hơn FPS mục tiêu
+                if self.fps < self.max_fps and last_ts is not None and \
+                        record.timestamp_ns - last_ts < 1e9 / self.fps:
+                    self.skipped += 1
+                    continue
+                data = reader.read(record)
+                if due is not None:
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif -delay > 0.005:
+                        self.late += 1
+                if args.disconnect_prob > 0 and self.rng.random() < args.disconnect_prob:
+                    sock = self._reconnect(sock, record, data)
+                    if sock is None:
+                        return
+                    resumed_at = time.monotonic()
+                    continue
+                if due is not None:
+                    self.lag_ns.append(max(0, int((time.monotonic() - due) * 1e9)))
+                try:
+                    sock.sendall(self.frame_header(record.sequence, len(data)) + data)
+                except OSError:
+                    self.short += 1
+                    break
+                last_ts = record.timestamp_ns
+                self.sent += 1
+                self.sent_bytes += len(data)
+        finally:
+            reader.close()
+            if sock is not None:
+                sock.close()
+
+
+# ---------- Chạy ----------
+
+def run(args):
+    source = load_session(args.session, args.cameras, args.start, args.duration)
+    source = {name: records for name, records in source.items() if records}
+    if not source:
+        raise RuntimeError(f"{args.session}: không có frame nào để phát lại")
+    t0 = min(records[0].timestamp_ns for records in source.values())
+    span = (max(records[-1].timestamp_ns for records in source.values()) - t0) / 1e9
+
+    spawned = None
+    log_file = None
+    temp_dir = None
+    data_dir = args.data_dir
+    if not args.no_spawn:
+        temp_dir = tempfile.mkdtemp(prefix='camserver_replay_')
+        data_dir = data_dir or os.path.join(temp_dir, 'data')
+        spawned, log_file = spawn_server(args, data_dir, os.path.join(temp_dir, 'server.log'))
+        print(f"Đã khởi động CamServer (pid {spawned.pid}), dữ liệu: {data_dir}")
+
+    cameras = [ReplayCamera(i, args, name, records, t0) for i, (name, records) in enumerate(source.items())]
+    print(f"Phát lại {os.path.basename(os.path.normpath(args.session))}: {len(cameras)} camera, "
+          f"{sum(len(c.records) for c in cameras)} frame, {span:.1f}s gốc, "
+          f"tốc độ {'tối đa' if args.speed <= 0 else f'x{args.speed:g}'}")
+    try:
+        for cam in cameras:
+            if not cam.connect(timeout=args.connect_timeout):
+                raise RuntimeError(f"{cam.device_id}: không nhận được phản hồi CONNECT từ server")
+        print(f"{len(cameras)} camera đã CONNECT, chờ {args.warmup}s (mở cổng TCP, đo đồng hồ)...")
+        time.sleep(args.warmup)
+
+        tails = {}
+        if data_dir:
+            known = list_sessions(data_dir)
+            tails = {cam.device_id: IndexTail(data_dir, cam.subdir, known) for cam in cameras}
+        cameras[0].send_command("START")
+
+        sampler = None
+        pid = args.server_pid or (spawned.pid if spawned is not None else None)
+        if pid is not None:
+            sampler = ProcessSampler(pid)
+            if sampler.available():
+                sampler.start()
+            else:
+                sampler = None
+
+        start_wall = time.time_ns()
+        start_at = time.monotonic() + 0.2
+        threads = [threading.Thread(target=cam.stream, args=(start_at,), daemon=True) for cam in cameras]
+        for t in threads:
+            t.start()
+
+        drain_deadline = None
+        while True:
+            for tail in tails.values():
+                tail.poll((start_wall, time.time_ns() + int(60e9)))
+            if drain_deadline is None and not any(t.is_alive() for t in threads):
+                drain_deadline = time.monotonic() + args.drain
+            if drain_deadline is not None:
+                sent = sum(c.sent for c in cameras)
+                stored = sum(t.count for t in tails.values())
+                if stored >= sent or time.monotonic() >= drain_deadline:
+                    break
+            time.sleep(args.poll_interval)
+        elapsed = (time.time_ns() - start_wall) / 1e9
+        server_stats = sampler.stop() if sampler is not None else None
+        cameras[0].send_command("STOP")
+        session_dir = next((t.session_dir for t in tails.values() if t.session_dir), None)
+        manifest = wait_manifest(session_dir, args.drain) if session_dir else None
+    finally:
+        for cam in cameras:
+            cam.close()
+        if spawned is not None:
+            stop_server(spawned)
+            log_file.close()
+
+    sent = sum(c.sent for c in cameras)
+    sent_bytes = sum(c.sent_bytes for c in cameras)
+    stored = sum(t.count for t in tails.values()) if tails else None
+    latencies = [lat for t in tails.values() for lat in t.latencies_ns]
+    result = {
+        "label": args.label,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "host": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count()},
+        "config": {
+            "source": os.path.abspath(args.session), "cameras": len(cameras), "source_span_s": span,
+            "speed": args.speed, "jitter_ms": args.jitter_ms, "disconnect_prob": args.disconnect_prob,
+            "cut_frame": args.cut_frame, "reconnect_delay_s": args.reconnect_delay, "seed": args.seed,
+            "protocol": args.protocol, "ingest_port": args.ingest_port, "rate_control": args.rate_control,
+            "server_env": dict(item.partition('=')[::2] for item in args.env),
+            "spawned": spawned is not None,
+        },
+        "elapsed_s": elapsed,
+        "sent_frames": sent,
+        "sent_bytes": sent_bytes,
+        "send_fps": sent / elapsed if elapsed > 0 else None,
+        "send_mbps": sent_bytes / elapsed / (1024 * 1024) if elapsed > 0 else None,
+        "late_frames": sum(c.late for c in cameras),
+        "schedule_lag_ms": percentiles_ms([lag for c in cameras for lag in c.lag_ns]),
+        "skipped_frames": sum(c.skipped for c in cameras),
+        "short_frames": sum(c.short for c in cameras),
+        "disconnects": sum(c.disconnects for c in cameras),
+        "connect_errors": sum(c.errors for c in cameras),
+        "stored_frames": stored,
+        "missing_frames": (sent - stored) if stored is not None else None,
+        "latency_ms": percentiles_ms(latencies),
+        "server": server_stats,
+        "session": os.path.basename(session_dir) if session_dir else None,
+        "manifest_totals": manifest.get("totals") if manifest else None,
+        "per_camera": {
+            c.name: {
+                "device_id": c.device_id,
+                "frames": len(c.records),
+                "recorded_fps": c.max_fps,
+                "sent": c.sent,
+                "stored": tails[c.device_id].count if tails else None,
+                "late": c.late,
+                "skipped": c.skipped,
+                "short": c.short,
+                "disconnects": c.disconnects,
+                "latency_ms": percentiles_ms(tails[c.device_id].latencies_ns) if tails else None,
+                "final_fps": c.fps,
+                "freeze_alerts": c.freeze_alerts,
+            } for c in cameras
+        },
+    }
+    if temp_dir is not None and not args.keep_data:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    elif temp_dir is not None:
+        result["data_dir"] = data_dir
+    return result
+
+
+def print_summary(result):
+    print(f"Đã gửi: {result['sent_frames']} frame trong {result['elapsed_s']:.1f}s "
+          f"({result['send_fps']:.1f} fps, {result['send_mbps']:.1f} MB/s) | trễ lịch: {result['late_frames']}"
+          f" | bỏ: {result['skipped_frames']} | ngắt: {result['disconnects']} | gửi dở: {result['short_frames']}")
+    lag = result['schedule_lag_ms']
+    if lag:
+        print(f"Lệch so với nhịp gốc (ms): p50 {lag['p50']:.2f} | p99 {lag['p99']:.2f} | max {lag['max']:.2f}")
+    if result['stored_frames'] is not None:
+        print(f"Server đã ghi: {result['stored_frames']} frame | thiếu: {result['missing_frames']}")
+    if result.get('session'):
+        totals = result['manifest_totals'] or {}
+        print(f"Phiên: {result['session']} | manifest: {totals.get('frames', '?')} frame, "
+              f"bỏ {totals.get('dropped', '?')}, hỏng {totals.get('corrupt', '?')}")
+    lat = result['latency_ms']
+    if lat:
+        print(f"Độ trễ gửi -> index (ms): p50 {lat['p50']:.2f} | p90 {lat['p90']:.2f} | p99 {lat['p99']:.2f}"
+              f" | max {lat['max']:.2f}")
+    srv = result['server']
+    if srv and srv['cpu_percent_avg'] is not None:
+        print(f"Server: CPU tb {srv['cpu_percent_avg']:.0f}% (max {srv['cpu_percent_max']:.0f}%)"
+              f" | RSS max {srv['rss_mb_max']:.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('session', help="thư mục phiên đã ghi (DATA_DIR/session_<thời gian>)")
+    parser.add_argument('--cameras', nargs='+', help="chỉ phát lại các thư mục camera này")
+    parser.add_argument('--start', type=float, default=0.0, help="bắt đầu từ giây thứ N của phiên")
+    parser.add_argument('--duration', type=float, default=0.0, help="chỉ phát N giây (0 = tới hết)")
+    parser.add_argument('--speed', type=float, default=1.0, help="hệ số tốc độ (1 = nhịp gốc, 0 = nhanh hết mức)")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="trễ ngẫu nhiên thêm 0..N ms mỗi frame")
+    parser.add_argument('--disconnect-prob', type=float, default=0.0,
+                        help="xác suất ngắt kết nối TCP trước mỗi frame")
+    parser.add_argument('--cut-frame', action='store_true', help="ngắt kết nối giữa frame (gửi nửa payload)")
+    parser.add_argument('--reconnect-delay', type=float, default=1.0, help="thời gian nối lại sau khi ngắt (giây)")
+    parser.add_argument('--seed', default='0', help="seed cho jitter / ngắt kết nối")
+    parser.add_argument('--protocol', type=int, default=FRAME_PROTOCOL_VERSION, choices=(1, 2),
+                        help="header frame TCP (2 = có sequence / capture time)")
+    parser.add_argument('--server', default='127.0.0.1')
+    parser.add_argument('--control-port', type=int, default=15000)
+    parser.add_argument('--base-cam-port', type=int, default=16001, help="BASE_CAM_PORT của server tự khởi động")
+    parser.add_argument('--ingest-port', type=int, default=0,
+                        help="INGEST_PORT của server tự khởi động: camera dùng cổng chung + handshake (0 = cổng riêng)")
+    parser.add_argument('--rate-control', action='store_true',
+                        help="camera khai báo rateControl và bỏ bớt frame theo gợi ý RATE của server")
+    parser.add_argument('--token', default='123456')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="biến môi trường thêm cho server tự khởi động (lặp lại được)")
+    parser.add_argument('--no-spawn', action='store_true', help="dùng server đang chạy thay vì tự khởi động")
+    parser.add_argument('--server-pid', type=int, help="pid server có sẵn để đo CPU/RSS")
+    parser.add_argument('--data-dir', help="DATA_DIR của server (bắt buộc để đo độ trễ khi --no-spawn)")
+    parser.add_argument('--keep-data', action='store_true', help="giữ lại thư mục dữ liệu tạm")
+    parser.add_argument('--warmup', type=float, default=2.0, help="thời gian chờ sau CONNECT (giây)")
+    parser.add_argument('--drain', type=float, default=10.0, help="thời gian tối đa chờ server ghi nốt (giây)")
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument('--poll-interval', type=float, default=0.002, help="chu kỳ đọc index (giây)")
+    parser.add_argument('--label', default='', help="nhãn lưu trong kết quả")
+    parser.add_argument('--out', help="file JSON kết quả (mặc định: replay_<thời gian>.json)")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.session):
+        parser.error(f"không tìm thấy thư mục phiên: {args.session}")
+    if not os.path.exists(os.path.join(args.session, MANIFEST_FILE)):
+        print(f"Cảnh báo: {args.session} không có {MANIFEST_FILE}, vẫn phát lại các thư mục camera tìm thấy.")
+
+    result = run(args)
+    print_summary(result)
+    out = args.out or f"replay_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi kết quả: {out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
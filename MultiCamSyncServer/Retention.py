@@ -0,0 +1,570 @@
+"""
+Bảo trì DATA_DIR chạy nền: giới hạn tuổi / dung lượng, đóng gói và chuyển phiên cũ sang ổ phụ.
+
+Mỗi lượt lập kế hoạch trên các phiên ĐÃ ĐÓNG (manifest "closed", hoặc manifest không đổi
+quá stale_after giây sau khi server crash), cũ -> mới; phiên đang ghi / đang đóng không bao
+giờ bị đụng tới:
+
+    delete         phiên (ở cả ổ chính và ổ phụ) cũ hơn max_age
+    delete_camera  thư mục camera cũ nhất khi tổng dung lượng 1 camera vượt camera_max_bytes
+    relocate       chuyển phiên sang secondary_dir khi cũ hơn relocate_after, khi ổ chính vượt
+                   max_bytes hoặc còn trống < min_free (không có ổ phụ thì xoá thay vì chuyển)
+    pack           phiên cũ hơn pack_after: gói JPEG của từng camera thành segment (SegmentStore,
+                   dựng lại frames.idx; frame hard link do dedup chỉ lưu 1 lần) hoặc cả phiên
+                   thành <session>.zip (JPEG / segment / mkv lưu nguyên, file khác nén deflate)
+
+Ngưỡng ổ đĩa có độ trễ: khi dung lượng trống < min_free (tỉ lệ), giải phóng tới target_free.
+Mọi đọc / ghi / xoá đi qua bộ giới hạn tốc độ (max_bytes_per_s) và tạm dừng khi ingest bận
+(busy()); pack / relocate chỉ chạy khi idle() (không có phiên đang ghi), xoá thì luôn chạy
+vì ổ đầy làm hỏng chính phiên đang ghi. Thao tác dở dang (.partial) được làm lại ở lượt sau.
+dry_run: chỉ lập kế hoạch và báo cáo dung lượng sẽ giải phóng.
+
+CLI (báo cáo không thay đổi gì; run chỉ nên dùng khi server đang dừng):
+    python Retention.py report <data_dir> [--max-age-days N] [--max-gb N] [--min-free-pct P] ...
+    python Retention.py run    <data_dir> [...]
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+
+from DeviceStore import write_json_atomic
+from FrameIndex import FrameIndex, INDEX_FILE, rebuild_index
+from FrameWriter import format_frame_time, parse_frame_filename
+from SegmentStore import SEGMENT_EXT, SegmentWriter, index_path_for, list_segments, read_index
+from Session import MANIFEST_FILE, SESSION_PREFIX
+
+PACK_SEGMENT = 'segment'
+PACK_ZIP = 'zip'
+PACK_FORMATS = (PACK_SEGMENT, PACK_ZIP)
+
+ARCHIVE_EXT = '.zip'
+PARTIAL_EXT = '.partial'
+# Định dạng đã nén: lưu nguyên trong zip (deflate không giảm thêm mà tốn CPU)
+STORED_EXTS = ('.jpg', '.seg', '.mkv')
+COPY_CHUNK = 1024 * 1024
+
+Action = collections.namedtuple('Action', 'kind path bytes reason')
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+class _Session:
+    """1 phiên trên đĩa (thư mục hoặc file .zip) với dung lượng đã quét."""
+    __slots__ = ('path', 'tier', 'archive', 'time', 'bytes', 'cameras', 'packed', 'finished')
+
+    def __init__(self, path, tier):
+        self.path = path
+        self.tier = tier
+        self.archive = path.endswith(ARCHIVE_EXT)
+        self.time = _session_time(path)
+        self.bytes = 0
+        self.cameras = {}      # subdir -> bytes
+        self.packed = True     # không còn frame JPEG rời
+        self.finished = True
+
+
+def _session_time(path):
+    """Thời điểm bắt đầu phiên (epoch giây) từ tên session_%Y%m%d_%H%M%S, không được thì mtime."""
+    stem = os.path.basename(path)[len(SESSION_PREFIX):]
+    try:
+        return datetime.datetime.strptime(stem[:15], '%Y%m%d_%H%M%S').timestamp()
+    except ValueError:
+        return os.stat(path).st_mtime
+
+
+def _file_size(path, seen):
+    """Kích thước file; file hard link (dedup) chỉ tính 1 lần cho mỗi inode."""
+    st = os.lstat(path)
+    if st.st_nlink > 1:
+        key = (st.st_dev, st.st_ino)
+        if key in seen:
+            return 0
+        seen.add(key)
+    return st.st_size
+
+
+def _tree_files(path):
+    for root, _, files in os.walk(path):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+class _Throttle:
+    """Giới hạn tốc độ I/O (token bucket, cho phép dồn 100 ms) và chờ khi ingest bận."""
+
+    def __init__(self, bytes_per_s, busy=None, stop_event=None):
+        self.bytes_per_s = bytes_per_s
+        self.busy = busy
+        self.stop_event = stop_event or threading.Event()
+        self._next = 0.0
+
+    def __call__(self, nbytes):
+        while self.busy is not None and self.busy():
+            if self.stop_event.wait(0.5):
+                break
+        if self.stop_event.is_set():
+            raise InterruptedError("bảo trì đã dừng")
+        if self.bytes_per_s <= 0:
+            return
+        now = time.monotonic()
+        self._next = max(self._next, now) + nbytes / self.bytes_per_s
+        delay = self._next - now - 0.1
+        if delay > 0 and self.stop_event.wait(delay):
+            raise InterruptedError("bảo trì đã dừng")
+
+
+class RetentionService:
+    """
+    data_dir / secondary_dir: ổ chính (DATA_DIR) và ổ phụ chậm hơn (None = không chuyển).
+    max_age / relocate_after / pack_after: giây (0 = tắt); max_bytes / camera_max_bytes: byte (0 = tắt).
+    min_free / target_free: tỉ lệ dung lượng trống của ổ chính (0..1, min_free=0 = tắt).
+    max_bytes_per_s: giới hạn tốc độ I/O của bảo trì (0 = không giới hạn).
+    active(): đường dẫn các phiên đang ghi / đang đóng; idle(): True khi được pack / relocate;
+    busy(): True khi ingest đang bận (tạm dừng I/O).
+    on_action(action) sau mỗi thao tác xong, on_error(action, exc), on_report(actions) ở chế độ dry_run.
+    """
+
+    def __init__(self, data_dir, secondary_dir=None, max_age=0, max_bytes=0, camera_max_bytes=0,
+                 min_free=0.0, target_free=0.0, relocate_after=0, pack_after=0, pack_format=PACK_SEGMENT,
+                 max_bytes_per_s=0, interval=300.0, dry_run=False, stale_after=3600.0,
+                 active=None, idle=None, busy=None, on_action=None, on_error=None, on_report=None):
+        if pack_format not in PACK_FORMATS:
+            raise ValueError(f"pack_format không hợp lệ: {pack_format} (hợp lệ: {', '.join(PACK_FORMATS)})")
+        self.data_dir = data_dir
+        self.secondary_dir = secondary_dir or None
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.camera_max_bytes = camera_max_bytes
+        self.min_free = min_free
+        self.target_free = max(min_free, target_free)
+        self.relocate_after = relocate_after
+        self.pack_after = pack_after
+        self.pack_format = pack_format
+        self.interval = interval
+        self.dry_run = dry_run
+        self.stale_after = stale_after
+        self.active = active
+        self.idle = idle
+        self.on_action = on_action
+        self.on_error = on_error
+        self.on_report = on_report
+        self._stop = threading.Event()
+        self._throttle = _Throttle(max_bytes_per_s, busy, self._stop)
+        self._cache = {}       # path -> _Session (phiên đã đóng không đổi nữa, trừ khi chính bảo trì sửa)
+        self._thread = None
+        self.runs = 0
+        self.done = collections.Counter()       # kind -> số thao tác
+        self.done_bytes = collections.Counter()  # kind -> byte
+        self.deferred = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_age or self.max_bytes or self.camera_max_bytes or self.min_free
+                    or (self.secondary_dir and self.relocate_after) or self.pack_after)
+
+    # ---------- Quét ----------
+
+    def _scan_session(self, path, tier):
+        s = _Session(path, tier)
+        seen = set()
+        if s.archive:
+            s.bytes = os.stat(path).st_size
+            return s
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                status = json.load(f).get('status')
+            mtime = os.stat(manifest_path).st_mtime
+        except (OSError, ValueError):
+            status, mtime = None, os.stat(path).st_mtime
+        s.finished = status == 'closed' or time.time() - mtime > self.stale_after
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                size = 0
+                for file_path in _tree_files(entry.path):
+                    try:
+                        size += _file_size(file_path, seen)
+                    except OSError:
+                        continue
+                s.cameras[entry.name] = size
+                s.bytes += size
+                if s.packed and any(parse_frame_filename(n) is not None for n in os.listdir(entry.path)):
+                    s.packed = False
+            elif entry.is_file(follow_symlinks=False):
+                s.bytes += entry.stat(follow_symlinks=False).st_size
+        return s
+
+    def scan(self, root, tier):
+        """Các phiên (thư mục / .zip) trong root, cũ -> mới."""
+        try:
+            names = sorted(e.name for e in os.scandir(root) if e.name.startswith(SESSION_PREFIX)
+                           and not e.name.endswith(PARTIAL_EXT)
+                           and (e.is_dir(follow_symlinks=False) or e.name.endswith(ARCHIVE_EXT)))
+        except FileNotFoundError:
+            return []
+        sessions = []
+        for name in names:
+            path = os.path.join(root, name)
+            s = self._cache.get(path)
+            if s is None:
+                try:
+                    s = self._scan_session(path, tier)
+                except OSError:
+                    continue
+                if s.finished:
+                    self._cache[path] = s
+            sessions.append(s)
+        return sessions
+
+    # ---------- Lập kế hoạch ----------
+
+    def plan(self):
+        """Danh sách Action theo thứ tự thực hiện (không thay đổi gì trên đĩa)."""
+        now = time.time()
+        active = set(self.active()) if self.active is not None else set()
+        primary = [s for s in self.scan(self.data_dir, 'primary') if s.finished and s.path not in active]
+        secondary = self.scan(self.secondary_dir, 'secondary') if self.secondary_dir else []
+        actions = []
+
+        # 1. Tuổi tối đa (cả 2 ổ)
+        expired = set()
+        if self.max_age > 0:
+            for s in primary + secondary:
+                if now - s.time > self.max_age:
+                    actions.append(Action('delete', s.path, s.bytes, 'max_age'))
+                    expired.add(s.path)
+        keep = [s for s in primary if s.path not in expired]
+        sizes = {s.path: s.bytes for s in keep}
+
+        # 2. Dung lượng mỗi camera trên ổ chính: xoá thư mục camera cũ nhất
+        if self.camera_max_bytes > 0:
+            per_camera = collections.defaultdict(list)
+            for s in keep:
+                for cam, size in s.cameras.items():
+                    per_camera[cam].append((s, size))
+            for cam, items in sorted(per_camera.items()):
+                total = sum(size for _, size in items)
+                for s, size in items:
+                    if total <= self.camera_max_bytes:
+                        break
+                    actions.append(Action('delete_camera', os.path.join(s.path, cam), size, 'camera_max'))
+                    sizes[s.path] -= size
+                    total -= size
+
+        # 3. Tổng dung lượng / dung lượng trống của ổ chính: chuyển (hoặc xoá) phiên cũ nhất
+        need, reason = 0, ''
+        if self.max_bytes > 0 and sum(sizes.values()) > self.max_bytes:
+            need, reason = sum(sizes.values()) - self.max_bytes, 'max_size'
+        if self.min_free > 0:
+            usage = shutil.disk_usage(self.data_dir)
+            if usage.free < self.min_free * usage.total:
+                disk_need = self.target_free * usage.total - usage.free
+                if disk_need > need:
+                    need, reason = disk_need, 'disk_free'
+        kind = 'relocate' if self.secondary_dir else 'delete'
+        for s in list(keep):
+            if need <= 0:
+                break
+            actions.append(Action(kind, s.path, sizes[s.path], reason))
+            need -= sizes[s.path]
+            keep.remove(s)
+
+        # 4. Chuyển sang ổ phụ theo tuổi
+        if self.secondary_dir and self.relocate_after > 0:
+            for s in list(keep):
+                if now - s.time > self.relocate_after:
+                    actions.append(Action('relocate', s.path, sizes[s.path], 'relocate_after'))
+                    keep.remove(s)
+
+        # 5. Đóng gói phiên cũ (ở ổ nào thì gói tại đó)
+        if self.pack_after > 0:
+            for s in keep + [s for s in secondary if s.path not in expired]:
+                if not s.archive and now - s.time > self.pack_after and (
+                        self.pack_format == PACK_ZIP or not s.packed):
+                    actions.append(Action('pack', s.path, sizes.get(s.path, s.bytes), self.pack_format))
+        return actions
+
+    # ---------- Thực hiện ----------
+
+    def run_once(self):
+        """1 lượt bảo trì. Trả về các Action đã lập kế hoạch."""
+        self.runs += 1
+        actions = self.plan()
+        if self.dry_run:
+            if self.on_report is not None:
+                self.on_report(actions)
+            return actions
+        for action in actions:
+            if self._stop.is_set():
+                break
+            if action.kind in ('pack', 'relocate') and self.idle is not None and not self.idle():
+                self.deferred += 1
+                continue
+            try:
+                getattr(self, '_' + action.kind)(action.path)
+            except InterruptedError:
+                break
+            except Exception as e:
+                self.failed += 1
+                if self.on_error is not None:
+                    self.on_error(action, e)
+                continue
+            finally:
+                self._cache.pop(os.path.dirname(action.path) if action.kind == 'delete_camera' else action.path, None)
+            self.done[action.kind] += 1
+            self.done_bytes[action.kind] += action.bytes
+            if self.on_action is not None:
+                self.on_action(action)
+        return actions
+
+    def _remove_tree(self, path):
+        """Xoá thư mục (hoặc file) theo từng file qua bộ giới hạn tốc độ."""
+        if not os.path.isdir(path):
+            if os.path.exists(path):
+                self._throttle(4096)
+                os.remove(path)
+            return
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                self._throttle(4096)
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(path)
+
+    def _delete(self, path):
+        self._remove_tree(path)
+
+    def _delete_camera(self, path):
+        self._remove_tree(path)
+
+    def _copy_file(self, src, dst):
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            while True:
+                chunk = fin.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                self._throttle(len(chunk))
+                fout.write(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copystat(src, dst)
+
+    def _relocate(self, path):
+        """Chuyển phiên sang ổ phụ: rename nếu cùng filesystem, không thì copy (giữ hard link) rồi xoá bản gốc."""
+        os.makedirs(self.secondary_dir, exist_ok=True)
+        dest = os.path.join(self.secondary_dir, os.path.basename(path))
+        if os.path.exists(dest):
+            raise FileExistsError(dest)
+        try:
+            os.rename(path, dest)
+            return
+        except OSError:
+            pass
+        partial = dest + PARTIAL_EXT
+        if os.path.exists(partial):
+            self._remove_tree(partial)
+        if os.path.isdir(path):
+            linked = {}
+            for src in _tree_files(path):
+                dst = os.path.join(partial, os.path.relpath(src, path))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                st = os.lstat(src)
+                key = (st.st_dev, st.st_ino)
+                if st.st_nlink > 1 and key in linked:
+                    os.link(linked[key], dst)
+                    continue
+                self._copy_file(src, dst)
+                linked[key] = dst
+        else:
+            self._copy_file(path, partial)
+        os.rename(partial, dest)
+        self._remove_tree(path)
+
+    def _pack(self, path):
+        if self.pack_format == PACK_ZIP:
+            self._pack_zip(path)
+        else:
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    self._pack_camera(entry.path)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if self.pack_format == PACK_SEGMENT and os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            manifest['packed'] = PACK_SEGMENT
+            write_json_atomic(manifest_path, manifest, indent=2)
+
+    def _pack_camera(self, cam_dir):
+        """Gói frame_*.jpg của 1 camera thành 1 segment (giữ sequence của frames.idx), xoá JPEG, dựng lại index."""
+        frames = sorted((ts, name) for name in os.listdir(cam_dir)
+                        for ts in (parse_frame_filename(name),) if ts is not None)
+        # lần gói trước bị ngắt sau khi segment đã xong: frame đã có trong segment chỉ cần xoá
+        packed = {e.timestamp_ns for seg in list_segments(cam_dir) for e in read_index(index_path_for(seg))}
+        for ts, name in [f for f in frames if f[0] in packed]:
+            os.remove(os.path.join(cam_dir, name))
+        frames = [f for f in frames if f[0] not in packed]
+        if not frames:
+            if packed:
+                rebuild_index(cam_dir)
+            return
+        sequences = {}
+        if os.path.exists(os.path.join(cam_dir, INDEX_FILE)):
+            try:
+                with FrameIndex(cam_dir) as index:
+                    for i in range(len(index)):
+                        record = index.entry(i)
+                        sequences.setdefault(record.timestamp_ns, record.sequence)
+            except (OSError, ValueError):
+                sequences = {}
+        final = os.path.join(cam_dir, f"seg_{format_frame_time(frames[0][0])}{SEGMENT_EXT}")
+        partial = final + PARTIAL_EXT
+        for stale in (partial, index_path_for(partial)):
+            if os.path.exists(stale):
+                os.remove(stale)
+        writer = SegmentWriter(partial)
+        try:
+            stored = {}   # inode -> (offset, length): JPEG hard link (dedup) chỉ lưu 1 lần
+            for i, (ts, name) in enumerate(frames):
+                src = os.path.join(cam_dir, name)
+                st = os.stat(src)
+                key = (st.st_dev, st.st_ino)
+                sequence = sequences.get(ts, i)
+                if key in stored:
+                    writer.append_ref(*stored[key], ts, sequence)
+                    continue
+                self._throttle(st.st_size)
+                with open(src, 'rb') as f:
+                    data = f.read()
+                stored[key] = (writer.append(data, ts, sequence), len(data))
+            writer.fsync()
+        finally:
+            writer.close()
+        os.replace(index_path_for(partial), index_path_for(final))
+        os.replace(partial, final)
+        for _, name in frames:
+            self._throttle(4096)
+            os.remove(os.path.join(cam_dir, name))
+        rebuild_index(cam_dir)
+
+    def _pack_zip(self, path):
+        """Gói cả phiên thành <session>.zip cạnh thư mục phiên rồi xoá thư mục."""
+        final = path + ARCHIVE_EXT
+        partial = final + PARTIAL_EXT
+        base = os.path.dirname(path)
+        # fsync trên chính handle ghi (Windows: FlushFileBuffers cần quyền ghi, handle 'rb' báo EBADF);
+        # ZipFile nhận file object thì không tự đóng, central directory đã ghi xong khi ra khỏi with
+        with open(partial, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', allowZip64=True) as archive:
+                for src in sorted(_tree_files(path)):
+                    info = zipfile.ZipInfo.from_file(src, os.path.relpath(src, base))
+                    info.compress_type = zipfile.ZIP_STORED if src.lower().endswith(STORED_EXTS) \
+                        else zipfile.ZIP_DEFLATED
+                    with open(src, 'rb') as fin, archive.open(info, 'w', force_zip64=True) as fout:
+                        while True:
+                            chunk = fin.read(COPY_CHUNK)
+                            if not chunk:
+                                break
+                            self._throttle(len(chunk))
+                            fout.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, final)
+        self._remove_tree(path)
+
+    # ---------- Vòng đời ----------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.failed += 1
+                if self.on_error is not None:
+                    self.on_error(None, e)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "done": dict(self.done),
+            "bytes": dict(self.done_bytes),
+            "deferred": self.deferred,
+            "failed": self.failed,
+        }
+
+
+def format_report(actions, dry_run=True):
+    """Báo cáo kế hoạch: từng thao tác và tổng dung lượng theo loại."""
+    lines = []
+    for a in actions:
+        lines.append(f"{a.kind:<13} {format_bytes(a.bytes):>10}  {a.path}  ({a.reason})")
+    totals = collections.Counter()
+    counts = collections.Counter()
+    for a in actions:
+        totals[a.kind] += a.bytes
+        counts[a.kind] += 1
+    reclaim = totals['delete'] + totals['delete_camera'] + totals['relocate']
+    verb = "Sẽ" if dry_run else "Đã"
+    summary = ", ".join(f"{kind} {counts[kind]} ({format_bytes(totals[kind])})" for kind in sorted(counts))
+    lines.append(f"{verb} giải phóng {format_bytes(reclaim)} trên ổ chính"
+                 + (f": {summary}" if summary else " (không có gì cần làm)")
+                 + (" + tiết kiệm thêm từ đóng gói" if counts['pack'] else ""))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bảo trì DATA_DIR của CamServer (xoá / đóng gói / chuyển phiên cũ)")
+    parser.add_argument('command', choices=('report', 'run'), help="report = chỉ báo cáo (dry-run), run = thực hiện")
+    parser.add_argument('data_dir')
+    parser.add_argument('--secondary', help="thư mục ổ phụ để chuyển phiên cũ sang")
+    parser.add_argument('--max-age-days', type=float, default=0)
+    parser.add_argument('--max-gb', type=float, default=0, help="dung lượng tối đa của ổ chính")
+    parser.add_argument('--camera-max-gb', type=float, default=0, help="dung lượng tối đa mỗi camera")
+    parser.add_argument('--min-free-pct', type=float, default=0)
+    parser.add_argument('--target-free-pct', type=float, default=0)
+    parser.add_argument('--relocate-after-hours', type=float, default=0)
+    parser.add_argument('--pack-after-hours', type=float, default=0)
+    parser.add_argument('--pack-format', choices=PACK_FORMATS, default=PACK_SEGMENT)
+    parser.add_argument('--max-mbps', type=float, default=0, help="giới hạn tốc độ I/O (MB/s, 0 = không giới hạn)")
+    args = parser.parse_args(argv)
+
+    service = RetentionService(
+        args.data_dir, secondary_dir=args.secondary,
+        max_age=args.max_age_days * 86400, max_bytes=int(args.max_gb * 1024 ** 3),
+        camera_max_bytes=int(args.camera_max_gb * 1024 ** 3),
+        min_free=args.min_free_pct / 100, target_free=args.target_free_pct / 100,
+        relocate_after=args.relocate_after_hours * 3600, pack_after=args.pack_after_hours * 3600,
+        pack_format=args.pack_format, max_bytes_per_s=args.max_mbps * 1024 * 1024,
+        dry_run=args.command == 'report',
+        on_error=lambda action, e: print(f"LỖI {action.kind if action else ''} "
+                                         f"{action.path if action else ''}: {e}", file=sys.stderr),
+    )
+    actions = service.run_once()
+    print(format_report(actions, dry_run=service.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+Lưu frame dạng segment append-only theo từng camera.
+
+Thay vì 1 file JPEG / frame, mỗi camera ghi nối tiếp các frame vào file segment
+    <cam_dir>/seg_<YYYYmmdd_HHMMSS_ffffff>.seg
+kèm file index cùng tên đuôi .idx gồm các bản ghi cố định:
+    offset (u64) | length (u32) | timestamp ns (i64) | sequence (u64)
+timestamp là thời điểm chụp (header v2) quy đổi sang đồng hồ server, hoặc thời điểm nhận (legacy).
+sequence là sequence thiết bị gửi trong header v2 (để truy khoảng mất frame về sequence trên
+đường truyền); frame legacy dùng bộ đếm nối tiếp của storage.
+Segment được xoay vòng theo kích thước hoặc thời gian.
+
+CLI:
+    python SegmentStore.py info   <cam_dir | file.seg>
+    python SegmentStore.py export <file.seg> [out_dir]
+"""
+import argparse
+import collections
+import os
+import struct
+import sys
+import threading
+import time
+
+from FrameWriter import FSYNC_BATCH, FSYNC_FRAME, FSYNC_NONE, format_frame_time, frame_filename
+
+SEGMENT_EXT = '.seg'
+INDEX_EXT = '.idx'
+
+INDEX_MAGIC = b'MCSI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHH')
+INDEX_RECORD = struct.Struct('<QIqQ')
+
+IndexEntry = collections.namedtuple('IndexEntry', 'offset length timestamp_ns sequence')
+
+
+def index_path_for(segment_path):
+    return os.path.splitext(segment_path)[0] + INDEX_EXT
+
+
+def list_segments(cam_dir):
+    """Danh sách file segment của 1 camera, sắp theo thời gian tạo (tên file)."""
+    try:
+        names = os.listdir(cam_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(cam_dir, n) for n in sorted(names) if n.startswith('seg_') and n.endswith(SEGMENT_EXT)]
+
+
+def read_index(index_path):
+    """Đọc toàn bộ index của 1 segment (bỏ qua bản ghi cuối bị ghi dở)."""
+    with open(index_path, 'rb') as f:
+        raw = f.read()
+    if len(raw) < INDEX_HEADER.size:
+        return []
+    magic, version, _ = INDEX_HEADER.unpack_from(raw)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise ValueError(f"{index_path}: không phải index segment hợp lệ")
+    body = len(raw) - INDEX_HEADER.size
+    count = body // INDEX_RECORD.size
+    return [IndexEntry(*INDEX_RECORD.unpack_from(raw, INDEX_HEADER.size + i * INDEX_RECORD.size))
+            for i in range(count)]
+
+
+class SegmentWriter:
+    """1 segment đang mở để ghi nối tiếp (data + index)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = index_path_for(path)
+        self.created = time.monotonic()
+        self.data_file = open(path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        if self.index_file.tell() == 0:
+            self.index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0))
+        self.size = self.data_file.tell()
+        self.count = 0
+
+    def append(self, data, timestamp_ns, sequence):
+        offset = self.size
+        length = len(data)
+        self.data_file.write(data)
+        # data phải xuống trước index để index không bao giờ trỏ ra ngoài data
+        self.data_file.flush()
+        self.index_file.write(INDEX_RECORD.pack(offset, length, timestamp_ns, sequence))
+        self.index_file.flush()
+        self.size += length
+        self.count += 1
+        return offset
+
+    def append_ref(self, offset, length, timestamp_ns, sequence):
+        """Bản ghi index trỏ lại dữ liệu đã có trong segment (frame lặp lại y hệt, không ghi data lần nữa)."""
+        self.index_file.write(INDEX_RECORD.pack(offset, length, timestamp_ns, sequence))
+        self.index_file.flush()
+        self.count += 1
+
+    def fsync(self):
+        os.fsync(self.data_file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        for f in (self.data_file, self.index_file):
+            try:
+                f.close()
+            except Exception:
+                pass
+
+
+class _CameraSegments:
+    def __init__(self, cam_dir):
+        self.cam_dir = cam_dir
+        self.lock = threading.Lock()
+        self.writer = None
+        self.next_sequence = _last_sequence(cam_dir) + 1
+        # (digest, offset, length) frame ghi gần nhất trong segment đang mở (dedup)
+        self.last = None
+
+
+def _last_sequence(cam_dir):
+    """Sequence lớn nhất đã ghi của camera (-1 nếu chưa có), để nối tiếp sau khi restart."""
+    for path in reversed(list_segments(cam_dir)):
+        try:
+            entries = read_index(index_path_for(path))
+        except Exception:
+            continue
+        if entries:
+            return entries[-1].sequence
+    return -1
+
+
+def _new_segment_path(cam_dir, timestamp_ns):
+    return os.path.join(cam_dir, f"seg_{format_frame_time(timestamp_ns)}{SEGMENT_EXT}")
+
+
+class SegmentStorage:
+    """
+    Storage cho FrameWriter: ghi frame vào segment append-only theo camera.
+    max_bytes / max_seconds: ngưỡng xoay segment (0 = không xoay theo tiêu chí đó).
+    indexer: FrameIndex.FrameIndexer (tuỳ chọn) để ghi index theo camera.
+    dedup: frame có digest trùng frame trước của camera (cùng segment) chỉ ghi bản ghi index
+    trỏ lại dữ liệu đã có, không ghi payload lần nữa.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_seconds=300, indexer=None, dedup=False):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.indexer = indexer
+        self.dedup = dedup
+        self.deduplicated = 0
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def _camera(self, cam_dir):
+        with self._lock:
+            cam = self._cameras.get(cam_dir)
+            if cam is None:
+                cam = self._cameras[cam_dir] = _CameraSegments(cam_dir)
+            return cam
+
+    def _needs_rotation(self, writer, length):
+        if self.max_bytes > 0 and writer.size > 0 and writer.size + length > self.max_bytes:
+            return True
+        if self.max_seconds > 0 and time.monotonic() - writer.created >= self.max_seconds:
+            return True
+        return False
+
+    def _append(self, cam, frame, fsync_policy):
+        writer = cam.writer
+        if writer is not None and self._needs_rotation(writer, len(frame.data)):
+            if fsync_policy != FSYNC_NONE:
+                writer.fsync()
+            writer.close()
+            writer = cam.writer = None
+            cam.last = None
+        if writer is None:
+            writer = cam.writer = SegmentWriter(_new_segment_path(cam.cam_dir, frame.timestamp_ns))
+        # sequence thiết bị (header v2); bộ đếm của storage chỉ dùng cho frame legacy
+        sequence = frame.sequence if frame.sequence is not None else cam.next_sequence
+        if self.dedup and frame.digest is not None and cam.last is not None and cam.last[0] == frame.digest:
+            _, offset, length = cam.last
+            writer.append_ref(offset, length, frame.timestamp_ns, sequence)
+            self.deduplicated += 1
+        else:
+            offset = writer.append(frame.data, frame.timestamp_ns, sequence)
+            if self.dedup:
+                cam.last = (frame.digest, offset, len(frame.data)) if frame.digest is not None else None
+        cam.next_sequence = max(cam.next_sequence, sequence + 1)
+        if self.indexer is not None:
+            self.indexer.append(cam.cam_dir, frame.timestamp_ns, len(frame.data),
+                                os.path.basename(writer.path), offset, sequence)
+        if fsync_policy == FSYNC_FRAME:
+            writer.fsync()
+        return writer
+
+    def write_batch(self, frames, fsync_policy, on_error=None):
+        written = []
+        touched = {}
+        for frame in frames:
+            cam = self._camera(frame.cam_dir)
+            try:
+                with cam.lock:
+                    touched[id(cam)] = cam
+                    self._append(cam, frame, fsync_policy)
+                written.append(frame)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(frame, e)
+        if fsync_policy == FSYNC_BATCH:
+            for cam in touched.values():
+                with cam.lock:
+                    if cam.writer is not None:
+                        cam.writer.fsync()
+        if self.indexer is not None:
+            self.indexer.flush()
+        return written
+
+    def close_cameras(self, cam_dirs):
+        """Đóng segment đang ghi của các thư mục camera không còn nhận frame (vd phiên ghi đã đóng)."""
+        with self._lock:
+            cameras = [self._cameras.pop(d) for d in cam_dirs if d in self._cameras]
+        for cam in cameras:
+            with cam.lock:
+                if cam.writer is not None:
+                    cam.writer.close()
+                    cam.writer = None
+        if self.indexer is not None:
+            self.indexer.close_cameras(cam_dirs)
+
+    def close(self):
+        with self._lock:
+            cameras = list(self._cameras.values())
+        for cam in cameras:
+            with cam.lock:
+                if cam.writer is not None:
+                    cam.writer.close()
+                    cam.writer = None
+        if self.indexer is not None:
+            self.indexer.close()
+
+
+class SegmentReader:
+    """Đọc ngẫu nhiên các frame trong 1 segment qua index sidecar."""
+
+    def __init__(self, segment_path):
+        self.path = segment_path
+        self.index_path = index_path_for(segment_path)
+        self.entries = read_index(self.index_path)
+        self._file = open(segment_path, 'rb')
+        # Bỏ các bản ghi trỏ quá cuối file data (segment đang ghi dở / crash)
+        data_size = os.fstat(self._file.fileno()).st_size
+        while self.entries and self.entries[-1].offset + self.entries[-1].length > data_size:
+            self.entries.pop()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def read(self, i):
+        entry = self.entries[i]
+        self._file.seek(entry.offset)
+        return self._file.read(entry.length)
+
+    def __iter__(self):
+        for i, entry in enumerate(self.entries):
+            yield entry, self.read(i)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_segment(segment_path, out_dir):
+    """Tách 1 segment thành các file frame_<timestamp>.jpg. Trả về số frame đã ghi."""
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+    with SegmentReader(segment_path) as reader:
+        for entry, data in reader:
+            with open(os.path.join(out_dir, frame_filename(entry.timestamp_ns)), 'wb') as f:
+                f.write(data)
+            count += 1
+    return count
+
+
+def _cmd_info(args):
+    paths = [args.path] if args.path.endswith(SEGMENT_EXT) else list_segments(args.path)
+    for path in paths:
+        with SegmentReader(path) as reader:
+            if reader.entries:
+                first, last = reader.entries[0], reader.entries[-1]
+                span = (last.timestamp_ns - first.timestamp_ns) / 1e9
+                print(f"{path}: {len(reader)} frame, seq {first.sequence}..{last.sequence}, {span:.1f}s")
+            else:
+                print(f"{path}: 0 frame")
+
+
+def _cmd_export(args):
+    out_dir = args.out_dir or os.path.splitext(args.segment)[0]
+    count = export_segment(args.segment, out_dir)
+    print(f"Đã xuất {count} frame vào {out_dir}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Công cụ đọc/xuất segment frame của CamServer")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_info = sub.add_parser('info', help="liệt kê segment và số frame")
+    p_info.add_argument('path', help="thư mục camera hoặc file .seg")
+    p_info.set_defaults(func=_cmd_info)
+
+    p_export = sub.add_parser('export', help="tách segment thành các file JPEG")
+    p_export.add_argument('segment', help="file .seg")
+    p_export.add_argument('out_dir', nargs='?', help="thư mục đích (mặc định: cùng tên segment)")
+    p_export.set_defaults(func=_cmd_export)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,450 @@
+"""
+Phiên ghi (take) của CamServer: mỗi SYNC_START mở 1 phiên mới, frame của phiên được ghi vào
+
+    DATA_DIR/<session>/<subdir camera>/...
+    DATA_DIR/<session>/manifest.json
+
+nên có thể ghi nhiều take liên tiếp mà không phải khởi động lại server. Bộ đếm frame
+(và giới hạn MAX_FRAMES) tính riêng cho từng phiên.
+
+manifest.json được ghi ngay khi mở phiên (status "recording") và ghi lại khi đóng
+("closed"): thiết bị tham gia, thời điểm bắt đầu / kết thúc, số frame, số byte, frame
+bị bỏ theo camera. Phiên dừng do crash vẫn còn manifest lúc mở.
+
+Sau SYNC_STOP phiên còn nhận frame thêm close_grace giây (frame đang trên đường truyền,
+điện thoại dừng chậm) rồi mới đóng: on_finalize (chờ writer ghi xong, đóng file) chạy
+trước khi ghi manifest cuối. Frame tới muộn hơn nữa bị bỏ (không mở lại phiên); chỉ khi
+process chưa mở phiên nào (server khởi động lại giữa take) thì frame đầu tiên tự mở phiên.
+
+Với INGEST_WORKERS > 0, mỗi process ingest giữ SessionMirror: bản sao phiên do process
+chính mở / dừng, đếm frame của các camera mình nhận và trả bộ đếm khi phiên đóng.
+"""
+import datetime
+import os
+import threading
+import time
+
+from DeviceStore import write_json_atomic
+
+SESSION_PREFIX = 'session_'
+MANIFEST_FILE = 'manifest.json'
+
+
+def list_sessions(data_dir):
+    """Thư mục phiên trong data_dir, cũ -> mới (tên phiên sắp theo thời gian)."""
+    try:
+        names = [e.name for e in os.scandir(data_dir) if e.is_dir() and e.name.startswith(SESSION_PREFIX)]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(data_dir, n) for n in sorted(names)]
+
+
+def _iso(time_ns):
+    if time_ns is None:
+        return None
+    return datetime.datetime.fromtimestamp(time_ns / 1e9).isoformat(timespec='milliseconds')
+
+
+class CameraStats:
+    __slots__ = ('frames', 'bytes', 'written', 'written_bytes', 'discarded', 'dropped', 'corrupt', 'repeated',
+                 'lost', 'first_ns', 'last_ns')
+
+    def __init__(self):
+        self.frames = 0          # frame nhận được và chuyển cho writer
+        self.bytes = 0
+        self.written = 0         # frame writer đã ghi xuống storage
+        self.written_bytes = 0
+        self.discarded = 0       # frame tới sau khi camera đạt MAX_FRAMES của phiên
+        self.dropped = 0         # frame writer bỏ do hàng đợi đầy
+        self.corrupt = 0         # frame không phải JPEG hoàn chỉnh (chuyển vào quarantine)
+        self.repeated = 0        # frame giống hệt frame trước (camera đứng hình?)
+        self.lost = 0            # frame thiếu theo sequence header v2
+        self.first_ns = None
+        self.last_ns = None
+
+    def to_dict(self):
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "written": self.written,
+            "writtenBytes": self.written_bytes,
+            "discarded": self.discarded,
+            "dropped": self.dropped,
+            "corrupt": self.corrupt,
+            "repeated": self.repeated,
+            "lost": self.lost,
+            "firstFrame": _iso(self.first_ns),
+            "lastFrame": _iso(self.last_ns),
+        }
+
+
+class RecordingSession:
+    """1 take: thư mục riêng, bộ đếm theo camera, thông tin thiết bị cho manifest."""
+
+    def __init__(self, session_id, path, started_ns, devices=None, reason=''):
+        self.id = session_id
+        self.path = path
+        self.started_ns = started_ns
+        self.stopped_ns = None
+        self.closed_ns = None
+        self.reason = reason
+        self.stop_reason = None
+        self.devices = list(devices or [])
+        self.cameras = {}
+        # thông tin thêm do server điền lúc đóng (cấu hình storage...)
+        self.extra = {}
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stopping(self):
+        return self.stopped_ns is not None
+
+    def cam_dir(self, subdir):
+        """Thư mục camera trong phiên (tạo khi có frame đầu tiên)."""
+        cam_dir = self._dirs.get(subdir)
+        if cam_dir is None:
+            cam_dir = os.path.join(self.path, subdir)
+            os.makedirs(cam_dir, exist_ok=True)
+            self._dirs[subdir] = cam_dir
+        return cam_dir
+
+    def cam_dirs(self):
+        return list(self._dirs.values())
+
+    def _stats(self, cam_name):
+        stats = self.cameras.get(cam_name)
+        if stats is None:
+            stats = self.cameras[cam_name] = CameraStats()
+        return stats
+
+    def admit(self, cam_name, nbytes, timestamp_ns, max_frames=0):
+        """Đếm 1 frame nhận được. Trả về số thứ tự frame trong phiên, 0 nếu camera đã đủ max_frames."""
+        with self._lock:
+            stats = self._stats(cam_name)
+            if max_frames > 0 and stats.frames >= max_frames:
+                stats.discarded += 1
+                return 0
+            stats.frames += 1
+            stats.bytes += nbytes
+            if stats.first_ns is None:
+                stats.first_ns = timestamp_ns
+            stats.last_ns = timestamp_ns
+            return stats.frames
+
+    def count_written(self, cam_name, nbytes):
+        with self._lock:
+            stats = self._stats(cam_name)
+            stats.written += 1
+            stats.written_bytes += nbytes
+
+    def count_lost(self, cam_name, frames):
+        with self._lock:
+            self._stats(cam_name).lost += frames
+
+    def count_dropped(self, cam_name, frames):
+        with self._lock:
+            self._stats(cam_name).dropped += frames
+
+    def count_corrupt(self, cam_name):
+        with self._lock:
+            self._stats(cam_name).corrupt += 1
+
+    def count_repeated(self, cam_name):
+        with self._lock:
+            self._stats(cam_name).repeated += 1
+
+    def merge_cameras(self, cameras, dirs=()):
+        """Nhận bộ đếm camera do process khác đếm (process ingest) và thư mục camera của phiên."""
+        with self._lock:
+            self.cameras.update(cameras)
+        for cam_dir in dirs:
+            self._dirs.setdefault(os.path.basename(cam_dir), cam_dir)
+
+    def cameras_snapshot(self):
+        with self._lock:
+            return dict(self.cameras)
+
+    def frame_counts(self):
+        with self._lock:
+            return {cam: stats.frames for cam, stats in self.cameras.items()}
+
+    def total_frames(self):
+        # không lấy lock (UI đọc mỗi giây, không tranh lock với admit() của thread nhận frame)
+        return sum(s.frames for s in list(self.cameras.values()))
+
+    def manifest(self):
+        with self._lock:
+            cameras = {cam: stats.to_dict() for cam, stats in sorted(self.cameras.items())}
+        end_ns = self.stopped_ns or self.closed_ns
+        return {
+            "session": self.id,
+            "status": "closed" if self.closed_ns is not None else "recording",
+            "reason": self.reason,
+            "stopReason": self.stop_reason,
+            "startedAt": _iso(self.started_ns),
+            "stoppedAt": _iso(end_ns),
+            "startedNs": self.started_ns,
+            "stoppedNs": end_ns,
+            "durationSeconds": round((end_ns - self.started_ns) / 1e9, 3) if end_ns is not None else None,
+            "devices": self.devices,
+            "cameras": cameras,
+            "totals": {
+                "frames": sum(c["frames"] for c in cameras.values()),
+                "bytes": sum(c["bytes"] for c in cameras.values()),
+                "written": sum(c["written"] for c in cameras.values()),
+                "discarded": sum(c["discarded"] for c in cameras.values()),
+                "dropped": sum(c["dropped"] for c in cameras.values()),
+                "corrupt": sum(c["corrupt"] for c in cameras.values()),
+                "repeated": sum(c["repeated"] for c in cameras.values()),
+                "lost": sum(c["lost"] for c in cameras.values()),
+            },
+            **self.extra,
+        }
+
+    def write_manifest(self):
+        write_json_atomic(os.path.join(self.path, MANIFEST_FILE), self.manifest(), indent=2)
+
+
+class SessionManager:
+    """
+    data_dir: thư mục gốc chứa các phiên.
+    close_grace: số giây phiên còn nhận frame sau SYNC_STOP trước khi đóng.
+    on_open(session) / on_stop(session) / on_finalize(session): callback của server
+    (on_finalize chạy trước khi ghi manifest cuối, trong thread nền).
+    """
+
+    def __init__(self, data_dir, close_grace=2.0, on_open=None, on_stop=None, on_finalize=None):
+        self.data_dir = data_dir
+        self.close_grace = close_grace
+        self.on_open = on_open
+        self.on_stop = on_stop
+        self.on_finalize = on_finalize
+        self._current = None
+        self._stopping = {}      # path -> phiên đã SYNC_STOP, chưa đóng
+        self._opened = False     # đã mở phiên nào trong process này chưa (chỉ tự mở phiên khi chưa)
+        self._lock = threading.Lock()
+        self._auto_lock = threading.Lock()
+        self.history = []        # id các phiên đã đóng trong process này
+
+    def current(self):
+        return self._current
+
+    def active(self):
+        """Thư mục các phiên chưa đóng hẳn (đang mở + đang đóng)."""
+        with self._lock:
+            paths = list(self._stopping)
+            if self._current is not None:
+                paths.append(self._current.path)
+        return paths
+
+    def _new_id(self, now_ns):
+        stamp = datetime.datetime.fromtimestamp(now_ns / 1e9).strftime('%Y%m%d_%H%M%S')
+        session_id = SESSION_PREFIX + stamp
+        n = 2
+        while os.path.exists(os.path.join(self.data_dir, session_id)):
+            session_id = f"{SESSION_PREFIX}{stamp}_{n}"
+            n += 1
+        return session_id
+
+    def open(self, devices=None, reason=''):
+        """Mở phiên mới (phiên đang mở, nếu có, chuyển sang dừng và đóng ngay)."""
+        now_ns = time.time_ns()
+        with self._lock:
+            previous = self._current
+            session_id = self._new_id(now_ns)
+            path = os.path.join(self.data_dir, session_id)
+            os.makedirs(path, exist_ok=True)
+            session = self._current = RecordingSession(session_id, path, now_ns, devices, reason)
+            self._opened = True
+            if previous is not None:
+                previous.stopped_ns = now_ns
+                previous.stop_reason = 'next_session'
+                self._stopping[previous.path] = previous
+        if previous is not None:
+            if self.on_stop is not None:
+                self.on_stop(previous)
+            self._finalize_later(previous, 0.0)
+        if self.on_open is not None:
+            self.on_open(session)
+        session.write_manifest()
+        return session
+
+    def stop(self, session=None, reason=''):
+        """
+        SYNC_STOP: phiên (mặc định phiên hiện tại) ngừng nhận frame mới sau close_grace giây
+        rồi đóng. Trả về phiên vừa dừng, None nếu không có phiên hoặc phiên đã dừng trước đó.
+        """
+        with self._lock:
+            session = session or self._current
+            if session is None or session.stopping:
+                return None
+            session.stopped_ns = time.time_ns()
+            session.stop_reason = reason
+            if self._current is session:
+                self._current = None
+            self._stopping[session.path] = session
+        if self.on_stop is not None:
+            self.on_stop(session)
+        self._finalize_later(session, self.close_grace)
+        return session
+
+    def for_frame(self, devices=None):
+        """
+        Phiên nhận frame vừa tới: phiên đang mở, phiên vừa SYNC_STOP còn trong close_grace,
+        hoặc mở phiên mới nếu process này chưa mở phiên nào (server khởi động lại giữa take).
+        None nếu phiên đã dừng (SYNC_STOP / MAX_FRAMES) quá close_grace: frame bị bỏ, không mở
+        lại phiên (thiết bị lỡ SYNC_STOP vẫn gửi tiếp sẽ tạo chuỗi phiên tự mở không dứt).
+        """
+        session = self._current
+        if session is not None:
+            return session
+        # nhiều camera cùng gửi frame đầu tiên: chỉ mở 1 phiên
+        with self._auto_lock:
+            now_ns = time.time_ns()
+            with self._lock:
+                if self._current is not None:
+                    return self._current
+                for stopping in self._stopping.values():
+                    if now_ns - stopping.stopped_ns <= self.close_grace * 1e9:
+                        return stopping
+                if self._opened:
+                    return None
+            return self.open(devices() if callable(devices) else devices, reason='auto')
+
+    def find(self, path):
+        """Phiên (đang mở hoặc đang đóng) theo thư mục phiên."""
+        session = self._current
+        if session is not None and session.path == path:
+            return session
+        return self._stopping.get(path)
+
+    def _finalize_later(self, session, delay):
+        timer = threading.Timer(delay, self.finalize, args=(session,))
+        timer.daemon = True
+        timer.start()
+
+    def finalize(self, session):
+        """Đóng hẳn phiên: on_finalize rồi ghi manifest cuối (gọi nhiều lần không sao)."""
+        with self._lock:
+            if self._stopping.get(session.path) is not session:
+                return False
+        try:
+            if self.on_finalize is not None:
+                self.on_finalize(session)
+        finally:
+            session.closed_ns = time.time_ns()
+            with self._lock:
+                self._stopping.pop(session.path, None)
+                self.history.append(session.id)
+            session.write_manifest()
+        return True
+
+    def close(self, reason='shutdown'):
+        """Tắt server: dừng phiên hiện tại và đóng mọi phiên ngay (không chờ close_grace)."""
+        self.stop(reason=reason)
+        with self._lock:
+            pending = list(self._stopping.values())
+        for session in pending:
+            self.finalize(session)
+
+
+class SessionMirror:
+    """
+    Phiên ghi trong process ingest (INGEST_WORKERS > 0), cùng giao diện với SessionManager
+    cho tầng lưu trữ (current / for_frame / find). Process chính mở / dừng phiên và báo
+    sang (apply_open / apply_stop); frame của camera trong process này được đếm vào
+    RecordingSession riêng, bộ đếm được trả về process chính khi phiên đóng (pop).
+    request_open(): frame tới khi chưa có phiên -> hỏi process chính
+    (session_id, path, started_ns, reason, stopped_ns, stop_reason), None nếu không có phiên nhận frame.
+    Chỉ hỏi khi bản sao chưa từng thấy phiên nào: sau khi đã có phiên (hoặc process chính trả
+    None) frame tới lúc không có phiên bị bỏ ngay, không tốn 1 lượt IPC / frame, cho tới khi
+    tin session_open kế tiếp tới (apply_open).
+    on_open(session): phiên mới xuất hiện trong process này.
+    """
+
+    def __init__(self, close_grace=2.0, request_open=None, on_open=None):
+        self.close_grace = close_grace
+        self.request_open = request_open
+        self.on_open = on_open
+        self._current = None
+        self._sessions = {}      # path -> phiên chưa đóng
+        self._lock = threading.Lock()
+        self._auto_lock = threading.Lock()
+        # còn phải hỏi process chính khi không có phiên (False sau apply_open / câu trả lời None)
+        self._ask_main = True
+
+    def current(self):
+        return self._current
+
+    def apply_open(self, session_id, path, started_ns, reason='', stopped_ns=None, stop_reason=None):
+        """Process chính đã mở phiên (gọi lại cùng phiên không sao)."""
+        with self._lock:
+            self._ask_main = False
+            session = self._sessions.get(path)
+            if session is not None:
+                return session
+            session = self._sessions[path] = RecordingSession(session_id, path, started_ns, reason=reason)
+            session.stopped_ns = stopped_ns
+            session.stop_reason = stop_reason
+            previous = self._current
+            if stopped_ns is None and (previous is None or previous.started_ns <= started_ns):
+                self._current = session
+                if previous is not None:
+                    previous.stopped_ns = started_ns
+                    previous.stop_reason = 'next_session'
+        if self.on_open is not None:
+            self.on_open(session)
+        return session
+
+    def apply_stop(self, path, stopped_ns, reason=''):
+        """Process chính đã dừng phiên (SYNC_STOP / MAX_FRAMES): còn nhận frame trong close_grace."""
+        with self._lock:
+            session = self._sessions.get(path)
+            if session is None or session.stopping:
+                return
+            session.stopped_ns = stopped_ns
+            session.stop_reason = reason
+            if self._current is session:
+                self._current = None
+
+    def for_frame(self, devices=None):
+        """Như SessionManager.for_frame (None = bỏ frame); phiên tự mở do process chính quyết định (devices bỏ qua)."""
+        session = self._current
+        if session is not None:
+            return session
+        with self._auto_lock:
+            now_ns = time.time_ns()
+            with self._lock:
+                if self._current is not None:
+                    return self._current
+                for stopping in self._sessions.values():
+                    if stopping.stopping and now_ns - stopping.stopped_ns <= self.close_grace * 1e9:
+                        return stopping
+                if not self._ask_main:
+                    return None
+            try:
+                opened = self.request_open()
+            except TimeoutError:
+                # process chính bận: bỏ frame này, frame sau hỏi lại
+                return None
+            if opened is None:
+                with self._lock:
+                    self._ask_main = False
+                return None
+            return self.apply_open(*opened)
+
+    def find(self, path):
+        return self._sessions.get(path)
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def pop(self, path):
+        """Phiên đã đóng ở process chính: bỏ khỏi bản sao, trả về phiên (None nếu không có frame)."""
+        with self._lock:
+            session = self._sessions.pop(path, None)
+            if self._current is session:
+                self._current = None
+        return session
@@ -0,0 +1,260 @@
+"""
+Ảnh thu nhỏ và contact sheet nhiều camera, tạo sau khi frame đã ghi xuống storage.
+
+    DATA_DIR/<session>/<camera>/thumbs/thumb_%Y%m%d_%H%M%S_%f.jpg
+    DATA_DIR/<session>/sheets/sheet_%Y%m%d_%H%M%S_%f.jpg
+
+Giải mã JPEG độ phân giải gốc tốn CPU và giữ GIL, nên mọi việc giải mã / thu nhỏ / ghép
+ảnh chạy trong ProcessPoolExecutor; thread writer chỉ lấy mẫu 1 frame / every_n frame của
+mỗi camera, copy payload của frame được chọn rồi submit. Số việc đang chờ bị giới hạn
+(max_pending) và frame mẫu bị bỏ qua (shed) khi pool chưa theo kịp hoặc khi ingest đang
+bận (busy(), vd hàng đợi writer gần đầy) - ảnh thu nhỏ không bao giờ làm chậm việc ghi.
+
+Contact sheet: mỗi sheet_interval giây ghép ảnh thu nhỏ mới nhất của các camera trong
+cùng phiên, căn theo timestamp: mốc là thời điểm mọi camera đều đã có ảnh, mỗi camera
+lấy ảnh gần mốc nhất, nhãn ghi độ lệch so với mốc.
+
+Cần Pillow (pip install pillow); không có Pillow thì AVAILABLE = False.
+"""
+import collections
+import concurrent.futures
+import io
+import os
+import threading
+import time
+
+from FrameWriter import format_frame_time
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+    ImageDraw = None
+
+AVAILABLE = Image is not None
+
+THUMBS_DIR = 'thumbs'
+SHEETS_DIR = 'sheets'
+
+
+def thumbnail_path(cam_dir, timestamp_ns):
+    return os.path.join(cam_dir, THUMBS_DIR, f"thumb_{format_frame_time(timestamp_ns)}.jpg")
+
+
+def sheet_path(session_dir, timestamp_ns):
+    return os.path.join(session_dir, SHEETS_DIR, f"sheet_{format_frame_time(timestamp_ns)}.jpg")
+
+
+# ---------- Chạy trong process con ----------
+
+def _save_jpeg(img, path, quality):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    img.save(tmp, 'JPEG', quality=quality)
+    os.replace(tmp, path)
+
+
+def make_thumbnail(data, out_path, max_size=320, quality=70):
+    """Thu nhỏ 1 JPEG (bytes) để cạnh dài <= max_size. Trả về (out_path, (w, h))."""
+    with Image.open(io.BytesIO(data)) as img:
+        # giải mã thẳng ở 1/2, 1/4, 1/8 kích thước (DCT scaling) thay vì giải mã đầy đủ rồi thu nhỏ
+        img.draft('RGB', (max_size, max_size))
+        thumb = img.convert('RGB')
+    thumb.thumbnail((max_size, max_size))
+    _save_jpeg(thumb, out_path, quality)
+    return out_path, thumb.size
+
+
+def make_contact_sheet(tiles, out_path, tile_size=320, columns=4, quality=80):
+    """
+    Ghép ảnh thu nhỏ thành lưới. tiles: [(nhãn, đường dẫn ảnh thu nhỏ | None)].
+    Trả về out_path.
+    """
+    columns = max(1, min(columns, len(tiles)))
+    rows = (len(tiles) + columns - 1) // columns
+    label_h = 16
+    cell_w, cell_h = tile_size, tile_size * 3 // 4 + label_h
+    sheet = Image.new('RGB', (columns * cell_w, rows * cell_h), (17, 17, 17))
+    draw = ImageDraw.Draw(sheet)
+    for i, (label, path) in enumerate(tiles):
+        x, y = (i % columns) * cell_w, (i // columns) * cell_h
+        if path is not None:
+            try:
+                with Image.open(path) as thumb:
+                    thumb.thumbnail((cell_w, cell_h - label_h))
+                    sheet.paste(thumb, (x + (cell_w - thumb.width) // 2, y + label_h))
+            except OSError:
+                pass
+        draw.text((x + 4, y + 2), label, fill=(230, 230, 230))
+    _save_jpeg(sheet, out_path, quality)
+    return out_path
+
+
+# ---------- Phía server ----------
+
+class ThumbnailStage:
+    """
+    every_n: lấy mẫu 1 frame / every_n frame đã ghi của mỗi camera.
+    max_size / quality: cạnh dài tối đa và chất lượng JPEG của ảnh thu nhỏ.
+    processes: số process con giải mã.
+    max_pending: số việc tối đa đang chờ pool (vượt thì bỏ frame mẫu).
+    sheet_interval: chu kỳ ghép contact sheet (giây, 0 = tắt).
+    busy: hàm trả về True khi ingest đang bận (bỏ frame mẫu để nhường CPU).
+    on_error(exc): lỗi tạo ảnh (ảnh hỏng, đĩa đầy...).
+    """
+
+    def __init__(self, every_n=30, max_size=320, quality=70, processes=1, max_pending=8,
+                 sheet_interval=10.0, sheet_columns=4, busy=None, on_error=None):
+        if not AVAILABLE:
+            raise RuntimeError("Cần Pillow để tạo ảnh thu nhỏ (pip install pillow)")
+        self.every_n = max(1, every_n)
+        self.max_size = max_size
+        self.quality = quality
+        self.processes = max(1, processes)
+        self.max_pending = max(1, max_pending)
+        self.sheet_interval = sheet_interval
+        self.sheet_columns = sheet_columns
+        self.busy = busy
+        self.on_error = on_error
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counts = collections.Counter()
+        # camera -> deque (timestamp_ns, thumb_path, session_dir) các ảnh gần nhất
+        self._recent = {}
+        self._last_sheet = 0.0
+        self.latest_sheet = None
+        self.thumbnails = 0
+        self.sheets = 0
+        self.shed = 0
+        self.failed = 0
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+        return self._pool
+
+    def _submit(self, fn, args, callback):
+        """Submit nếu còn chỗ trong giới hạn max_pending. Trả về False nếu bỏ."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.shed += 1
+                return False
+            self._pending += 1
+            try:
+                future = self._executor().submit(fn, *args)
+            except Exception as e:
+                # pool hỏng (process con chết) -> tạo lại ở lần sau
+                self._pending -= 1
+                self._pool = None
+                self._fail(e)
+                return False
+        future.add_done_callback(callback)
+        return True
+
+    def _fail(self, exc):
+        self.failed += 1
+        if self.on_error is not None:
+            self.on_error(exc)
+
+    # ---------- Ảnh thu nhỏ ----------
+
+    def offer(self, frames):
+        """Gọi từ writer thread sau khi ghi 1 lô (frame.data còn hợp lệ): lấy mẫu và gửi sang pool."""
+        for frame in frames:
+            self._counts[frame.cam_name] += 1
+            if (self._counts[frame.cam_name] - 1) % self.every_n:
+                continue
+            if self.busy is not None and self.busy():
+                with self._lock:
+                    self.shed += 1
+                continue
+            ts = frame.timestamp_ns
+            out_path = thumbnail_path(frame.cam_dir, ts)
+            session_dir = os.path.dirname(frame.cam_dir)
+            self._submit(make_thumbnail, (bytes(frame.data), out_path, self.max_size, self.quality),
+                         lambda f, cam=frame.cam_name, ts=ts, sd=session_dir: self._on_thumbnail(cam, ts, sd, f))
+
+    def _on_thumbnail(self, cam_name, timestamp_ns, session_dir, future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            path, _ = future.result()
+        except Exception as e:
+            with self._lock:
+                self._fail(e)
+            return
+        with self._lock:
+            self.thumbnails += 1
+            recent = self._recent.get(cam_name)
+            if recent is None:
+                recent = self._recent[cam_name] = collections.deque(maxlen=8)
+            recent.append((timestamp_ns, path, session_dir))
+        self._maybe_sheet()
+
+    def latest(self):
+        """{camera: (timestamp_ns, thumb_path)} ảnh thu nhỏ mới nhất (cho UI)."""
+        with self._lock:
+            return {cam: recent[-1][:2] for cam, recent in self._recent.items() if recent}
+
+    # ---------- Contact sheet ----------
+
+    def _sheet_tiles(self):
+        """Mốc và ảnh của từng camera cho sheet kế tiếp (camera cùng phiên với ảnh mới nhất)."""
+        newest = max((recent[-1] for recent in self._recent.values() if recent), default=None)
+        if newest is None:
+            return None, None, []
+        session_dir = newest[2]
+        cameras = {cam: [item for item in recent if item[2] == session_dir]
+                   for cam, recent in sorted(self._recent.items())}
+        cameras = {cam: items for cam, items in cameras.items() if items}
+        # mốc: thời điểm mọi camera đều đã có ảnh
+        anchor = min(items[-1][0] for items in cameras.values())
+        tiles = []
+        for cam, items in cameras.items():
+            ts, path, _ = min(items, key=lambda item: abs(item[0] - anchor))
+            tiles.append((f"{cam} {(ts - anchor) / 1e6:+.0f} ms", path))
+        return session_dir, anchor, tiles
+
+    def _maybe_sheet(self):
+        if self.sheet_interval <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sheet < self.sheet_interval:
+                return
+            session_dir, anchor, tiles = self._sheet_tiles()
+            if not tiles:
+                return
+            self._last_sheet = now
+        out_path = sheet_path(session_dir, anchor)
+        self._submit(make_contact_sheet, (tiles, out_path, self.max_size, self.sheet_columns),
+                     self._on_sheet)
+
+    def _on_sheet(self, future):
+        with self._lock:
+            self._pending -= 1
+            try:
+                self.latest_sheet = future.result()
+                self.sheets += 1
+            except Exception as e:
+                self._fail(e)
+
+    # ---------- Thống kê / vòng đời ----------
+
+    def stats(self):
+        with self._lock:
+            return {
+                "thumbnails": self.thumbnails,
+                "sheets": self.sheets,
+                "pending": self._pending,
+                "shed": self.shed,
+                "failed": self.failed,
+            }
+
+    def close(self, wait=True):
+        """Dừng pool (wait=False: bỏ các việc chưa chạy)."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=not wait)
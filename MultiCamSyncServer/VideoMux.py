@@ -0,0 +1,458 @@
+"""
+Ghép frame JPEG thành video theo camera ngay trong lúc ingest (MJPEG trong Matroska .mkv).
+
+Không nén lại: mỗi frame JPEG nhận được là 1 frame video (codec V_MJPEG), thời điểm
+frame là timestamp thật của frame (capture time header v2 hoặc lúc nhận) nên video
+giữ đúng nhịp chụp dù FPS thay đổi (gợi ý RATE, mất frame). Muxer chạy trong writer
+thread, nhận payload từ bộ nhớ (không đọc lại từ đĩa) và được đóng khi phiên ghi đóng
+(SYNC_STOP):
+    DATA_DIR/<session>/<camera>.mkv
+
+File được ghi tuần tự với kích thước Segment/Cluster "chưa biết" rồi vá lại khi đóng
+(kèm Duration, Cues để tua), nên file của take bị ngắt do crash vẫn phát được.
+
+CLI (ghép lại từ dữ liệu đã có, vd take cũ):
+    python VideoMux.py mux  <cam_dir> [out.mkv]
+    python VideoMux.py info <file.mkv>
+"""
+import argparse
+import datetime
+import os
+import struct
+import sys
+import threading
+
+from FrameWriter import FSYNC_NONE
+
+VIDEO_EXT = '.mkv'
+
+# ID phần tử EBML / Matroska
+EBML = 0x1A45DFA3
+EBML_VERSION = 0x4286
+EBML_READ_VERSION = 0x42F7
+EBML_MAX_ID_LENGTH = 0x42F2
+EBML_MAX_SIZE_LENGTH = 0x42F3
+DOC_TYPE = 0x4282
+DOC_TYPE_VERSION = 0x4287
+DOC_TYPE_READ_VERSION = 0x4285
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+VOID = 0xEC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+DATE_UTC = 0x4461
+MUXING_APP = 0x4D80
+WRITING_APP = 0x5741
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+FLAG_LACING = 0x9C
+CODEC_ID = 0x86
+TRACK_NAME = 0x536E
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+
+# Kích thước "chưa biết" (8 byte) của Segment / Cluster đang ghi, vá lại khi đóng
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+TIMECODE_SCALE_NS = 1_000_000       # timecode theo ms
+SEEK_HEAD_RESERVED = 96             # chỗ dành cho SeekHead (Info, Tracks, Cues)
+# Ngày gốc của DateUTC (Matroska): 2001-01-01T00:00:00 UTC
+_MKV_EPOCH_NS = 978307200 * 1_000_000_000
+
+# Marker SOF của JPEG (chứa kích thước ảnh)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+# ---------- EBML ----------
+
+def _id_bytes(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+
+def _size_bytes(size, length=None):
+    """Độ dài dạng vint (mặc định ngắn nhất; length=8 để vá lại được)."""
+    if length is None:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    return (size | (1 << (7 * length))).to_bytes(length, 'big')
+
+
+def element(element_id, payload):
+    return _id_bytes(element_id) + _size_bytes(len(payload)) + payload
+
+
+def uint_element(element_id, value):
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+
+def int_element(element_id, value):
+    return element(element_id, value.to_bytes(8, 'big', signed=True))
+
+
+def float_element(element_id, value):
+    return element(element_id, struct.pack('>d', value))
+
+
+def string_element(element_id, value):
+    return element(element_id, value.encode('utf-8'))
+
+
+def read_vint(data, pos):
+    """Đọc vint tại pos -> (giá trị đã bỏ bit độ dài, độ dài, có phải 'chưa biết')."""
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    value = first & ((0x80 >> (length - 1)) - 1)
+    for b in data[pos + 1:pos + length]:
+        value = (value << 8) | b
+    return value, length, value == (1 << (7 * length)) - 1
+
+
+def read_element_id(data, pos):
+    first = data[pos]
+    length = 1
+    while length <= 4 and not first & (0x80 >> (length - 1)):
+        length += 1
+    return int.from_bytes(data[pos:pos + length], 'big'), length
+
+
+def jpeg_size(data):
+    """(rộng, cao) đọc từ marker SOF của JPEG, (0, 0) nếu không tìm thấy."""
+    n = len(data)
+    i = 2
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            return 0, 0
+        marker = data[i + 1]
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack('>HH', bytes(data[i + 5:i + 9]))
+            return width, height
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        i += 2 + struct.unpack('>H', bytes(data[i + 2:i + 4]))[0]
+    return 0, 0
+
+
+# ---------- Muxer ----------
+
+class MkvWriter:
+    """
+    Ghi 1 track MJPEG vào file .mkv theo kiểu streaming.
+    cluster_ms: độ dài tối đa 1 Cluster (ms, giới hạn trên 32767 do timecode tương đối 16 bit).
+    """
+
+    def __init__(self, path, name='', cluster_ms=5000):
+        self.path = path
+        self.name = name
+        self.cluster_ms = max(1, min(cluster_ms, 32767))
+        self.frames = 0
+        self.first_ns = None
+        self.last_ns = None
+        self.last_delta_ns = 0
+        self._file = None
+        self._segment_data = None     # offset đầu dữ liệu Segment (gốc của SeekPosition / Cue)
+        self._duration_pos = None
+        self._cluster_pos = None
+        self._cluster_tc = None
+        self._cues = []               # (timecode ms, vị trí cluster tương đối segment)
+        self._positions = {}          # ID phần tử cấp 1 -> vị trí tương đối segment
+
+    def _segment_pos(self):
+        return self._file.tell() - self._segment_data
+
+    def _open(self, data, timestamp_ns):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = self._file = open(self.path, 'wb')
+        f.write(element(EBML,
+                        uint_element(EBML_VERSION, 1) + uint_element(EBML_READ_VERSION, 1)
+                        + uint_element(EBML_MAX_ID_LENGTH, 4) + uint_element(EBML_MAX_SIZE_LENGTH, 8)
+                        + string_element(DOC_TYPE, 'matroska') + uint_element(DOC_TYPE_VERSION, 4)
+                        + uint_element(DOC_TYPE_READ_VERSION, 2)))
+        f.write(_id_bytes(SEGMENT) + UNKNOWN_SIZE)
+        self._segment_data = f.tell()
+
+        # Chỗ trống cho SeekHead, ghi thật khi đóng file
+        f.write(_id_bytes(VOID) + _size_bytes(SEEK_HEAD_RESERVED - 9, 8) + b'\x00' * (SEEK_HEAD_RESERVED - 9))
+
+        self._positions[INFO] = self._segment_pos()
+        info = (uint_element(TIMECODE_SCALE, TIMECODE_SCALE_NS)
+                + int_element(DATE_UTC, timestamp_ns - _MKV_EPOCH_NS)
+                + string_element(MUXING_APP, 'CamServer VideoMux')
+                + string_element(WRITING_APP, 'CamServer VideoMux'))
+        duration = float_element(DURATION, 0.0)
+        f.write(_id_bytes(INFO) + _size_bytes(len(info) + len(duration)) + info)
+        self._duration_pos = f.tell() + len(duration) - 8
+        f.write(duration)
+
+        width, height = jpeg_size(data)
+        video = uint_element(PIXEL_WIDTH, width) + uint_element(PIXEL_HEIGHT, height)
+        track = (uint_element(TRACK_NUMBER, 1)
+                 + uint_element(TRACK_UID, int.from_bytes(os.urandom(7), 'big') or 1)
+                 + uint_element(TRACK_TYPE, 1)
+                 + uint_element(FLAG_LACING, 0)
+                 + string_element(CODEC_ID, 'V_MJPEG')
+                 + (string_element(TRACK_NAME, self.name) if self.name else b'')
+                 + element(VIDEO, video))
+        self._positions[TRACKS] = self._segment_pos()
+        f.write(element(TRACKS, element(TRACK_ENTRY, track)))
+        self.first_ns = timestamp_ns
+
+    def _close_cluster(self):
+        if self._cluster_pos is None:
+            return
+        end = self._file.tell()
+        self._file.seek(self._cluster_pos + 4)
+        self._file.write(_size_bytes(end - self._cluster_pos - 12, 8))
+        self._file.seek(end)
+        self._cluster_pos = None
+
+    def _start_cluster(self, timecode):
+        self._close_cluster()
+        self._cluster_pos = self._file.tell()
+        self._cluster_tc = timecode
+        self._cues.append((timecode, self._cluster_pos - self._segment_data))
+        self._file.write(_id_bytes(CLUSTER) + UNKNOWN_SIZE + uint_element(TIMECODE, timecode))
+
+    def add(self, data, timestamp_ns):
+        """Thêm 1 frame JPEG (bytes / memoryview) với timestamp epoch ns."""
+        if self._file is None:
+            self._open(data, timestamp_ns)
+        if self.last_ns is not None:
+            # timestamp phải không giảm trong 1 track
+            timestamp_ns = max(timestamp_ns, self.last_ns)
+            self.last_delta_ns = timestamp_ns - self.last_ns
+        timecode = (timestamp_ns - self.first_ns) // TIMECODE_SCALE_NS
+        if self._cluster_pos is None or timecode - self._cluster_tc > self.cluster_ms:
+            self._start_cluster(timecode)
+        header = b'\x81' + struct.pack('>hB', timecode - self._cluster_tc, 0x80)
+        f = self._file
+        f.write(_id_bytes(SIMPLE_BLOCK) + _size_bytes(len(header) + len(data)))
+        f.write(header)
+        f.write(data)
+        self.last_ns = timestamp_ns
+        self.frames += 1
+
+    def flush(self, fsync=False):
+        if self._file is not None:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        """Vá kích thước Cluster / Segment, ghi Duration, Cues và SeekHead rồi đóng file."""
+        f = self._file
+        if f is None:
+            return
+        try:
+            self._close_cluster()
+            self._positions[CUES] = self._segment_pos()
+            f.write(element(CUES, b''.join(
+                element(CUE_POINT, uint_element(CUE_TIME, tc) + element(
+                    CUE_TRACK_POSITIONS, uint_element(CUE_TRACK, 1) + uint_element(CUE_CLUSTER_POSITION, pos)))
+                for tc, pos in self._cues)))
+            end = f.tell()
+
+            # frame cuối kéo dài bằng khoảng cách frame trước đó
+            duration_ms = (self.last_ns - self.first_ns + self.last_delta_ns) / TIMECODE_SCALE_NS
+            f.seek(self._duration_pos)
+            f.write(struct.pack('>d', duration_ms))
+
+            seek_head = element(SEEK_HEAD, b''.join(
+                element(SEEK, element(SEEK_ID, _id_bytes(element_id)) + uint_element(SEEK_POSITION, pos))
+                for element_id, pos in self._positions.items()))
+            void_size = SEEK_HEAD_RESERVED - len(seek_head)
+            f.seek(self._segment_data)
+            f.write(seek_head)
+            f.write(_id_bytes(VOID) + _size_bytes(void_size - 9, 8))
+
+            f.seek(self._segment_data - 8)
+            f.write(_size_bytes(end - self._segment_data, 8))
+            f.flush()
+        finally:
+            self._file = None
+            f.close()
+
+
+class MuxingStorage:
+    """
+    Storage bọc storage gốc của FrameWriter: sau khi lô frame được ghi, frame đã ghi
+    được ghép tiếp vào <session>/<camera>.mkv (cùng writer thread, payload còn trong bộ nhớ).
+    close_cameras() (phiên ghi đóng) và close() hoàn tất file video.
+    """
+
+    def __init__(self, storage, cluster_ms=5000, on_error=None):
+        self.storage = storage
+        self.cluster_ms = cluster_ms
+        self.on_error = on_error
+        self._muxers = {}     # cam_dir -> (MkvWriter, lock)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def video_path(cam_dir):
+        cam_dir = cam_dir.rstrip('/\\')
+        return os.path.join(os.path.dirname(cam_dir), os.path.basename(cam_dir) + VIDEO_EXT)
+
+    def _muxer(self, cam_dir):
+        with self._lock:
+            entry = self._muxers.get(cam_dir)
+            if entry is None:
+                writer = MkvWriter(self.video_path(cam_dir), os.path.basename(cam_dir), self.cluster_ms)
+                entry = self._muxers[cam_dir] = (writer, threading.Lock())
+            return entry
+
+    def write_batch(self, frames, fsync_policy, on_error=None):
+        written = self.storage.write_batch(frames, fsync_policy, on_error)
+        touched = {}
+        for frame in written:
+            muxer, lock = self._muxer(frame.cam_dir)
+            try:
+                with lock:
+                    muxer.add(frame.data, frame.timestamp_ns)
+                touched[frame.cam_dir] = (muxer, lock)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(frame, e)
+        for muxer, lock in touched.values():
+            with lock:
+                muxer.flush(fsync=fsync_policy != FSYNC_NONE)
+        return written
+
+    def _finish(self, entries):
+        for muxer, lock in entries:
+            try:
+                with lock:
+                    muxer.close()
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(None, e)
+
+    def close_cameras(self, cam_dirs):
+        with self._lock:
+            entries = [self._muxers.pop(d) for d in cam_dirs if d in self._muxers]
+        self._finish(entries)
+        if hasattr(self.storage, 'close_cameras'):
+            self.storage.close_cameras(cam_dirs)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._muxers.values())
+            self._muxers = {}
+        self._finish(entries)
+        self.storage.close()
+
+
+# ---------- Đọc lại (kiểm tra file) ----------
+
+def read_mkv(path):
+    """Đọc nhanh file .mkv do MkvWriter ghi -> dict (frames, duration_ms, timecodes, width, height...)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    result = {"frames": 0, "timecodes": [], "duration_ms": None, "width": None, "height": None,
+              "codec": None, "date_utc_ns": None, "cues": 0, "complete": False}
+    containers = {SEGMENT, INFO, TRACKS, TRACK_ENTRY, VIDEO, CLUSTER, CUES}
+    cluster_tc = 0
+    pos = 0
+    end = len(data)
+    while pos < end:
+        element_id, id_len = read_element_id(data, pos)
+        size, size_len, unknown = read_vint(data, pos + id_len)
+        body = pos + id_len + size_len
+        if element_id == SEGMENT:
+            result["complete"] = not unknown
+        if element_id in containers:
+            pos = body
+            continue
+        payload = data[body:body + size]
+        if element_id == TIMECODE:
+            cluster_tc = int.from_bytes(payload, 'big')
+        elif element_id == SIMPLE_BLOCK:
+            result["frames"] += 1
+            result["timecodes"].append(cluster_tc + struct.unpack('>h', payload[1:3])[0])
+        elif element_id == DURATION:
+            result["duration_ms"] = struct.unpack('>d', payload)[0]
+        elif element_id == DATE_UTC:
+            result["date_utc_ns"] = int.from_bytes(payload, 'big', signed=True) + _MKV_EPOCH_NS
+        elif element_id == CODEC_ID:
+            result["codec"] = payload.decode('utf-8')
+        elif element_id == PIXEL_WIDTH:
+            result["width"] = int.from_bytes(payload, 'big')
+        elif element_id == PIXEL_HEIGHT:
+            result["height"] = int.from_bytes(payload, 'big')
+        elif element_id == CUE_POINT:
+            result["cues"] += 1
+        pos = body + size
+    return result
+
+
+# ---------- CLI ----------
+
+def mux_camera_dir(cam_dir, out_path=None, cluster_ms=5000):
+    """Ghép frame đã lưu của 1 camera (theo frames.idx) thành .mkv. Trả về số frame."""
+    from FrameIndex import FrameIndex
+    out_path = out_path or MuxingStorage.video_path(cam_dir)
+    writer = MkvWriter(out_path, os.path.basename(cam_dir.rstrip('/\\')), cluster_ms)
+    try:
+        with FrameIndex(cam_dir) as index:
+            for i in range(len(index)):
+                writer.add(index.read(i), index.timestamp_at(i))
+    finally:
+        writer.close()
+    return writer.frames
+
+
+def _cmd_mux(args):
+    count = mux_camera_dir(args.cam_dir, args.out)
+    print(f"Đã ghép {count} frame vào {args.out or MuxingStorage.video_path(args.cam_dir)}")
+
+
+def _cmd_info(args):
+    info = read_mkv(args.path)
+    tcs = info["timecodes"]
+    fps = (len(tcs) - 1) / ((tcs[-1] - tcs[0]) / 1000) if len(tcs) > 1 and tcs[-1] > tcs[0] else 0
+    start = (datetime.datetime.fromtimestamp(info["date_utc_ns"] / 1e9).isoformat(timespec='milliseconds')
+             if info["date_utc_ns"] is not None else '?')
+    print(f"{args.path}: {info['frames']} frame, {info['codec']} {info['width']}x{info['height']}, "
+          f"{(info['duration_ms'] or 0) / 1000:.2f}s (~{fps:.1f} fps), bắt đầu {start}, "
+          f"{info['cues']} cue{'' if info['complete'] else ' (chưa đóng)'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ghép frame JPEG của CamServer thành video MJPEG (.mkv)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_mux = sub.add_parser('mux', help="ghép frame đã lưu (theo frames.idx) của 1 camera")
+    p_mux.add_argument('cam_dir')
+    p_mux.add_argument('out', nargs='?', help="file .mkv (mặc định: <thư mục phiên>/<camera>.mkv)")
+    p_mux.set_defaults(func=_cmd_mux)
+
+    p_info = sub.add_parser('info', help="số frame / thời lượng của file .mkv")
+    p_info.add_argument('path')
+    p_info.set_defaults(func=_cmd_info)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())